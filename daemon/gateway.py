@@ -1,13 +1,246 @@
 # -*- coding: utf-8 -
 
+import logging
 import socket
+import select
+import threading
+import time
 import os
+import urllib
+import zlib
 import cgi
 
 PORT = 8000
 MOBWRITE_PORT = 3017
 DEFAULT_EDITOR = os.path.abspath(os.path.join(os.path.split(__file__)[0], '../demo/index.html'))
 
+# Most idle connections to the daemon kept for reuse.
+POOL_SIZE = 8
+# Seconds an idle connection is kept; less than the daemon's TIMEOUT_KEEPALIVE.
+POOL_MAX_IDLE = 30.0
+# Timeout if MobWrite daemon dosen't respond in 10 seconds.
+DAEMON_TIMEOUT = 10.0
+# Initial size of each connection's receive buffer.
+BUFFER_SIZE = 65536
+# Tells the daemon to keep the connection open after responding.
+KEEPALIVE_LINE = "k:1"
+# Host the sync engine in this process, instead of relaying each request to
+# a separate daemon.  Only for a single gateway process; run the daemon when
+# several gateways share the texts.
+EMBEDDED = False
+# Largest form accepted from a browser, as for the daemon's MAX_REQUEST_BYTES.
+MAX_FORM = 10000000
+# Responses shorter than this are sent uncompressed.
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
+# Bytes escaped and compressed at a time.
+CHUNK_SIZE = 65536
+# Content codings offered, in order of preference, with their zlib windows.
+ENCODINGS = [('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS)]
+
+class BadRequest(Exception):
+    """The request's form can't be read."""
+
+
+def decodeCommands(data):
+    """Find the MobWrite commands in url-encoded form data in a single pass,
+    without decoding any other fields.  Returns a tuple of the field's name
+    ('q' for a text reply, 'p' for a JavaScript one, or None if neither was
+    sent) and the decoded commands."""
+    if ';' in data:
+        # Either separator is allowed, as for cgi.FieldStorage.
+        data = data.replace(';', '&')
+    found = None
+    for field in data.split('&'):
+        name = field[:2]
+        if name == 'q=' or field == 'q':
+            found = field
+            break
+        if found is None and (name == 'p=' or field == 'p'):
+            found = field
+    if found is None:
+        return (None, "\n")
+    return (found[0], urllib.unquote_plus(found[2:]))
+
+
+def readCommands(environ):
+    """Read the MobWrite commands from a request's query string or body.
+    Returns a tuple as for decodeCommands.  Raises ValueError if the form is
+    over MAX_FORM bytes, or BadRequest if its length is invalid."""
+    data = environ.get('QUERY_STRING', '')
+    if environ.get('REQUEST_METHOD', 'GET') == 'POST':
+        content_type = environ.get('CONTENT_TYPE', '').split(';')[0].strip()
+        if content_type.lower() not in ('', 'application/x-www-form-urlencoded'):
+            # Multipart or the like; leave it to the general parser.
+            form = cgi.FieldStorage(fp=environ['wsgi.input'],
+                                    environ=environ,
+                                    keep_blank_values=1)
+            for name in ('q', 'p'):
+                if form.has_key(name):
+                    return (name, form[name].value)
+            return (None, "\n")
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise BadRequest("Content length of %r" %
+                             environ.get('CONTENT_LENGTH'))
+        if length < 0:
+            raise BadRequest("Content length of %d" % length)
+        if length + len(data) > MAX_FORM:
+            raise ValueError("Form of %d bytes" % (length + len(data)))
+        body = environ['wsgi.input'].read(length)
+        if data:
+            # As for cgi.FieldStorage, the body's fields come first.
+            data = body + '&' + data
+        else:
+            data = body
+    elif len(data) > MAX_FORM:
+        raise ValueError("Form of %d bytes" % len(data))
+    return decodeCommands(data)
+
+
+def keepAliveRequest(request):
+    """Prepare a request for a kept-alive connection: prefix the keep-alive
+    line and drop anything after the blank line which terminates it.
+    Returns None if the request is not terminated."""
+    lines = request.split("\n")
+    # The last element follows the last line break, so isn't a whole line.
+    for x in xrange(len(lines) - 1):
+        if not lines[x].rstrip("\r"):
+            return "\n".join([KEEPALIVE_LINE] + lines[:x]) + "\n\n"
+    return None
+
+
+class DaemonConnection(object):
+    """A kept-alive connection to the MobWrite daemon."""
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address, DAEMON_TIMEOUT)
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.lasttime = time.time()
+        # Bytes of the current response received so far.
+        self.received = 0
+
+    def exchange(self, request):
+        """Send a kept-alive request and return the response.  Responses are
+        terminated by a blank line; no response contains one."""
+        self.received = 0
+        self.sock.sendall(request)
+        view = memoryview(self.buffer)
+        size = 0
+        while 1:
+            if size == len(self.buffer):
+                # Full; double the buffer.
+                del view
+                self.buffer.extend(bytearray(len(self.buffer)))
+                view = memoryview(self.buffer)
+            count = self.sock.recv_into(view[size:])
+            if not count:
+                raise socket.error("Connection closed by daemon")
+            start = max(size - 1, 0)
+            size += count
+            self.received = size
+            if self.buffer[0] == ord("\n"):
+                end = -1
+                break
+            end = self.buffer.find("\n\n", start, size)
+            if end != -1:
+                break
+        del view
+        if end + 2 != size:
+            raise socket.error("Unexpected data from daemon")
+        response = str(self.buffer[:end + 1])
+        if len(self.buffer) > BUFFER_SIZE:
+            # Don't hold on to the space needed by an unusually big response.
+            self.buffer = bytearray(BUFFER_SIZE)
+        self.lasttime = time.time()
+        return response
+
+    def close(self):
+        self.sock.close()
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of kept-alive connections to the MobWrite daemon."""
+
+    def __init__(self, address, size):
+        self.address = address
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Return a healthy idle connection, or None if there are none."""
+        while 1:
+            with self.lock:
+                if not self.idle:
+                    return None
+                # Most recently used first; the oldest expire at the bottom.
+                connection = self.idle.pop()
+            # An idle connection should have nothing to read.  If it does, the
+            # daemon has hung up (or is confused); discard it.
+            if (time.time() - connection.lasttime < POOL_MAX_IDLE and
+                    not select.select([connection.sock], [], [], 0)[0]):
+                return connection
+            connection.close()
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def exchange(self, request):
+        """Send a request to the daemon and return its response.
+        Raises socket.error if the daemon can't be reached."""
+        request = keepAliveRequest(request)
+        if request is None:
+            # Truncated request; the daemon would give up on it.
+            return ""
+        connection = self.acquire()
+        if connection:
+            try:
+                response = connection.exchange(request)
+            except socket.timeout:
+                # The daemon is slow, not gone; it may still apply the request.
+                connection.close()
+                raise
+            except socket.error:
+                connection.close()
+                if connection.received:
+                    # The daemon had begun to answer, so it has the request.
+                    raise
+                # The daemon may have expired the connection; start afresh.
+                connection = None
+        if not connection:
+            connection = DaemonConnection(self.address)
+            try:
+                response = connection.exchange(request)
+            except socket.error:
+                connection.close()
+                raise
+        self.release(connection)
+        return response
+
+
+POOL = ConnectionPool(("localhost", MOBWRITE_PORT), POOL_SIZE)
+
+ENGINE = None
+ENGINE_LOCK = threading.Lock()
+
+LOG = logging.getLogger("gateway")
+
+
+def getEngine():
+    """Return the embedded sync engine, starting it on first use."""
+    global ENGINE
+    with ENGINE_LOCK:
+        if ENGINE is None:
+            import mobwrite_daemon
+            ENGINE = mobwrite_daemon.embed()
+    return ENGINE
+
 def application(environ, start_response):
     """Simplest possible application object"""
     if environ['QUERY_STRING'] and environ['QUERY_STRING'] == 'editor':
@@ -19,23 +252,42 @@ def application(environ, start_response):
         start_response('200 OK', response_headers)
         return iter([data])
     else:
-        form = cgi.FieldStorage(fp=environ['wsgi.input'],
-                                    environ=environ,
-                                    keep_blank_values=1)
-        out_string = "\n"
-        if form.has_key('q'):
-            out_string = form['q'].value # Client sending a sync.  Requesting text return.
-        elif form.has_key('p'):
-            out_string = form['p'].value # Client sending a sync.  Requesting JS return.
-        
-        in_string = ""
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            s.connect(("localhost", MOBWRITE_PORT))
+            # 'q': Client sending a sync.  Requesting text return.
+            # 'p': Client sending a sync.  Requesting JS return.
+            (field, out_string) = readCommands(environ)
+        except BadRequest, msg:
+            data = 'ERROR: Bad request.'
+            response_headers = [
+                ('Content-type', 'text/plain'),
+                ('Content-Length', str(len(data)))
+            ]
+            start_response('400 Bad Request', response_headers)
+            return iter([data])
+        except ValueError, msg:
+            data = 'ERROR: Request too large.'
+            response_headers = [
+                ('Content-type', 'text/plain'),
+                ('Content-Length', str(len(data)))
+            ]
+            start_response('413 Request Entity Too Large', response_headers)
+            return iter([data])
+
+        try:
+            if EMBEDDED:
+                in_string = getEngine().handleRequest(out_string)
+            else:
+                in_string = POOL.exchange(out_string)
         except socket.error, msg:
-            s = None
-        if not s:
             # Python CGI can't connect to Python daemon.
+            in_string = None
+        except Exception:
+            if not EMBEDDED:
+                raise
+            # Don't let a failure in the engine take down the server.
+            LOG.exception("Sync engine failed.")
+            in_string = None
+        if in_string is None:
             data = 'ERROR: Cannot reach the mobwrite gateway.'
             response_headers = [
                 ('Content-type', 'text/plain'),
@@ -43,32 +295,92 @@ def application(environ, start_response):
             ]
             start_response('200 OK', response_headers)
             return iter([data])
-        else:
-            # Timeout if MobWrite daemon dosen't respond in 10 seconds.
-            s.settimeout(10.0)
-            s.send(out_string)
-            while 1:
-                line = s.recv(1024)
-                if not line:
-                    break
-                in_string += line
-            s.close()
-        
-        if form.has_key('p'):
-            # Client sending a sync.  Requesting JS return.
-            in_string = in_string.replace("\\", "\\\\").replace("\"", "\\\"")
-            in_string = in_string.replace("\n", "\\n").replace("\r", "\\r")
-            in_string = "mobwrite.callback(\"%s\");" % in_string
         
-        data = in_string
+        # Client sending a sync.  Requesting JS return if 'p'.
+        encoding = negotiateEncoding(environ.get('HTTP_ACCEPT_ENCODING', ''),
+                                     len(in_string))
+        data = encodeResponse(in_string, field == 'p', encoding)
         response_headers = [
             ('Content-type','text/javascript'),
-            ('Content-Length', str(len(data)))
+            ('Content-Length', str(len(data))),
+            ('Vary', 'Accept-Encoding')
         ]
+        if encoding:
+            response_headers.append(('Content-Encoding', encoding))
         start_response('200 OK', response_headers)
         return iter([data])
 
 
+def jsonpEscape(text):
+    """Escape text for a JavaScript string literal."""
+    text = text.replace("\\", "\\\\").replace("\"", "\\\"")
+    return text.replace("\n", "\\n").replace("\r", "\\r")
+
+
+def jsonpCallback(text):
+    """Wrap a response in a JavaScript call to the client."""
+    return "mobwrite.callback(\"%s\");" % jsonpEscape(text)
+
+
+def negotiateEncoding(accept, size):
+    """Choose a content coding for a response of the given size, from the
+    browser's Accept-Encoding header.  Returns 'gzip', 'deflate', or None to
+    send the response as it is."""
+    if size < COMPRESS_THRESHOLD or not accept:
+        return None
+    weights = {}
+    for item in accept.split(','):
+        params = item.split(';')
+        name = params[0].strip().lower()
+        weight = 1.0
+        for param in params[1:]:
+            (key, sep, value) = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name] = weight
+    best = None
+    best_weight = 0.0
+    for (name, wbits) in ENCODINGS:
+        weight = weights.get(name, weights.get('*', 0.0))
+        if weight > best_weight:
+            best = name
+            best_weight = weight
+    return best
+
+
+def encodeResponse(text, jsonp, encoding):
+    """Build a response body in one pass over the text: each chunk is escaped
+    for JSON-P if requested, then fed to the compressor for the given content
+    coding (or None)."""
+    compressor = None
+    if encoding:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                      dict(ENCODINGS)[encoding])
+    if not jsonp and not compressor:
+        return text
+    output = []
+    def write(data):
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            output.append(data)
+    if jsonp:
+        write('mobwrite.callback("')
+    for start in xrange(0, len(text), CHUNK_SIZE):
+        chunk = text[start:start + CHUNK_SIZE]
+        if jsonp:
+            chunk = jsonpEscape(chunk)
+        write(chunk)
+    if jsonp:
+        write('");')
+    if compressor:
+        output.append(compressor.flush())
+    return "".join(output)
+
+
 def printEditor():
     with open(DEFAULT_EDITOR) as f:
         editor = f.read()
@@ -77,6 +389,16 @@ def printEditor():
 
 
 if __name__ == '__main__':
+    import sys
     from wsgiref.simple_server import make_server
+    if '--embedded' in sys.argv[1:]:
+        logging.basicConfig()
+        EMBEDDED = True
+        getEngine()
     http = make_server('', PORT, application)
-    http.serve_forever()
\ No newline at end of file
+    try:
+        http.serve_forever()
+    except KeyboardInterrupt:
+        if ENGINE:
+            import mobwrite_daemon
+            mobwrite_daemon.stop_engine()
\ No newline at end of file
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -
+
+"""Asynchronous MobWrite gateway.
+
+Serves the same requests as gateway.py, but from a single event loop.  Any
+number of browser syncs are multiplexed over a few kept-alive connections to
+the daemon, and a request which the daemon doesn't answer in time is given up
+on without holding up the rest.
+"""
+
+import asynchat
+import asyncore
+import collections
+import logging
+import socket
+import sys
+import time
+import urlparse
+
+import gateway
+
+PORT = gateway.PORT
+# Kept-alive connections to the daemon, shared by all browsers.
+DAEMON_LINKS = 4
+# Seconds a browser may wait on the daemon before its request is abandoned.
+REQUEST_TIMEOUT = gateway.DAEMON_TIMEOUT
+# Seconds a browser connection may sit idle between requests.
+IDLE_TIMEOUT = 30.0
+# Largest request body accepted from a browser.
+MAX_BODY = gateway.MAX_FORM
+# Largest request line and headers accepted from a browser.
+MAX_HEADER = 65536
+
+ERROR = 'ERROR: Cannot reach the mobwrite gateway.'
+TOO_LARGE = 'ERROR: Request too large.'
+
+LOG = logging.getLogger("gateway")
+
+
+class Exchange(object):
+    """One browser request waiting on the daemon."""
+
+    def __init__(self, channel, jsonp, accept_encoding):
+        self.channel = channel
+        self.jsonp = jsonp
+        self.accept_encoding = accept_encoding
+        self.deadline = time.time() + REQUEST_TIMEOUT
+        self.active = True
+
+    def finish(self, response):
+        """Answer the browser with the daemon's response, or with an error if
+        the response is None.  Ignored once cancelled."""
+        if not self.active:
+            return
+        self.active = False
+        try:
+            if response is None:
+                self.channel.respond('text/plain', ERROR)
+            else:
+                encoding = gateway.negotiateEncoding(self.accept_encoding,
+                                                     len(response))
+                response = gateway.encodeResponse(response, self.jsonp,
+                                                  encoding)
+                headers = ["Vary: Accept-Encoding"]
+                if encoding:
+                    headers.append("Content-Encoding: %s" % encoding)
+                self.channel.respond('text/javascript', response, headers)
+        except Exception:
+            # One browser's failure mustn't break the link it shares.
+            LOG.exception("Can't answer browser.")
+            self.channel.close()
+
+    def cancel(self):
+        """The browser has gone; discard the response when it arrives."""
+        self.active = False
+
+
+class DaemonLink(asynchat.async_chat):
+    """A kept-alive connection to the daemon carrying many browsers' requests.
+    Requests are pipelined, and the daemon answers them in order, each
+    response terminated by a blank line."""
+
+    def __init__(self, server):
+        asynchat.async_chat.__init__(self)
+        self.server = server
+        self.pending = collections.deque()
+        self.incoming = []
+        self.lines = []
+        self.set_terminator("\n")
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect(("localhost", gateway.MOBWRITE_PORT))
+        except socket.error:
+            self.close()
+            raise
+
+    def send_request(self, exchange, request):
+        self.pending.append(exchange)
+        self.push(request)
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        line = "".join(self.incoming)
+        self.incoming = []
+        if line:
+            self.lines.append(line + "\n")
+            return
+        # Blank line; the response is complete.
+        response = "".join(self.lines)
+        self.lines = []
+        if not self.pending:
+            LOG.error("Unexpected response from daemon.")
+            self.handle_close()
+            return
+        self.pending.popleft().finish(response)
+
+    def expired(self, now):
+        # Has the oldest request waited too long?
+        return self.pending and self.pending[0].deadline < now
+
+    def handle_connect(self):
+        pass
+
+    def handle_error(self):
+        LOG.error("Daemon connection failed: %s" % sys.exc_info()[1])
+        self.handle_close()
+
+    def handle_close(self):
+        # Fail everything still waiting; later requests get a new link.
+        self.close()
+        if self in self.server.links:
+            self.server.links.remove(self)
+        while self.pending:
+            self.pending.popleft().finish(None)
+
+
+class HttpChannel(asynchat.async_chat):
+    """One browser's HTTP connection.  Requests are answered one at a time;
+    the next isn't parsed until the current one has been answered.  Anything
+    which arrives in the meantime, such as pipelined requests, is kept unread
+    until then."""
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock)
+        self.server = server
+        self.unread = ""
+        self.resuming = False
+        self.incoming = []
+        self.size = 0
+        self.header = None
+        self.keepalive = False
+        self.exchange = None
+        self.refused = False
+        self.lasttime = time.time()
+        self.set_terminator("\r\n\r\n")
+
+    def readable(self):
+        return (self.exchange is None and not self.refused and
+                asynchat.async_chat.readable(self))
+
+    def recv(self, buffer_size):
+        # Hand back what arrived while a request was outstanding first.
+        if self.unread:
+            data = self.unread
+            self.unread = ""
+            return data
+        return asynchat.async_chat.recv(self, buffer_size)
+
+    def collect_incoming_data(self, data):
+        if self.refused:
+            return
+        if self.exchange is not None:
+            # No terminator is set; keep it all for after the response.
+            self.unread += data
+            return
+        self.incoming.append(data)
+        self.size += len(data)
+        if self.header is None and self.size > MAX_HEADER:
+            LOG.warning("Request header too large; disconnecting.")
+            self.refuse("413 Request Entity Too Large", TOO_LARGE)
+
+    def found_terminator(self):
+        if self.refused:
+            return
+        data = "".join(self.incoming)
+        self.incoming = []
+        self.size = 0
+        if self.header is None:
+            self.header = data
+            length = 0
+            for line in data.split("\r\n")[1:]:
+                (name, sep, value) = line.partition(":")
+                if name.strip().lower() == "content-length":
+                    try:
+                        length = int(value)
+                    except ValueError:
+                        length = -1
+            if length < 0:
+                LOG.warning("Bad request body length refused.")
+                self.refuse("400 Bad Request", "ERROR: Bad request.")
+                return
+            if length > MAX_BODY:
+                LOG.warning("Request body of %d bytes refused." % length)
+                self.refuse("413 Request Entity Too Large", TOO_LARGE)
+                return
+            if length:
+                self.set_terminator(length)
+                return
+            data = ""
+        self.handle_request(self.header, data)
+
+    def handle_request(self, header, body):
+        lines = header.split("\r\n")
+        try:
+            (method, path, version) = lines[0].split()
+        except ValueError:
+            self.close()
+            return
+        headers = {}
+        for line in lines[1:]:
+            (name, sep, value) = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            self.keepalive = connection != "close"
+        else:
+            self.keepalive = connection == "keep-alive"
+
+        query = urlparse.urlsplit(path).query
+        if query == 'editor':
+            self.respond('text/html', gateway.printEditor())
+            return
+        # Form fields may be in the query string or a url-encoded body.
+        if method == 'POST' and body:
+            if query:
+                query = body + '&' + query
+            else:
+                query = body
+        (field, out_string) = gateway.decodeCommands(query)
+        self.exchange = Exchange(self, field == 'p',
+                                 headers.get("accept-encoding", ""))
+        # Stop parsing until this request has been answered.
+        self.set_terminator(None)
+        request = gateway.keepAliveRequest(out_string)
+        if request is None:
+            # Truncated request; the daemon would give up on it.
+            self.exchange.finish("")
+        else:
+            self.server.submit(self.exchange, request)
+
+    def refuse(self, status, data):
+        """Answer a request which won't be read with an error, and hang up."""
+        self.refused = True
+        self.incoming = []
+        self.keepalive = False
+        self.respond('text/plain', data, status=status)
+
+    def respond(self, content_type, data, headers=(), status="200 OK"):
+        header = ["HTTP/1.1 %s" % status,
+                  "Content-Type: %s" % content_type,
+                  "Content-Length: %d" % len(data)]
+        header.extend(headers)
+        if not self.keepalive:
+            header.append("Connection: close")
+        elif not self.header.split("\r\n")[0].endswith("HTTP/1.1"):
+            header.append("Connection: keep-alive")
+        self.push("\r\n".join(header) + "\r\n\r\n" + data)
+        self.exchange = None
+        self.header = None
+        self.lasttime = time.time()
+        self.set_terminator("\r\n\r\n")
+        if not self.keepalive:
+            self.unread = ""
+            self.close_when_done()
+        else:
+            self.resume()
+
+    def resume(self):
+        # Parse the requests which arrived while the last was outstanding, up
+        # to the next which has to wait for the daemon.  Responses given along
+        # the way return to this loop rather than recursing.
+        if self.resuming:
+            return
+        self.resuming = True
+        try:
+            while self.unread and self.exchange is None and self.connected:
+                self.handle_read()
+        finally:
+            self.resuming = False
+
+    def expired(self, now):
+        # Has the connection sat idle too long between requests?
+        return self.exchange is None and self.lasttime + IDLE_TIMEOUT < now
+
+    def handle_error(self):
+        LOG.warning("Browser connection failed: %s" % sys.exc_info()[1])
+        self.handle_close()
+
+    def handle_close(self):
+        if self.exchange:
+            self.exchange.cancel()
+            self.exchange = None
+        self.close()
+
+
+class GatewayServer(asyncore.dispatcher):
+    """Accepts browser connections, and shares the daemon links among them."""
+
+    def __init__(self, address):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(socket.SOMAXCONN)
+        self.links = []
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair is None:
+            return
+        HttpChannel(pair[0], self)
+
+    def submit(self, exchange, request):
+        # Send the request down the least busy link, opening more as needed.
+        if len(self.links) < DAEMON_LINKS:
+            try:
+                self.links.append(DaemonLink(self))
+            except socket.error, e:
+                LOG.error("Can't connect to daemon: %s" % e)
+        if not self.links:
+            exchange.finish(None)
+            return
+        link = min(self.links, key=lambda link: len(link.pending))
+        link.send_request(exchange, request)
+
+    def expire(self):
+        # Give up on links whose daemon is stuck, and on idle browsers.
+        now = time.time()
+        for link in list(self.links):
+            if link.expired(now):
+                LOG.warning("Daemon timed out with %d requests waiting." %
+                            len(link.pending))
+                link.handle_close()
+        for channel in asyncore.socket_map.values():
+            if isinstance(channel, HttpChannel) and channel.expired(now):
+                channel.close()
+
+    def serve_forever(self):
+        # Poll rather than select, which is limited to 1024 connections.
+        last_expire = time.time()
+        while True:
+            asyncore.loop(timeout=0.5, use_poll=True, count=1)
+            if time.time() - last_expire >= 0.5:
+                self.expire()
+                last_expire = time.time()
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    http = GatewayServer(('', PORT))
+    try:
+        http.serve_forever()
+    except KeyboardInterrupt:
+        pass
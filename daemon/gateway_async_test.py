@@ -0,0 +1,208 @@
+#!/usr/bin/python2.4
+
+"""Test harness for gateway_async.py
+
+Copyright 2009 Google Inc.
+http://code.google.com/p/google-mobwrite/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncore
+import socket
+import unittest
+import logging
+import gateway
+import gateway_async
+# Force a module reload so to make debugging easier (at least in PythonWin).
+reload(gateway_async)
+
+class GatewayAsyncTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.basicConfig()
+    gateway_async.LOG.setLevel(logging.CRITICAL)
+    self.saved = (gateway.MOBWRITE_PORT, gateway_async.DAEMON_LINKS,
+                  gateway_async.REQUEST_TIMEOUT, gateway_async.MAX_HEADER)
+    # A fake daemon, whose side of each link is read and written by hand.
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.bind(("localhost", 0))
+    self.listener.listen(5)
+    self.listener.setblocking(0)
+    gateway.MOBWRITE_PORT = self.listener.getsockname()[1]
+    # Every request goes down one link, pipelined.
+    gateway_async.DAEMON_LINKS = 1
+    self.server = gateway_async.GatewayServer(("localhost", 0))
+    self.daemon = None
+    # Data read by each browser after the response it was waiting for.
+    self.unread = {}
+
+  def tearDown(self):
+    asyncore.close_all()
+    if self.daemon:
+      self.daemon.close()
+    self.listener.close()
+    (gateway.MOBWRITE_PORT, gateway_async.DAEMON_LINKS,
+     gateway_async.REQUEST_TIMEOUT, gateway_async.MAX_HEADER) = self.saved
+
+  def pump(self):
+    asyncore.loop(timeout=0.01, count=1)
+
+  def browser(self):
+    # Connect a browser to the gateway.
+    (client, server) = socket.socketpair()
+    gateway_async.HttpChannel(server, self.server)
+    client.setblocking(0)
+    return client
+
+  def sync(self, client, commands):
+    client.sendall("GET /?q=%s HTTP/1.1\r\nHost: localhost\r\n\r\n" %
+                   commands.replace("\n", "%0A"))
+
+  def receive(self, client):
+    # Pump the event loop until the browser has a whole response.
+    # Returns the status line and the body.
+    data = self.unread.pop(client, "")
+    for x in xrange(200):
+      (header, sep, body) = data.partition("\r\n\r\n")
+      if sep:
+        for line in header.split("\r\n"):
+          if line.lower().startswith("content-length:"):
+            length = int(line.split(":")[1])
+            if len(body) >= length:
+              # Keep any later response for the next call.
+              self.unread[client] = body[length:]
+              return (header.split("\r\n")[0], body[:length])
+      self.pump()
+      try:
+        data += client.recv(65536)
+      except socket.error:
+        pass
+    self.fail("No response: %r" % data)
+
+  def daemonRead(self):
+    # Pump the event loop until the daemon has been sent another request.
+    data = ""
+    for x in xrange(200):
+      self.pump()
+      try:
+        if self.daemon is None:
+          (self.daemon, address) = self.listener.accept()
+          self.daemon.setblocking(0)
+        data += self.daemon.recv(65536)
+      except socket.error:
+        pass
+      if data.endswith("\n\n"):
+        return data
+    self.fail("Daemon was sent %r" % data)
+
+  def testPipelined(self):
+    # Responses on one link reach the browsers in the order they asked.
+    first = self.browser()
+    second = self.browser()
+    self.sync(first, "u:a\nf:0:one\nR:0:1\n\n")
+    self.assertEquals("k:1\nu:a\nf:0:one\nR:0:1\n\n", self.daemonRead())
+    self.sync(second, "u:b\nf:0:two\nR:0:2\n\n")
+    self.assertEquals("k:1\nu:b\nf:0:two\nR:0:2\n\n", self.daemonRead())
+    self.assertEquals(1, len(self.server.links))
+    self.assertEquals(2, len(self.server.links[0].pending))
+    self.daemon.sendall("F:0:one\nD:0:=1\n\nF:0:two\nD:0:=1\n\n")
+    self.assertEquals(("HTTP/1.1 200 OK", "F:0:one\nD:0:=1\n"),
+                      self.receive(first))
+    self.assertEquals(("HTTP/1.1 200 OK", "F:0:two\nD:0:=1\n"),
+                      self.receive(second))
+
+  def testPipelinedRequests(self):
+    # Requests sent together by one browser are answered one at a time.
+    client = self.browser()
+    self.sync(client, "u:a\nf:0:one\nR:0:1\n\n")
+    client.sendall("POST / HTTP/1.1\r\nContent-Length: 18\r\n\r\n" +
+                   "q=u:a%0Af:0:two%0A")
+    self.sync(client, "u:a\nf:0:three\nR:0:3\n\n")
+    self.assertEquals("k:1\nu:a\nf:0:one\nR:0:1\n\n", self.daemonRead())
+    for x in xrange(5):
+      self.pump()
+    self.assertEquals(1, len(self.server.links[0].pending))
+    self.daemon.sendall("F:0:one\nD:0:=1\n\n")
+    self.assertEquals(("HTTP/1.1 200 OK", "F:0:one\nD:0:=1\n"),
+                      self.receive(client))
+    # The second is truncated, so is answered without asking the daemon.
+    self.assertEquals(("HTTP/1.1 200 OK", ""), self.receive(client))
+    self.assertEquals("k:1\nu:a\nf:0:three\nR:0:3\n\n", self.daemonRead())
+    self.daemon.sendall("F:0:three\nD:0:=1\n\n")
+    self.assertEquals(("HTTP/1.1 200 OK", "F:0:three\nD:0:=1\n"),
+                      self.receive(client))
+
+  def testTimeout(self):
+    # A link whose daemon is stuck is dropped, failing its requests.
+    gateway_async.REQUEST_TIMEOUT = 0
+    first = self.browser()
+    second = self.browser()
+    self.sync(first, "u:a\nf:0:one\nR:0:1\n\n")
+    self.daemonRead()
+    self.sync(second, "u:b\nf:0:two\nR:0:2\n\n")
+    self.daemonRead()
+    self.server.expire()
+    self.assertEquals([], self.server.links)
+    self.assertEquals(("HTTP/1.1 200 OK", gateway_async.ERROR),
+                      self.receive(first))
+    self.assertEquals(("HTTP/1.1 200 OK", gateway_async.ERROR),
+                      self.receive(second))
+
+  def testCancelled(self):
+    # A browser which hangs up has its response discarded, not misdelivered.
+    first = self.browser()
+    second = self.browser()
+    self.sync(first, "u:a\nf:0:one\nR:0:1\n\n")
+    self.daemonRead()
+    self.sync(second, "u:b\nf:0:two\nR:0:2\n\n")
+    self.daemonRead()
+    first.close()
+    for x in xrange(5):
+      self.pump()
+    self.daemon.sendall("F:0:one\nD:0:=1\n\nF:0:two\nD:0:=1\n\n")
+    self.assertEquals(("HTTP/1.1 200 OK", "F:0:two\nD:0:=1\n"),
+                      self.receive(second))
+    self.assertEquals(0, len(self.server.links[0].pending))
+
+  def testFinishFails(self):
+    # A browser which can't be answered doesn't break the daemon link.
+    class BrokenChannel(object):
+      closed = False
+      def respond(self, *args):
+        raise AttributeError("respond")
+      def close(self):
+        self.closed = True
+    channel = BrokenChannel()
+    gateway_async.Exchange(channel, False, "").finish("F:0:one\n")
+    self.assertTrue(channel.closed)
+
+  def testTooLarge(self):
+    # Oversized bodies and headers are refused with 413.
+    client = self.browser()
+    client.sendall("POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n" %
+                   (gateway_async.MAX_BODY + 1))
+    self.assertEquals("HTTP/1.1 413 Request Entity Too Large",
+                      self.receive(client)[0])
+    gateway_async.MAX_HEADER = 100
+    client = self.browser()
+    client.sendall("GET / HTTP/1.1\r\nCookie: %s\r\n" % ("x" * 200))
+    self.assertEquals("HTTP/1.1 413 Request Entity Too Large",
+                      self.receive(client)[0])
+    client = self.browser()
+    client.sendall("POST / HTTP/1.1\r\nContent-Length: -5\r\n\r\n")
+    self.assertEquals("HTTP/1.1 400 Bad Request", self.receive(client)[0])
+
+
+if __name__ == "__main__":
+  unittest.main()
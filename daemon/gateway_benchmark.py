@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -
+
+"""Microbenchmark of request decoding in gateway.py: the single-pass
+decoder against cgi.FieldStorage, on typical and large syncs.
+
+Usage:  python gateway_benchmark.py [REPEATS]
+"""
+
+import cgi
+import StringIO
+import sys
+import time
+import urllib
+
+import gateway
+
+
+def fieldStorage(environ):
+    """Decode a request the way the gateway used to."""
+    form = cgi.FieldStorage(fp=environ['wsgi.input'],
+                            environ=environ,
+                            keep_blank_values=1)
+    if form.has_key('q'):
+        return ('q', form['q'].value)
+    elif form.has_key('p'):
+        return ('p', form['p'].value)
+    return (None, "\n")
+
+
+def makeEnviron(method, query, body):
+    return {'REQUEST_METHOD': method,
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO.StringIO(body)}
+
+
+def timeDecoder(decoder, method, query, body, repeats):
+    """Return the mean microseconds per call, and the last result."""
+    environs = [makeEnviron(method, query, body) for x in xrange(repeats)]
+    start = time.time()
+    for environ in environs:
+        result = decoder(environ)
+    return ((time.time() - start) * 1000000 / repeats, result)
+
+
+def main():
+    if len(sys.argv) > 1:
+        repeats = int(sys.argv[1])
+    else:
+        repeats = 2000
+    delta = "u:fred\nf:12:demo_editor_text\nd:11:=1024\t+Hello%20world\t=80\n\n"
+    raw = "u:fred\nf:0:big\nR:0:" + "Lorem%20ipsum%0A" * 6400 + "\n\n"
+    cases = [
+        ("delta, POST q", 'POST', '', 'q=' + urllib.quote(delta)),
+        ("delta, GET p", 'GET', 'p=' + urllib.quote(delta) + '&x=1', ''),
+        ("100KB raw, POST q", 'POST', '', 'q=' + urllib.quote(raw)),
+        ("100KB raw, GET p", 'GET', 'p=' + urllib.quote(raw), ''),
+    ]
+    print "Microseconds per request, mean of %d:" % repeats
+    print "%-20s %12s %12s %8s" % ("request", "FieldStorage", "decoder", "speedup")
+    for (name, method, query, body) in cases:
+        (before, expected) = timeDecoder(fieldStorage, method, query, body,
+                                         repeats)
+        (after, result) = timeDecoder(gateway.readCommands, method, query,
+                                      body, repeats)
+        if result != expected:
+            raise AssertionError("Decoders disagree on %s" % name)
+        print "%-20s %12.1f %12.1f %7.1fx" % (name, before, after,
+                                              before / after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/python2.4
+
+"""Test harness for gateway.py
+
+Copyright 2009 Google Inc.
+http://code.google.com/p/google-mobwrite/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import cgi
+import StringIO
+import unittest
+import zlib
+import gateway
+# Force a module reload so to make debugging easier (at least in PythonWin).
+reload(gateway)
+
+class GatewayTest(unittest.TestCase):
+
+  def environ(self, query, body=None, length=None):
+    # Build the WSGI environment of a GET, or a POST if there is a body.
+    environ = {"QUERY_STRING": query, "REQUEST_METHOD": "GET",
+               "wsgi.input": StringIO.StringIO(body or "")}
+    if body is not None:
+      environ["REQUEST_METHOD"] = "POST"
+      environ["CONTENT_TYPE"] = "application/x-www-form-urlencoded"
+      if length is None:
+        length = len(body)
+      environ["CONTENT_LENGTH"] = str(length)
+    return environ
+
+  def fieldStorage(self, environ):
+    # Read the commands the way the gateway used to, with cgi.FieldStorage.
+    form = cgi.FieldStorage(fp=environ["wsgi.input"], environ=environ,
+                            keep_blank_values=1)
+    for name in ("q", "p"):
+      if form.has_key(name):
+        return (name, form.getfirst(name))
+    return (None, "\n")
+
+  def testDecodeCommands(self):
+    # The single-pass decoder agrees with cgi.FieldStorage.
+    for query in ["q=u:fred%0Af:0:memo%0AR:0:Hello%0A%0A",
+                  "p=u:fred%0A%0A",
+                  "x=1&p=u:paul%0A%0A&q=u:fred%0A%0A",
+                  "q",
+                  "q=",
+                  "x=1;q=u:fred%0A%0A;y=2",
+                  "q=1+1%3D2&q=ignored",
+                  "q=a%2Bb+c",
+                  "x=q%3D1",
+                  ""]:
+      environ = self.environ(query)
+      self.assertEquals(self.fieldStorage(environ),
+                        gateway.decodeCommands(query), query)
+
+  def testReadCommands(self):
+    # A POST body is read ahead of the query string, as by cgi.FieldStorage.
+    for (query, body) in [("", "q=u:fred%0A%0A"),
+                          ("q=query", "q=body"),
+                          ("p=query", "q=body"),
+                          ("q=query", "x=1")]:
+      self.assertEquals(self.fieldStorage(self.environ(query, body)),
+                        gateway.readCommands(self.environ(query, body)))
+    # Only the declared length of the body is read.
+    self.assertEquals(("q", "ab"),
+                      gateway.readCommands(self.environ("", "q=abcd", 4)))
+
+  def testReadLimits(self):
+    saved = gateway.MAX_FORM
+    gateway.MAX_FORM = 10
+    try:
+      self.assertRaises(ValueError, gateway.readCommands,
+                        self.environ("q=" + "x" * 10))
+      self.assertRaises(ValueError, gateway.readCommands,
+                        self.environ("q=x", "q=" + "x" * 8))
+      # A negative length mustn't slip under the limit.
+      self.assertRaises(gateway.BadRequest, gateway.readCommands,
+                        self.environ("", "q=" + "x" * 20, -100))
+      self.assertRaises(gateway.BadRequest, gateway.readCommands,
+                        self.environ("", "q=x", "many"))
+      statuses = []
+      def start_response(status, headers):
+        statuses.append(status)
+      gateway.application(self.environ("q=" + "x" * 10), start_response)
+      gateway.application(self.environ("", "q=x", -1), start_response)
+      self.assertEquals(["413 Request Entity Too Large", "400 Bad Request"],
+                        statuses)
+    finally:
+      gateway.MAX_FORM = saved
+
+  def testNegotiateEncoding(self):
+    size = gateway.COMPRESS_THRESHOLD
+    self.assertEquals("gzip", gateway.negotiateEncoding("gzip, deflate", size))
+    self.assertEquals("deflate", gateway.negotiateEncoding("deflate", size))
+    # Small responses aren't worth compressing.
+    self.assertEquals(None, gateway.negotiateEncoding("gzip", size - 1))
+    self.assertEquals(None, gateway.negotiateEncoding("", size))
+    self.assertEquals(None, gateway.negotiateEncoding("identity, br", size))
+    # The highest q-value wins; ties go to the preferred coding.
+    self.assertEquals("deflate",
+        gateway.negotiateEncoding("gzip;q=0.5, deflate;q=0.8", size))
+    self.assertEquals("gzip",
+        gateway.negotiateEncoding("Deflate;q=0.5, GZIP ; Q=0.5", size))
+    # q=0 refuses a coding, and a bad q-value counts as 0.
+    self.assertEquals("deflate",
+        gateway.negotiateEncoding("gzip;q=0, deflate", size))
+    self.assertEquals(None, gateway.negotiateEncoding("gzip;q=0", size))
+    self.assertEquals(None, gateway.negotiateEncoding("gzip;q=x", size))
+    # '*' covers any coding not named.
+    self.assertEquals("gzip", gateway.negotiateEncoding("*", size))
+    self.assertEquals("deflate",
+        gateway.negotiateEncoding("gzip;q=0, *;q=0.1", size))
+    self.assertEquals(None, gateway.negotiateEncoding("*;q=0", size))
+
+  def testEncodeResponse(self):
+    # JSON-P escapes are unaffected by where the chunks split the text.
+    self.assertEquals('mobwrite.callback("a\\r\\n\\\\\\"b");',
+                      gateway.jsonpCallback('a\r\n\\"b'))
+    saved = gateway.CHUNK_SIZE
+    try:
+      text = 'a\r\n\\"b"\\\nc\r' * 5
+      expected = gateway.jsonpCallback(text)
+      for size in (1, 2, 3, 5):
+        gateway.CHUNK_SIZE = size
+        self.assertEquals(expected, gateway.encodeResponse(text, True, None))
+        self.assertEquals(text, gateway.encodeResponse(text, False, None))
+      self.assertEquals(expected, zlib.decompress(
+          gateway.encodeResponse(text, True, "gzip"), 16 + zlib.MAX_WBITS))
+      self.assertEquals(expected, zlib.decompress(
+          gateway.encodeResponse(text, True, "deflate")))
+    finally:
+      gateway.CHUNK_SIZE = saved
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -26,15 +26,26 @@ from clients.
 
 __author__ = "fraser@google.com (Neil Fraser)"
 
+import asynchat
+import asyncore
+import BaseHTTPServer
+import collections
+import cPickle
 import datetime
 import glob
+import heapq
 import os
+import Queue
+import select
+import signal
 import socket
 import SocketServer
+import struct
 import sys
 import time
 import thread
 import urllib
+import zlib
 
 try:
   # Used by non-Google applications.
@@ -56,21 +67,408 @@ MAX_VIEWS = 10000
 MEMORY = 0
 FILE = 1
 BDB = 2
+JOURNAL = 3
+SQLITE = 4
 STORAGE_MODE = MEMORY
 
+# A request containing this line asks for the connection to stay open after
+# the response, which is then terminated by a blank line.  Further requests
+# may follow on the same connection and are answered in order.
+KEEPALIVE_LINE = "k:1"
+
 # Relative location of the data directory.
 DATA_DIR = ROOT_DIR + "data"
 
-# Dictionary of all text objects.
-texts = {}
+# When documents are sharded across worker processes, the number of shards
+# and the shard owned by this process (None for the router or when unsharded).
+SHARD_COUNT = 0
+SHARD = None
+
+# Number of locks guarding each registry of persistent objects.
+LOCK_STRIPES = 64
+
+# Most files a flush holds open at once while staging them.
+STAGED_FILES = 64
+
+
+class Registry:
+  # A dictionary of persistent objects guarded by striped locks.  Each key
+  # hashes to one of the locks, so operations on different objects rarely
+  # wait on each other.  The stripe lock for a key must be held while that
+  # key is inserted or deleted.
+
+  # Object properties:
+  # .name - Name of the registry for reporting, e.g. 'texts'.
+  # .items - Dictionary of the objects.
+  # .locks - List of the stripe locks.
+  # .acquired - Number of times each stripe lock has been acquired.
+  # .contended - Number of those acquisitions which had to wait.
+
+  def __init__(self, name, stripes=LOCK_STRIPES):
+    self.name = name
+    self.items = {}
+    self.locks = [thread.allocate_lock() for x in xrange(stripes)]
+    self.acquired = [0] * stripes
+    self.contended = [0] * stripes
+
+  def lock(self, key):
+    # Return the stripe lock for the given key.
+    return self.locks[hash(key) % len(self.locks)]
+
+  def acquire(self, key):
+    # Acquire the stripe lock for the given key, counting contention.
+    # Returns the lock, which the caller must release.
+    stripe = hash(key) % len(self.locks)
+    lock = self.locks[stripe]
+    if not lock.acquire(0):
+      lock.acquire()
+      self.contended[stripe] += 1
+    self.acquired[stripe] += 1
+    return lock
+
+  def get(self, key, default=None):
+    return self.items.get(key, default)
+
+  def has_key(self, key):
+    return self.items.has_key(key)
+
+  def values(self):
+    return self.items.values()
+
+  def __getitem__(self, key):
+    return self.items[key]
+
+  def __setitem__(self, key, value):
+    assert self.lock(key).locked(), "Can't insert unless locked."
+    self.items[key] = value
+
+  def __delitem__(self, key):
+    assert self.lock(key).locked(), "Can't delete unless locked."
+    del self.items[key]
+
+  def __len__(self):
+    return len(self.items)
+
+  def stats(self):
+    # Return the total number of lock acquisitions, and how many waited.
+    return (sum(self.acquired), sum(self.contended))
+
+
+class ExpiryQueue:
+  # A min-heap of persistent objects, ordered by when each one is next due
+  # for its cleanup.  The cleanup pass only visits objects which are due.
+  # An object which has been used since it was scheduled reschedules itself
+  # from its cleanup method.
+
+  # Object properties:
+  # .heap - Heap of (due time, sequence number, object).
+  # .sequence - Tie-breaker so that objects themselves are never compared.
+  # .lock - Access control for the heap.
+
+  def __init__(self):
+    self.heap = []
+    self.sequence = 0
+    self.lock = thread.allocate_lock()
+
+  def schedule(self, obj, when):
+    # Arrange for obj.cleanup() to be called once the given time has passed.
+    self.lock.acquire()
+    try:
+      self.sequence += 1
+      heapq.heappush(self.heap, (when, self.sequence, obj))
+    finally:
+      self.lock.release()
+
+  def due(self, now):
+    # Remove and return all objects which are due at the given time.
+    objs = []
+    self.lock.acquire()
+    try:
+      while self.heap and self.heap[0][0] <= now:
+        objs.append(heapq.heappop(self.heap)[2])
+    finally:
+      self.lock.release()
+    return objs
+
+  def __len__(self):
+    return len(self.heap)
+
+
+class ExpiryIndex:
+  # Records when each text in storage was last saved, so that texts which
+  # have not been saved for TIMEOUT_TEXT can be found without scanning the
+  # storage.  In FILE mode the index is persisted in a log file next to the
+  # texts; in BDB mode lasttime_db already persists it.
+
+  # Object properties:
+  # .saved - Dictionary of text names to the time of their last save.
+  # .heap - Heap of (time of save, name), including superseded entries.
+  # .logfile - Open log file persisting the index, or None.
+  # .filename - Path of the log file.
+  # .entries - Number of lines in the log file.
+  # .lock - Access control for the index.
+
+  def __init__(self):
+    self.saved = {}
+    self.heap = []
+    self.logfile = None
+    self.filename = None
+    self.entries = 0
+    self.lock = thread.allocate_lock()
+
+  def load(self, items):
+    # Populate the index from (name, time of save) pairs.
+    for (name, when) in items:
+      if when:
+        self.saved[name] = when
+      elif self.saved.has_key(name):
+        del self.saved[name]
+    self.rebuild()
+
+  def rebuild(self):
+    # Rebuild the heap with only the current entries.
+    self.heap = [(when, name) for (name, when) in self.saved.iteritems()]
+    heapq.heapify(self.heap)
+
+  def open(self, filename, scan):
+    """Load the index from its log file, and keep the log open for appending.
+
+    Args:
+      filename: Path of the log file.
+      scan: Function returning (name, time of save) pairs for every stored
+          text, used once if the log file does not exist yet.
+    """
+    self.filename = filename
+    if os.path.exists(filename):
+      items = []
+      infile = open(filename, "r")
+      try:
+        for line in infile:
+          (when, name) = line.rstrip("\n").split(" ", 1)
+          items.append((urllib.unquote(name), int(when)))
+      finally:
+        infile.close()
+      self.entries = len(items)
+      self.load(items)
+      mobwrite_core.LOG.info("Read expiry index: %d texts" % len(self.saved))
+      self.logfile = open(filename, "a")
+    else:
+      self.load(scan())
+      self.compact()
+      mobwrite_core.LOG.info("Built expiry index: %d texts" % len(self.saved))
+
+  def record(self, name, when):
+    # Append one change to the log file.  Caller must hold the lock.
+    if self.logfile:
+      self.logfile.write("%d %s\n" % (when, urllib.quote(name, "")))
+      self.logfile.flush()
+      self.entries += 1
+      if self.entries > 2 * len(self.saved) + 1000:
+        self.compact()
+
+  def compact(self):
+    # Rewrite the log file with only the current entries.
+    if not self.filename:
+      return
+    if self.logfile:
+      self.logfile.close()
+    tempname = self.filename + ".tmp"
+    outfile = open(tempname, "w")
+    for (name, when) in self.saved.iteritems():
+      outfile.write("%d %s\n" % (when, urllib.quote(name, "")))
+    outfile.close()
+    os.rename(tempname, self.filename)
+    self.entries = len(self.saved)
+    self.logfile = open(self.filename, "a")
+
+  def touch(self, name, when):
+    # The named text was saved at the given time (in seconds).
+    self.lock.acquire()
+    try:
+      self.saved[name] = when
+      heapq.heappush(self.heap, (when, name))
+      if len(self.heap) > 2 * len(self.saved) + 1000:
+        # Mostly superseded entries; start afresh.
+        self.rebuild()
+      self.record(name, when)
+    finally:
+      self.lock.release()
+
+  def forget(self, name):
+    # The named text was removed from storage.
+    self.lock.acquire()
+    try:
+      if self.saved.has_key(name):
+        del self.saved[name]
+        self.record(name, 0)
+    finally:
+      self.lock.release()
+
+  def due(self, cutoff):
+    # Remove and return the names of all texts last saved before the cutoff.
+    names = []
+    self.lock.acquire()
+    try:
+      while self.heap and self.heap[0][0] < cutoff:
+        (when, name) = heapq.heappop(self.heap)
+        if self.saved.get(name) == when:
+          # Not superseded by a later save.
+          del self.saved[name]
+          self.record(name, 0)
+          names.append(name)
+    finally:
+      self.lock.release()
+    return names
+
+  def close(self):
+    if self.logfile:
+      self.logfile.close()
+      self.logfile = None
+
+
+# Objects waiting for their next cleanup.
+expiry = ExpiryQueue()
+
+# Texts in storage waiting to expire.
+stored_index = ExpiryIndex()
+
+# Texts changed since they were last saved, keyed by name.
+dirty = {}
+
+# Lock to prevent simultaneous changes to the dirty dictionary.
+lock_dirty = thread.allocate_lock()
+
+# Registry of all text objects.
+texts = Registry("texts")
+
+class Residency:
+  # Tracks the texts held in memory, least recently used first.  Once they
+  # hold more than the budget, idle texts are evicted to storage.  Sizes are
+  # counted in characters.
+
+  # Object properties:
+  # .budget - Characters which may be resident, or 0 for no limit.
+  # .texts - Ordered dictionary of text names to resident text objects.
+  # .size - Characters held by the resident text objects.
+  # .evictions - Count of texts evicted.
+  # .evicted - Count of characters evicted.
+  # .lock - Access control for the above.
+  # .wanted - Queue holding a token while a trim is wanted.
+
+  def __init__(self):
+    self.budget = 0
+    self.texts = collections.OrderedDict()
+    self.size = 0
+    self.evictions = 0
+    self.evicted = 0
+    self.lock = thread.allocate_lock()
+    self.wanted = Queue.Queue(1)
+
+  def add(self, textobj):
+    # The text object has been registered.
+    self.lock.acquire()
+    try:
+      self.texts[textobj.name] = textobj
+      self.size += textobj.size
+    finally:
+      self.lock.release()
+
+  def touch(self, textobj):
+    # The text object has been used; it is now the most recently used.
+    if not self.budget:
+      return
+    self.lock.acquire()
+    try:
+      if self.texts.get(textobj.name) is textobj:
+        del self.texts[textobj.name]
+        self.texts[textobj.name] = textobj
+    finally:
+      self.lock.release()
+
+  def resize(self, textobj, delta):
+    # The text object's text has changed size.
+    self.lock.acquire()
+    try:
+      if self.texts.get(textobj.name) is textobj:
+        self.size += delta
+    finally:
+      self.lock.release()
+
+  def remove(self, textobj):
+    # The text object has been unregistered.
+    self.lock.acquire()
+    try:
+      if self.texts.get(textobj.name) is textobj:
+        del self.texts[textobj.name]
+        self.size -= textobj.size
+    finally:
+      self.lock.release()
+
+  def request(self):
+    # Ask the residency thread for a trim if over budget.  Evicting writes to
+    # storage, so it is kept out of requests and the locks they hold.
+    if not self.budget or self.size <= self.budget:
+      return
+    try:
+      self.wanted.put_nowait(True)
+    except Queue.Full:
+      pass
+
+  def run(self):
+    # Trim whenever asked, forever.
+    while True:
+      self.wanted.get()
+      try:
+        self.trim()
+      except:
+        mobwrite_core.LOG.exception("Can't trim resident texts.")
+
+  def trim(self):
+    # Evict idle texts, least recently used first, until within budget.
+    if not self.budget or self.size <= self.budget:
+      return
+    self.lock.acquire()
+    try:
+      candidates = self.texts.values()
+    finally:
+      self.lock.release()
+    for textobj in candidates:
+      if self.size <= self.budget:
+        break
+      if textobj.views > 0:
+        continue
+      size = textobj.size
+      if textobj.evict():
+        self.lock.acquire()
+        try:
+          self.evictions += 1
+          self.evicted += size
+        finally:
+          self.lock.release()
+    if self.size > self.budget:
+      mobwrite_core.LOG.warning("Resident texts over budget: %d of %d" %
+                                (self.size, self.budget))
+
+  def stats(self):
+    self.lock.acquire()
+    try:
+      return ("%d texts, %d characters resident; %d texts, %d characters "
+              "evicted" % (len(self.texts), self.size, self.evictions,
+                           self.evicted))
+    finally:
+      self.lock.release()
+
+
+# Texts in memory, for enforcing MAX_RESIDENT_SIZE.
+residency = Residency()
+
+# Number of deltas each text caches for views at the same shadow version.
+DIFF_CACHE_SIZE = 16
 
 # Berkeley Databases
 texts_db = None
 lasttime_db = None
 
-# Lock to prevent simultaneous changes to the texts dictionary.
-lock_texts = thread.allocate_lock()
-
 
 class TextObj(mobwrite_core.TextObj):
   # A persistent object which stores a text.
@@ -79,33 +477,103 @@ class TextObj(mobwrite_core.TextObj):
   # .lock - Access control for writing to the text on this object.
   # .views - Count of views currently connected to this text.
   # .lasttime - The last time that this text was modified.
+  # .size - Length of the text, for the residency budget.
+  # .version - Count of changes to the text.
+  # .snapshots - Dictionary of versions to [text, reference count] for
+  #     earlier or current texts which views still use as shadows.
+  # .deltas - Ordered dictionary of (shadow version, version) to the delta
+  #     between them, least recently used first.
 
   # Inherited properties:
   # .name - The unique name for this text, e.g 'proposal'.
   # .text - The text itself.
   # .changed - Has the text changed since the last time it was saved.
+  __slots__ = ("lock", "views", "lasttime", "size", "version", "snapshots",
+               "deltas")
 
   def __init__(self, *args, **kwargs):
     # Setup this object
     mobwrite_core.TextObj.__init__(self, *args, **kwargs)
     self.views = 0
     self.lasttime = datetime.datetime.now()
+    self.size = 0
+    self.version = 0
+    self.snapshots = {}
+    self.deltas = collections.OrderedDict()
     self.lock = thread.allocate_lock()
+    # Loading may be slow, so this happens without holding the texts lock.
+    # The caller is responsible for registering the new object.
     self.load()
 
-    # lock_texts must be acquired by the caller to prevent simultaneous
-    # creations of the same text.
-    assert lock_texts.locked(), "Can't create TextObj unless locked."
-    global texts
-    texts[self.name] = self
-
   def setText(self, newText):
+    oldText = self.text
     mobwrite_core.TextObj.setText(self, newText)
+    if self.text is not oldText:
+      self.version += 1
     self.lasttime = datetime.datetime.now()
+    size = len(self.text or "")
+    if size != self.size:
+      residency.resize(self, size - self.size)
+      self.size = size
+    if self.changed and STORAGE_MODE != MEMORY:
+      # Queue for saving on the next cleanup pass.
+      lock_dirty.acquire()
+      try:
+        dirty[self.name] = self
+      finally:
+        lock_dirty.release()
+
+  def retain(self, version, text):
+    # Take a reference to the snapshot of the given version, creating it
+    # from the text if needed.  Return the snapshot's text.
+    # Lock must be acquired by the caller.
+    assert self.lock.locked(), "Can't retain unless locked."
+    snapshot = self.snapshots.get(version)
+    if snapshot is None:
+      snapshot = self.snapshots[version] = [text, 0]
+    snapshot[1] += 1
+    return snapshot[0]
+
+  def release(self, version):
+    # Drop a reference to the snapshot of the given version.
+    # Lock must be acquired by the caller.
+    assert self.lock.locked(), "Can't release unless locked."
+    snapshot = self.snapshots[version]
+    snapshot[1] -= 1
+    if snapshot[1] == 0:
+      del self.snapshots[version]
+
+  def cachedDelta(self, key):
+    # Return the cached delta between two versions, or None.
+    # Lock must be acquired by the caller.
+    delta = self.deltas.pop(key, None)
+    if delta is not None:
+      self.deltas[key] = delta
+    return delta
+
+  def cacheDelta(self, key, delta):
+    # Cache the delta between two versions, dropping the least recently used
+    # delta if the cache is full.
+    # Lock must be acquired by the caller.
+    self.deltas[key] = delta
+    if len(self.deltas) > DIFF_CACHE_SIZE:
+      self.deltas.popitem(last=False)
+
+  def schedule(self):
+    # Called when the last view detaches.  Arrange for this text to be
+    # expired (in memory) or unloaded (otherwise).
+    if STORAGE_MODE == MEMORY:
+      expiry.schedule(self, self.lasttime + mobwrite_core.TIMEOUT_TEXT)
+    else:
+      expiry.schedule(self, datetime.datetime.now())
 
   def cleanup(self):
     # General cleanup task.
     if self.views > 0:
+      # Will be rescheduled once the last view detaches.
+      return
+    if texts.get(self.name) is not self:
+      # Already unloaded.
       return
     terminate = False
     # Lock must be acquired to prevent simultaneous deletions.
@@ -123,115 +591,974 @@ class TextObj(mobwrite_core.TextObj):
       if terminate:
         # Save to disk/database.
         self.save()
-        # Terminate in-memory copy.
-        global texts
-        lock_texts.acquire()
-        try:
-          try:
-            del texts[self.name]
-          except KeyError:
-            mobwrite_core.LOG.error("Text object not in text list: '%s'" % self)
-        finally:
-          lock_texts.release()
+        self.unload()
       else:
-        if self.changed:
-          self.save()
+        # Check again once this text could have expired.
+        expiry.schedule(self, self.lasttime + mobwrite_core.TIMEOUT_TEXT)
     finally:
       self.lock.release()
 
-  def load(self):
-    # Load the text object from non-volatile storage.
-    if STORAGE_MODE == FILE:
-      # Load the text (if present) from disk.
-      filename = "%s/%s.txt" % (DATA_DIR, urllib.quote(self.name, ""))
-      if os.path.exists(filename):
-        try:
-          infile = open(filename, "r")
-          self.setText(infile.read().decode("utf-8"))
-          infile.close()
-          self.changed = False
-          mobwrite_core.LOG.info("Loaded file: '%s'" % filename)
-        except:
-          mobwrite_core.LOG.critical("Can't read file: %s" % filename)
+  def evict(self):
+    # Unload this text ahead of its time to free memory.  In memory mode the
+    # text is spilled to a file until it is next needed.
+    # Return True if the text was evicted.
+    if texts.get(self.name) is not self:
+      return False
+    self.lock.acquire()
+    try:
+      if self.views > 0:
+        return False
+      if STORAGE_MODE == MEMORY:
+        if self.text is None:
+          # Nullified, so there is nothing to keep.
+          unspill_text(self.name)
+        elif not spill_text(self.name, self.text, self.lasttime):
+          return False
       else:
-        self.setText(None)
-        self.changed = False
+        self.save()
+      if self.unload():
+        mobwrite_core.LOG.info("Evicted text: '%s'" % self)
+        return True
+      if STORAGE_MODE == MEMORY:
+        # Still in use, so the spilled copy would go stale.
+        unspill_text(self.name)
+      return False
+    finally:
+      self.lock.release()
 
-    if STORAGE_MODE == BDB:
-      # Load the text (if present) from database.
-      if texts_db.has_key(self.name):
-        self.setText(texts_db[self.name].decode("utf-8"))
-        mobwrite_core.LOG.info("Loaded from DB: '%s'" % self)
-      else:
-        self.setText(None)
-      self.changed = False
+  def unload(self):
+    # Terminate in-memory copy, unless a view has attached.
+    # Lock must be acquired by the caller.  Return True if unloaded.
+    lock = texts.acquire(self.name)
+    try:
+      if self.views > 0:
+        # A view attached itself while this text was being saved.
+        mobwrite_core.LOG.info("Text reclaimed during unload: '%s'" % self)
+        return False
+      try:
+        del texts[self.name]
+      except KeyError:
+        mobwrite_core.LOG.error("Text object not in text list: '%s'" % self)
+    finally:
+      lock.release()
+    residency.remove(self)
+    return True
 
+  def load(self):
+    # Load the text object from non-volatile storage.
+    if STORAGE_MODE != MEMORY:
+      self.setText(read_text(self.name))
+      self.changed = False
+    elif residency.budget:
+      # Reload a text which was evicted from memory.
+      spilled = unspill_text(self.name)
+      if spilled:
+        (text, self.lasttime) = spilled
+        mobwrite_core.TextObj.setText(self, text)
+        self.size = len(text)
+        self.changed = False
 
   def save(self):
     # Save the text object to non-volatile storage.
     # Lock must be acquired by the caller to prevent simultaneous saves.
     assert self.lock.locked(), "Can't save unless locked."
+    if STORAGE_MODE == MEMORY:
+      return
+    if writer:
+      # Hand the text to the background writer.
+      writer.save(self.name, self.text)
+      self.changed = False
+    elif write_text(self.name, self.text):
+      self.changed = False
+
+
+def text_filename(name):
+  # Path of the file storing the named text in FILE mode.
+  return "%s/%s.txt" % (DATA_DIR, urllib.quote(name, ""))
+
+
+def spill_filename(name):
+  # Path of the file holding the named text while evicted in MEMORY mode.
+  return "%s/%s.spill" % (DATA_DIR, urllib.quote(name, ""))
+
+
+def spill_text(name, text, lasttime):
+  """Write an evicted text to a spill file in MEMORY mode.
+
+  Args:
+    name: The unique name of the text.
+    text: The text.
+    lasttime: The last time that the text was modified.
+
+  Returns:
+    True if the text was written.
+  """
+  filename = spill_filename(name)
+  try:
+    outfile = open(filename, "w")
+    outfile.write((text or "").encode("utf-8"))
+    outfile.close()
+    # The modification time carries the text's own, for expiry and reload.
+    when = time.mktime(lasttime.timetuple())
+    os.utime(filename, (when, when))
+  except (IOError, OSError):
+    mobwrite_core.LOG.critical("Can't spill file: %s" % filename)
+    return False
+  stored_index.touch(name, int(when))
+  return True
+
+
+def unspill_text(name):
+  # Read and remove the named text's spill file, if any.
+  # Return (text, last modified time), or None.
+  filename = spill_filename(name)
+  try:
+    infile = open(filename)
+  except IOError:
+    return None
+  text = infile.read().decode("utf-8")
+  infile.close()
+  lasttime = datetime.datetime.fromtimestamp(os.path.getmtime(filename))
+  os.remove(filename)
+  stored_index.forget(name)
+  mobwrite_core.LOG.info("Loaded spilled file: '%s'" % filename)
+  return (text, lasttime)
+
+
+def clear_spills():
+  # Spill files left by an earlier run of a MEMORY mode daemon are stale.
+  for filename in glob.glob("%s/*.spill" % DATA_DIR):
+    name = urllib.unquote(os.path.basename(filename)[:-6])
+    if SHARD is None or shard_of(name) == SHARD:
+      os.remove(filename)
+
+
+def read_text(name):
+  """Read a text from non-volatile storage.
+
+  Args:
+    name: The unique name of the text.
+
+  Returns:
+    The text, or None if it isn't stored.
+  """
+  if writer:
+    # A write which is still queued is newer than what is in storage.
+    (found, text) = writer.lookup(name)
+    if found:
+      mobwrite_core.LOG.info("Loaded from write queue: '%s'" % name)
+      return text
+
+  if STORAGE_MODE == FILE:
+    # Load the text (if present) from disk.
+    filename = text_filename(name)
+    if os.path.exists(filename):
+      try:
+        infile = open(filename, "r")
+        text = infile.read().decode("utf-8")
+        infile.close()
+        mobwrite_core.LOG.info("Loaded file: '%s'" % filename)
+        return text
+      except:
+        mobwrite_core.LOG.critical("Can't read file: %s" % filename)
+
+  if STORAGE_MODE == BDB:
+    # Load the text (if present) from database.
+    if texts_db.has_key(name):
+      mobwrite_core.LOG.info("Loaded from DB: '%s'" % name)
+      return texts_db[name].decode("utf-8")
+
+  if STORAGE_MODE == JOURNAL:
+    # Load the text (if present) from the replayed journal.
+    text = journal.read(name)
+    if text is not None:
+      mobwrite_core.LOG.info("Loaded from journal: '%s'" % name)
+    return text
+
+  if STORAGE_MODE == SQLITE:
+    # Load the text (if present) from database.
+    text = sqlite_db.read(name)
+    if text is not None:
+      mobwrite_core.LOG.info("Loaded from DB: '%s'" % name)
+    return text
+
+  return None
+
+
+def write_text(name, text):
+  """Write a text to non-volatile storage.
+
+  Args:
+    name: The unique name of the text.
+    text: The text, or None to remove it from storage.
+
+  Returns:
+    True if the text was written.
+  """
+  if STORAGE_MODE == FILE:
+    # Save the text to disk.
+    filename = text_filename(name)
+    if text is None:
+      # Nullified text equates to no file.
+      if os.path.exists(filename):
+        try:
+          os.remove(filename)
+          stored_index.forget(name)
+          mobwrite_core.LOG.info("Nullified file: '%s'" % filename)
+        except:
+          mobwrite_core.LOG.critical("Can't nullify file: %s" % filename)
+    else:
+      try:
+        outfile = open(filename, "w")
+        outfile.write(text.encode("utf-8"))
+        outfile.close()
+        stored_index.touch(name, int(time.time()))
+        mobwrite_core.LOG.info("Saved file: '%s'" % filename)
+      except:
+        mobwrite_core.LOG.critical("Can't save file: %s" % filename)
+        return False
+
+  if STORAGE_MODE == BDB:
+    # Save the text to database.
+    if text is None:
+      if lasttime_db.has_key(name):
+        del lasttime_db[name]
+        stored_index.forget(name)
+      if texts_db.has_key(name):
+        del texts_db[name]
+        mobwrite_core.LOG.info("Nullified from DB: '%s'" % name)
+    else:
+      mobwrite_core.LOG.info("Saved to DB: '%s'" % name)
+      texts_db[name] = text.encode("utf-8")
+      now = int(time.time())
+      lasttime_db[name] = str(now)
+      stored_index.touch(name, now)
+
+  if STORAGE_MODE == JOURNAL:
+    # Append the change to the journal.
+    journal.write(name, text)
+    if text is None:
+      stored_index.forget(name)
+      mobwrite_core.LOG.info("Nullified from journal: '%s'" % name)
+    else:
+      stored_index.touch(name, int(time.time()))
+      mobwrite_core.LOG.info("Saved to journal: '%s'" % name)
+
+  if STORAGE_MODE == SQLITE:
+    # Save the text to database.
+    if sqlite_db.write([(name, text)]):
+      return False
+    if text is None:
+      mobwrite_core.LOG.info("Nullified from DB: '%s'" % name)
+    else:
+      mobwrite_core.LOG.info("Saved to DB: '%s'" % name)
+
+  return True
+
+
+class WriteBehind:
+  # Writes saved texts to storage from a background thread.  Repeated saves
+  # of the same text are merged while they wait, and each flush writes its
+  # whole batch before syncing it to disk in one go.
+
+  # Object properties:
+  # .interval - Seconds between flushes.
+  # .pending - Dictionary of text names to texts waiting to be written.
+  # .flushing - Dictionary of text names to texts being written right now.
+  # .lock - Access control for pending and flushing.
+  # .saves - Number of saves queued.
+  # .merged - Number of saves which replaced one already waiting.
+  # .written - Number of texts written.
+  # .flushes - Number of flushes.
+  # .latency - Duration of the last flush, in seconds.
+  # .max_latency - Longest flush, in seconds.
+  # .total_latency - Time spent flushing, in seconds.
+
+  def __init__(self, interval):
+    self.interval = interval
+    self.pending = {}
+    self.flushing = {}
+    self.lock = thread.allocate_lock()
+    self.saves = 0
+    self.merged = 0
+    self.written = 0
+    self.flushes = 0
+    self.latency = 0.0
+    self.max_latency = 0.0
+    self.total_latency = 0.0
+
+  def save(self, name, text):
+    # Queue a text (None to remove it) for writing.
+    self.lock.acquire()
+    try:
+      if self.pending.has_key(name):
+        self.merged += 1
+      self.pending[name] = text
+      self.saves += 1
+    finally:
+      self.lock.release()
+
+  def lookup(self, name):
+    # Return (True, text) if the named text is waiting to be written,
+    # otherwise (False, None).
+    self.lock.acquire()
+    try:
+      for queue in (self.pending, self.flushing):
+        if queue.has_key(name):
+          return (True, queue[name])
+    finally:
+      self.lock.release()
+    return (False, None)
+
+  def depth(self):
+    # Number of texts waiting to be written.
+    return len(self.pending)
+
+  def flush(self):
+    # Write everything which is waiting.
+    self.lock.acquire()
+    try:
+      self.flushing = self.pending
+      self.pending = {}
+    finally:
+      self.lock.release()
+    if not self.flushing:
+      return
+    starttime = time.time()
+    failed = self.write(self.flushing.items())
+    latency = time.time() - starttime
+    self.lock.acquire()
+    try:
+      for (name, text) in failed:
+        # Try again next time, unless a newer save has arrived.
+        if not self.pending.has_key(name):
+          self.pending[name] = text
+      self.written += len(self.flushing) - len(failed)
+      self.flushing = {}
+      self.flushes += 1
+      self.latency = latency
+      self.max_latency = max(self.max_latency, latency)
+      self.total_latency += latency
+    finally:
+      self.lock.release()
+
+  def write(self, batch):
+    """Write a batch of texts to storage, syncing once for the whole batch.
 
+    Args:
+      batch: List of (name, text) pairs.
+
+    Returns:
+      List of the (name, text) pairs which could not be written.
+    """
+    failed = []
     if STORAGE_MODE == FILE:
-      # Save the text to disk.
-      filename = "%s/%s.txt" % (DATA_DIR, urllib.quote(self.name, ''))
-      if self.text is None:
-        # Nullified text equates to no file.
-        if os.path.exists(filename):
+      # Write the files beside their destinations a few dozen at a time, sync
+      # each lot, then move them into place.
+      renamed = False
+      for start in xrange(0, len(batch), STAGED_FILES):
+        staged = []
+        for (name, text) in batch[start:start + STAGED_FILES]:
+          if text is None:
+            write_text(name, None)
+            continue
+          filename = text_filename(name)
+          outfile = None
+          try:
+            outfile = open(filename + ".tmp", "w")
+            outfile.write(text.encode("utf-8"))
+            outfile.flush()
+            staged.append((name, text, filename, outfile))
+          except:
+            mobwrite_core.LOG.critical("Can't save file: %s" % filename)
+            failed.append((name, text))
+            if outfile is not None:
+              try:
+                outfile.close()
+              except IOError:
+                pass
+        for (name, text, filename, outfile) in staged:
           try:
-            os.remove(filename)
-            mobwrite_core.LOG.info("Nullified file: '%s'" % filename)
+            try:
+              os.fsync(outfile.fileno())
+            finally:
+              outfile.close()
+            os.rename(filename + ".tmp", filename)
+            renamed = True
+            stored_index.touch(name, int(time.time()))
+            mobwrite_core.LOG.info("Saved file: '%s'" % filename)
           except:
-            mobwrite_core.LOG.critical("Can't nullify file: %s" % filename)
+            mobwrite_core.LOG.critical("Can't save file: %s" % filename)
+            failed.append((name, text))
+      if renamed:
+        # Make the renames durable too.
+        try:
+          fd = os.open(DATA_DIR, os.O_RDONLY)
+          try:
+            os.fsync(fd)
+          finally:
+            os.close(fd)
+        except OSError:
+          pass
+
+    if STORAGE_MODE == BDB:
+      for (name, text) in batch:
+        write_text(name, text)
+      texts_db.sync()
+      lasttime_db.sync()
+
+    if STORAGE_MODE == JOURNAL:
+      for (name, text) in batch:
+        write_text(name, text)
+      journal.sync()
+
+    if STORAGE_MODE == SQLITE:
+      failed = sqlite_db.write(batch)
+      if not failed:
+        mobwrite_core.LOG.info("Saved %d texts to DB." % len(batch))
+
+    return failed
+
+  def stats(self):
+    # Return a summary of the writer's activity.
+    if self.flushes:
+      average = self.total_latency / self.flushes
+    else:
+      average = 0.0
+    return ("queue depth %d, %d saves (%d merged), %d written in %d flushes, "
+            "flush latency %.3fs last, %.3fs average, %.3fs max" %
+            (self.depth(), self.saves, self.merged, self.written, self.flushes,
+             self.latency, average, self.max_latency))
+
+  def run(self):
+    # Flush periodically, forever.
+    while True:
+      time.sleep(self.interval)
+      save_dirty()
+      self.flush()
+
+
+# The background writer, if saves are written behind.
+writer = None
+
+
+class JournalShard:
+  # One shard of the journal: an append-only log of changes to its texts,
+  # plus the latest snapshot of all its texts.  Files are numbered by
+  # generation; the snapshot of generation n holds the state reached by
+  # every log before generation n.  Only the whereabouts of each text's
+  # records are held in memory; texts are read back from the files.
+
+  # Object properties:
+  # .prefix - Path prefix of this shard's files.
+  # .generation - Generation of the log being appended to.
+  # .logfile - Open handle on that log.
+  # .size - Size of that log in bytes.
+  # .chains - Dictionary of text names to the records which rebuild each
+  #     text: an S record, then any D records, each located by a tuple of
+  #     (generation, extension, offset).
+  # .times - Dictionary of text names to the time they were last journaled.
+  # .readers - Dictionary of (generation, extension) to open file handles.
+  # .lock - Access control for the log, the dictionaries and the readers.
+
+  def __init__(self, prefix):
+    self.prefix = prefix
+    self.generation = 0
+    self.logfile = None
+    self.size = 0
+    self.chains = {}
+    self.times = {}
+    self.readers = {}
+    self.lock = thread.allocate_lock()
+
+  def filename(self, generation, extension):
+    return "%s_%d.%s" % (self.prefix, generation, extension)
+
+  def generations(self, extension):
+    # Sorted list of the generations of this shard's files with the extension.
+    found = []
+    for filename in glob.glob("%s_*.%s" % (self.prefix, extension)):
+      try:
+        found.append(int(filename[len(self.prefix) + 1:-len(extension) - 1]))
+      except ValueError:
+        pass
+    found.sort()
+    return found
+
+  def replay(self):
+    # Index the latest snapshot and the logs which follow it.
+    snapshots = self.generations("snap")
+    if snapshots:
+      self.generation = snapshots[-1]
+      self.scan(self.generation, "snap")
+    for generation in self.generations("log"):
+      if generation >= self.generation:
+        self.scan(generation, "log")
+        self.generation = generation
+    filename = self.filename(self.generation, "log")
+    self.logfile = open(filename, "a")
+    self.size = self.logfile.tell()
+
+  def scan(self, generation, extension):
+    # Index every record in one file.
+    filename = self.filename(generation, extension)
+    infile = open(filename, "r+")
+    try:
+      good = 0
+      for line in infile:
+        if not line.endswith("\n"):
+          # Torn write from a crash.  Discard it.
+          mobwrite_core.LOG.warning("Truncated journal record in %s" % filename)
+          infile.truncate(good)
+          break
+        self.index(line, (generation, extension, good))
+        good += len(line)
+    finally:
+      infile.close()
+
+  def index(self, line, location):
+    # Note the location of one journal record.
+    (kind, when, name) = line.split("\t", 3)[:3]
+    name = urllib.unquote(name)
+    if kind == "S":
+      self.chains[name] = [location]
+      self.times[name] = int(when)
+    elif kind == "D":
+      if not self.chains.has_key(name):
+        mobwrite_core.LOG.critical("Can't replay journal delta for '%s'" % name)
+        return
+      self.chains[name].append(location)
+      self.times[name] = int(when)
+    elif kind == "N":
+      if self.chains.has_key(name):
+        del self.chains[name]
+        del self.times[name]
+
+  def rebuild(self, chain, readers):
+    """Read a text back from its records.
+
+    Args:
+      chain: List of the locations of the text's records.
+      readers: Dictionary of file handles to read with, which is added to.
+
+    Returns:
+      The text.
+    """
+    text = None
+    for (generation, extension, offset) in chain:
+      infile = readers.get((generation, extension))
+      if infile is None:
+        infile = open(self.filename(generation, extension), "r")
+        readers[(generation, extension)] = infile
+      infile.seek(offset)
+      (kind, when, name, payload) = infile.readline().rstrip("\n").split("\t", 3)
+      if kind == "S":
+        text = urllib.unquote(payload).decode("utf-8")
+        continue
+      try:
+        diffs = mobwrite_core.DMP.diff_fromDelta(text, payload)
+      except ValueError:
+        mobwrite_core.LOG.critical("Can't replay journal delta for '%s'" %
+                                   urllib.unquote(name))
+        continue
+      text = mobwrite_core.DMP.diff_text2(diffs)
+    return text
+
+  def read(self, name):
+    self.lock.acquire()
+    try:
+      chain = self.chains.get(name)
+      if chain is None:
+        return None
+      return self.rebuild(chain, self.readers)
+    finally:
+      self.lock.release()
+
+  def write(self, name, text):
+    """Append the change to one text to the log.
+
+    Args:
+      name: The unique name of the text.
+      text: The new text, or None to remove it.
+
+    Returns:
+      True if the log has grown large enough to be compacted.
+    """
+    when = int(time.time())
+    quoted = urllib.quote(name, "")
+    self.lock.acquire()
+    try:
+      chain = self.chains.get(name)
+      location = (self.generation, "log", self.size)
+      if text is None:
+        if chain is None:
+          return False
+        record = "N\t%d\t%s\t" % (when, quoted)
+        del self.chains[name]
+        del self.times[name]
+      elif (chain is None or chain[0][0] != self.generation or
+            len(chain) >= JOURNAL_CHAIN):
+        # Start a fresh chain, which may not lean on a file that compaction
+        # is about to remove.
+        record = "S\t%d\t%s\t%s" % (when, quoted,
+            urllib.quote(text.encode("utf-8"), "!~*'();/?:@&=+$,# "))
+        self.chains[name] = [location]
+        self.times[name] = when
       else:
+        # Only the edit since the last save is written.
+        base = self.rebuild(chain, self.readers)
+        diffs = mobwrite_core.DMP.diff_main(base, text, False)
+        mobwrite_core.DMP.diff_cleanupEfficiency(diffs)
+        record = "D\t%d\t%s\t%s" % (when, quoted,
+                                      mobwrite_core.DMP.diff_toDelta(diffs))
+        # A new list, so that compaction can tell the text has changed.
+        self.chains[name] = chain + [location]
+        self.times[name] = when
+      record += "\n"
+      self.logfile.write(record)
+      self.logfile.flush()
+      self.size += len(record)
+      return self.size > JOURNAL_COMPACT
+    finally:
+      self.lock.release()
+
+  def sync(self):
+    self.lock.acquire()
+    try:
+      os.fsync(self.logfile.fileno())
+    finally:
+      self.lock.release()
+
+  def compact(self):
+    # Fold the logs into a new snapshot.  Writes carry on into a fresh log
+    # while the snapshot is written.
+    self.lock.acquire()
+    try:
+      self.logfile.close()
+      self.generation += 1
+      generation = self.generation
+      self.logfile = open(self.filename(generation, "log"), "a")
+      self.size = 0
+      chains = self.chains.copy()
+      times = self.times.copy()
+    finally:
+      self.lock.release()
+
+    filename = self.filename(generation, "snap")
+    locations = {}
+    readers = {}
+    outfile = open(filename + ".tmp", "w")
+    try:
+      offset = 0
+      for (name, chain) in chains.iteritems():
+        text = self.rebuild(chain, readers)
+        record = "S\t%d\t%s\t%s\n" % (times[name], urllib.quote(name, ""),
+            urllib.quote(text.encode("utf-8"), "!~*'();/?:@&=+$,# "))
+        outfile.write(record)
+        locations[name] = (generation, "snap", offset)
+        offset += len(record)
+      outfile.flush()
+      os.fsync(outfile.fileno())
+    finally:
+      outfile.close()
+      for infile in readers.values():
+        infile.close()
+    os.rename(filename + ".tmp", filename)
+
+    # Texts not written since now rebuild from the snapshot alone.
+    self.lock.acquire()
+    try:
+      for (name, chain) in chains.iteritems():
+        if self.chains.get(name) is chain:
+          self.chains[name] = [locations[name]]
+      for key in self.readers.keys():
+        if key[0] < generation:
+          self.readers.pop(key).close()
+    finally:
+      self.lock.release()
+
+    # The new snapshot supersedes all older files.
+    for extension in ("snap", "log"):
+      for old in self.generations(extension):
+        if old < generation:
+          os.remove(self.filename(old, extension))
+    mobwrite_core.LOG.info("Compacted journal: %s (%d texts)" %
+                           (filename, len(chains)))
+
+  def close(self):
+    self.lock.acquire()
+    try:
+      self.logfile.close()
+      for infile in self.readers.values():
+        infile.close()
+      self.readers = {}
+    finally:
+      self.lock.release()
+
+
+class Journal:
+  # Stores texts in JOURNAL mode.  Texts are spread by name across several
+  # shards, each with its own log, so that saves of different texts rarely
+  # contend.  Logs are compacted into snapshots by a background thread.
+
+  # Object properties:
+  # .shards - List of JournalShard objects.
+  # .compact_wanted - Dictionary of shards whose logs have grown too large.
+
+  def __init__(self, prefix, count):
+    self.shards = [JournalShard("%s_%d" % (prefix, x)) for x in xrange(count)]
+    self.compact_wanted = {}
+
+  def open(self):
+    for shard in self.shards:
+      shard.replay()
+    mobwrite_core.LOG.info("Replayed journal: %d texts" %
+                           sum([len(shard.chains) for shard in self.shards]))
+
+  def shard(self, name):
+    return self.shards[(zlib.crc32(name) & 0xffffffff) % len(self.shards)]
+
+  def read(self, name):
+    return self.shard(name).read(name)
+
+  def write(self, name, text):
+    shard = self.shard(name)
+    if shard.write(name, text):
+      self.compact_wanted[shard] = True
+
+  def times(self):
+    # Return (name, time last journaled) for every text.
+    items = []
+    for shard in self.shards:
+      items.extend(shard.times.items())
+    return items
+
+  def sync(self):
+    for shard in self.shards:
+      shard.sync()
+
+  def run(self):
+    # Compact logs which have grown too large, forever.
+    while True:
+      time.sleep(1)
+      for shard in self.compact_wanted.keys():
+        del self.compact_wanted[shard]
         try:
-          outfile = open(filename, "w")
-          outfile.write(self.text.encode("utf-8"))
-          outfile.close()
-          self.changed = False
-          mobwrite_core.LOG.info("Saved file: '%s'" % filename)
+          shard.compact()
         except:
-          mobwrite_core.LOG.critical("Can't save file: %s" % filename)
+          mobwrite_core.LOG.exception("Can't compact journal.")
 
-    if STORAGE_MODE == BDB:
-      # Save the text to database.
-      if self.text is None:
-        if lasttime_db.has_key(self.name):
-          del lasttime_db[self.name]
-        if texts_db.has_key(self.name):
-          del texts_db[self.name]
-          mobwrite_core.LOG.info("Nullified from DB: '%s'" % self)
+  def close(self):
+    for shard in self.shards:
+      shard.close()
+
+
+# Size in bytes at which a journal log is compacted into a snapshot.
+JOURNAL_COMPACT = 4 * 1024 * 1024
+# Most records to rebuild a text from; a longer chain is restarted by saving
+# the whole text.
+JOURNAL_CHAIN = 16
+
+# The journal, in JOURNAL mode.
+journal = None
+
+
+class SqliteStore:
+  # Stores texts in SQLITE mode, in one table indexed on the time each text
+  # was last saved.  Saves from one write-behind flush share one transaction.
+
+  # Object properties:
+  # .db - Connection to the database.
+  # .lock - Access control for the connection, which all threads share.
+
+  def __init__(self, filename):
+    import sqlite3
+    # Transactions are begun and committed explicitly.
+    self.db = sqlite3.connect(filename, check_same_thread=False,
+                              isolation_level=None)
+    self.db.text_factory = str
+    self.lock = thread.allocate_lock()
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.execute("CREATE TABLE IF NOT EXISTS texts "
+                    "(name TEXT PRIMARY KEY, text TEXT, lasttime INTEGER)")
+    self.db.execute("CREATE INDEX IF NOT EXISTS texts_lasttime "
+                    "ON texts (lasttime)")
+
+  def read(self, name):
+    self.lock.acquire()
+    try:
+      row = self.db.execute("SELECT text FROM texts WHERE name = ?",
+                            (name,)).fetchone()
+    finally:
+      self.lock.release()
+    if row is None:
+      return None
+    return row[0].decode("utf-8")
+
+  def write(self, batch):
+    """Write a batch of texts in a single transaction.
+
+    Args:
+      batch: List of (name, text) pairs.  A text of None removes it.
+
+    Returns:
+      List of the (name, text) pairs which could not be written.
+    """
+    now = int(time.time())
+    saves = []
+    removes = []
+    for (name, text) in batch:
+      if text is None:
+        removes.append((name,))
       else:
-        mobwrite_core.LOG.info("Saved to DB: '%s'" % self)
-        texts_db[self.name] = self.text.encode("utf-8")
-        lasttime_db[self.name] = str(int(time.time()))
-      self.changed = False
+        saves.append((name, text.encode("utf-8"), now))
+    self.lock.acquire()
+    try:
+      try:
+        self.db.execute("BEGIN")
+        self.db.executemany("INSERT OR REPLACE INTO texts "
+                            "(name, text, lasttime) VALUES (?, ?, ?)", saves)
+        self.db.executemany("DELETE FROM texts WHERE name = ?", removes)
+        self.db.execute("COMMIT")
+      except:
+        mobwrite_core.LOG.exception("Can't save to database.")
+        try:
+          self.db.execute("ROLLBACK")
+        except:
+          # BEGIN itself failed, so there is no transaction to roll back.
+          pass
+        return batch
+    finally:
+      self.lock.release()
+    return []
+
+  def load(self, rows):
+    # Bulk load (name, text, lasttime) rows, such as those of an older
+    # storage mode.  Return the number of rows loaded.
+    rows = [(name, text.encode("utf-8"), lasttime)
+            for (name, text, lasttime) in rows]
+    self.lock.acquire()
+    try:
+      self.db.execute("BEGIN")
+      self.db.executemany("INSERT OR IGNORE INTO texts "
+                          "(name, text, lasttime) VALUES (?, ?, ?)", rows)
+      self.db.execute("COMMIT")
+    finally:
+      self.lock.release()
+    return len(rows)
+
+  def empty(self):
+    self.lock.acquire()
+    try:
+      return self.db.execute("SELECT 1 FROM texts LIMIT 1").fetchone() is None
+    finally:
+      self.lock.release()
+
+  def expire(self, cutoff):
+    # Delete every text last saved before the cutoff time.
+    # Return the names deleted.
+    self.lock.acquire()
+    try:
+      self.db.execute("BEGIN")
+      names = [row[0] for row in self.db.execute(
+          "SELECT name FROM texts WHERE lasttime < ?", (cutoff,))]
+      self.db.execute("DELETE FROM texts WHERE lasttime < ?", (cutoff,))
+      self.db.execute("COMMIT")
+    finally:
+      self.lock.release()
+    return names
+
+  def close(self):
+    self.lock.acquire()
+    try:
+      self.db.close()
+    finally:
+      self.lock.release()
+
+
+# The database, in SQLITE mode.
+sqlite_db = None
+
+
+class LoadFuture:
+  # A text being loaded from storage by one thread, which other threads
+  # wanting the same text can wait on.
+
+  def __init__(self):
+    self.lock = thread.allocate_lock()
+    self.lock.acquire()
+
+  def wait(self):
+    # Block until the load is finished.
+    self.lock.acquire()
+    self.lock.release()
+
+  def done(self):
+    self.lock.release()
+
+
+# Dictionary of texts being loaded, guarded by the texts stripe locks.
+loading = {}
 
 
 def fetch_textobj(name, view):
   # Retrieve the named text object.  Create it if it doesn't exist.
   # Add the given view into the text object's list of connected views.
   # Don't let two simultaneous creations happen, or a deletion during a
-  # retrieval.
-  lock_texts.acquire()
+  # retrieval.  Storage is read without holding the texts lock.
+  lock = texts.acquire(name)
   try:
-    if texts.has_key(name):
-      textobj = texts[name]
+    textobj = texts.get(name)
+    if textobj:
+      textobj.views += 1
       mobwrite_core.LOG.debug("Accepted text: '%s'" % name)
+      residency.touch(textobj)
+      return textobj
+    future = loading.get(name)
+    if future:
+      loader = False
     else:
-      textobj = TextObj(name=name)
-      mobwrite_core.LOG.debug("Creating text: '%s'" % name)
+      future = LoadFuture()
+      loading[name] = future
+      loader = True
+  finally:
+    lock.release()
+
+  if not loader:
+    # Another thread is loading this text.  Wait for it, then try again.
+    mobwrite_core.LOG.debug("Waiting on load of text: '%s'" % name)
+    future.wait()
+    return fetch_textobj(name, view)
+
+  try:
+    textobj = TextObj(name=name)
+  except:
+    # Let any waiting threads make their own attempt.
+    lock = texts.acquire(name)
+    try:
+      del loading[name]
+    finally:
+      lock.release()
+    future.done()
+    raise
+  lock = texts.acquire(name)
+  try:
+    texts[name] = textobj
     textobj.views += 1
+    del loading[name]
   finally:
-    lock_texts.release()
+    lock.release()
+  future.done()
+  mobwrite_core.LOG.debug("Creating text: '%s'" % name)
+  residency.add(textobj)
+  # Make room for the new text.
+  residency.request()
   return textobj
 
 
-# Dictionary of all view objects.
-views = {}
-
-# Lock to prevent simultaneous changes to the views dictionary.
-lock_views = thread.allocate_lock()
+# Registry of all view objects.
+views = Registry("views")
 
 class ViewObj(mobwrite_core.ViewObj):
   # A persistent object which contains one user's view of one text.
@@ -239,6 +1566,9 @@ class ViewObj(mobwrite_core.ViewObj):
   # Object properties:
   # .lasttime - The last time that a web connection serviced this object.
   # .textobj - The shared text object being worked on.
+  # .shadow_version - Version of the text object's snapshot which the shadow
+  #     shares, or None if the shadow is a private copy.
+  # .backup_shadow_version - Likewise for the backup shadow.
 
   # Inherited properties:
   # .username - The name for the user, e.g 'fraser'
@@ -252,78 +1582,262 @@ class ViewObj(mobwrite_core.ViewObj):
   # .edit_stack - List of unacknowledged edits sent to the client.
   # .changed - Has the view changed since the last time it was saved.
   # .delta_ok - Did the previous delta match the text length.
+  __slots__ = ("lasttime", "textobj", "shadow_version",
+               "backup_shadow_version")
 
   def __init__(self, *args, **kwargs):
     # Setup this object
     mobwrite_core.ViewObj.__init__(self, *args, **kwargs)
     self.lasttime = datetime.datetime.now()
+    self.edit_stack = kwargs.get("edit_stack", [])
+    self.shadow_version = None
+    self.backup_shadow_version = None
     self.textobj = fetch_textobj(self.filename, self)
 
-    # lock_views must be acquired by the caller to prevent simultaneous
+    # The views lock must be acquired by the caller to prevent simultaneous
     # creations of the same view.
-    assert lock_views.locked(), "Can't create ViewObj unless locked."
-    global views
-    views[(self.username, self.filename)] = self
+    key = (self.username, self.filename)
+    assert views.lock(key).locked(), "Can't create ViewObj unless locked."
+    views[key] = self
+    expiry.schedule(self, self.lasttime + mobwrite_core.TIMEOUT_VIEW)
 
   def cleanup(self):
     # General cleanup task.
     # Delete myself if I've been idle too long.
     # Don't delete during a retrieval.
-    lock_views.acquire()
+    key = (self.username, self.filename)
+    lock = views.acquire(key)
     try:
+      if views.get(key) is not self:
+        # Already deleted.
+        return
       if self.lasttime < datetime.datetime.now() - mobwrite_core.TIMEOUT_VIEW:
         mobwrite_core.LOG.info("Idle out: '%s'" % self)
-        global views
+        del views[key]
+        self.textobj.lock.acquire()
         try:
-          del views[(self.username, self.filename)]
-        except KeyError:
-          mobwrite_core.LOG.error("View object not in view list: '%s'" % self)
-        self.textobj.views -= 1
+          self.setShadow(None, None)
+          self.backupShadow()
+        finally:
+          self.textobj.lock.release()
+        # Detach from the text, under the same lock as attachments.
+        text_lock = texts.acquire(self.filename)
+        try:
+          self.textobj.views -= 1
+          if self.textobj.views == 0:
+            self.textobj.schedule()
+        finally:
+          text_lock.release()
+      else:
+        # Used since this check was scheduled.  Check again once it could
+        # have timed out.
+        expiry.schedule(self, self.lasttime + mobwrite_core.TIMEOUT_VIEW)
     finally:
-      lock_views.release()
+      lock.release()
 
   def nullify(self):
     self.lasttime = datetime.datetime.min
     self.cleanup()
 
+  def setShadow(self, text, version):
+    # Replace the shadow, sharing the text object's snapshot of the given
+    # version.  A version of None keeps the text as a private copy.
+    # Text object lock must be acquired by the caller.
+    if version is not None:
+      text = self.textobj.retain(version, text)
+    if self.shadow_version is not None:
+      self.textobj.release(self.shadow_version)
+    self.shadow = text
+    self.shadow_version = version
+
+  def backupShadow(self):
+    # Copy the shadow to the backup shadow.
+    # Text object lock must be acquired by the caller.
+    if self.shadow_version is not None:
+      self.textobj.retain(self.shadow_version, self.shadow)
+    if self.backup_shadow_version is not None:
+      self.textobj.release(self.backup_shadow_version)
+    self.backup_shadow = self.shadow
+    self.backup_shadow_version = self.shadow_version
+
+  def adoptShadow(self, edited=True):
+    # The shadow and backup shadow have just been replaced with a private
+    # copy of the client's text.  If the client made no edits, carry on
+    # sharing the old snapshot.  Otherwise share the master text if they match.
+    # Text object lock must be acquired by the caller.
+    if not edited and self.shadow_version is not None:
+      self.shadow = self.textobj.snapshots[self.shadow_version][0]
+      self.backupShadow()
+      return
+    shadow = self.shadow
+    self.setShadow(None, None)
+    self.backupShadow()
+    if shadow == self.textobj.text:
+      shadow = self.textobj.text
+      self.setShadow(shadow, self.textobj.version)
+    else:
+      self.setShadow(shadow, None)
+    self.backupShadow()
+
+
+def fetch_viewobj(username, filename):
+  # Retrieve the named view object.  Create it if it doesn't exist.
+  # Don't let two simultaneous creations happen, or a deletion during a
+  # retrieval.
+  key = (username, filename)
+  lock = views.acquire(key)
+  try:
+    viewobj = views.get(key)
+    if viewobj:
+      viewobj.lasttime = datetime.datetime.now()
+      mobwrite_core.LOG.debug("Accepting view: '%s'" % viewobj)
+    else:
+      if MAX_VIEWS != 0 and len(views) > MAX_VIEWS:
+        viewobj = None
+        mobwrite_core.LOG.critical("Overflow: Can't create new view.")
+      else:
+        state = None
+        if view_store:
+          state = view_store.take(key)
+        if state:
+          viewobj = ViewObj(username=username, filename=filename, **state)
+          mobwrite_core.LOG.debug("Restoring view: '%s'" % viewobj)
+        else:
+          viewobj = ViewObj(username=username, filename=filename)
+          mobwrite_core.LOG.debug("Creating view: '%s'" % viewobj)
+  finally:
+    lock.release()
+  return viewobj
+
+
+class ViewStore:
+  # Keeps the state of each view across restarts, so that clients carry on
+  # with deltas instead of a raw resync.  Views are checkpointed to a pickle
+  # file periodically and on shutdown, then restored when next fetched.
+
+  # Object properties:
+  # .filename - Path of the pickle file.
+  # .saved - Dictionary of (username, filename) keys to the state of views
+  #     not yet restored.
+  # .lock - Access control for the saved states.
+
+  # View properties which are saved.
+  FIELDS = ("shadow", "backup_shadow", "shadow_client_version",
+            "shadow_server_version", "backup_shadow_server_version")
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.saved = {}
+    self.lock = thread.allocate_lock()
+
+  def load(self):
+    # Read the states saved by the last run, dropping any too old to use.
+    if not os.path.exists(self.filename):
+      return
+    try:
+      infile = open(self.filename, "rb")
+      try:
+        saved = cPickle.load(infile)
+      finally:
+        infile.close()
+    except:
+      mobwrite_core.LOG.exception("Can't load views: %s" % self.filename)
+      return
+    timeout = datetime.datetime.now() - mobwrite_core.TIMEOUT_VIEW
+    for (key, state) in saved.iteritems():
+      if state["lasttime"] >= timeout:
+        self.saved[key] = state
+    mobwrite_core.LOG.info("Loaded %d views: %s" %
+                           (len(self.saved), self.filename))
+
+  def take(self, key):
+    # Remove and return the saved state of a view (as ViewObj keyword
+    # arguments), or None.
+    self.lock.acquire()
+    try:
+      return self.saved.pop(key, None)
+    finally:
+      self.lock.release()
+
+  def checkpoint(self):
+    # Write the state of every view to disk.
+    # Views are read without locking; a view caught mid-edit fails its next
+    # delta and falls back to a raw resync, as it would without this store.
+    state = {}
+    self.lock.acquire()
+    try:
+      # Views which were saved but have not reconnected yet.
+      timeout = datetime.datetime.now() - mobwrite_core.TIMEOUT_VIEW
+      for (key, saved) in self.saved.items():
+        if saved["lasttime"] < timeout:
+          del self.saved[key]
+        else:
+          state[key] = saved
+    finally:
+      self.lock.release()
+    for viewobj in views.values():
+      saved = {"lasttime": viewobj.lasttime,
+               "edit_stack": list(viewobj.edit_stack)}
+      for field in self.FIELDS:
+        saved[field] = getattr(viewobj, field)
+      state[(viewobj.username, viewobj.filename)] = saved
+
+    try:
+      outfile = open(self.filename + ".tmp", "wb")
+      cPickle.dump(state, outfile, cPickle.HIGHEST_PROTOCOL)
+      outfile.flush()
+      os.fsync(outfile.fileno())
+      outfile.close()
+      os.rename(self.filename + ".tmp", self.filename)
+    except (IOError, OSError):
+      mobwrite_core.LOG.critical("Can't save views: %s" % self.filename)
+      return
+    mobwrite_core.LOG.info("Saved %d views: %s" % (len(state), self.filename))
+
+
+# The store of view states, if views persist across restarts.
+view_store = None
+
+
+# Count of delta syncs; of those which found the text unchanged; of those
+# answered from a text's delta cache; and of those which had to diff.
+sync_stats = {"syncs": 0, "unchanged": 0, "cached": 0, "diffed": 0}
 
-def fetch_viewobj(username, filename):
-  # Retrieve the named view object.  Create it if it doesn't exist.
-  # Don't let two simultaneous creations happen, or a deletion during a
-  # retrieval.
-  lock_views.acquire()
-  try:
-    key = (username, filename)
-    if views.has_key(key):
-      viewobj = views[key]
-      viewobj.lasttime = datetime.datetime.now()
-      mobwrite_core.LOG.debug("Accepting view: '%s'" % viewobj)
-    else:
-      if MAX_VIEWS != 0 and len(views) > MAX_VIEWS:
-        viewobj = None
-        mobwrite_core.LOG.critical("Overflow: Can't create new view.")
-      else:
-        viewobj = ViewObj(username=username, filename=filename)
-        mobwrite_core.LOG.debug("Creating view: '%s'" % viewobj)
-  finally:
-    lock_views.release()
-  return viewobj
+# Lock to prevent simultaneous changes to the sync counts.
+lock_sync_stats = thread.allocate_lock()
 
 
-# Dictionary of all buffer objects.
-buffers = {}
+def acquire_timed(lock):
+  # Acquire a text's lock, recording how long it took in the metrics.
+  if not mobwrite_core.METRICS.enabled:
+    lock.acquire()
+    return
+  if lock.acquire(0):
+    wait = 0.0
+  else:
+    start = time.time()
+    lock.acquire()
+    wait = time.time() - start
+  mobwrite_core.METRICS.observe("lock_wait_seconds", wait)
 
-# Lock to prevent simultaneous changes to the buffers dictionary.
-lock_buffers = thread.allocate_lock()
+# Registry of all buffer objects.
+buffers = Registry("buffers")
 
-class BufferObj:
+class BufferObj(object):
   # A persistent object which assembles large commands from fragments.
 
   # Object properties:
   # .name - The name (and size) of the buffer, e.g. 'alpha:12'
   # .lasttime - The last time that a web connection wrote to this object.
-  # .data - The contents of the buffer.
+  # .slots - List of the fragments, None for those not yet received.
+  # .filled - Count of the slots which have been received.
+  # .bytes - Memory held: the length of the fragments received, plus the
+  #     slots themselves.
   # .lock - Access control for writing to the text on this object.
+  __slots__ = ("name", "lasttime", "slots", "filled", "bytes", "lock")
+
+  # Bytes taken by each slot, received or not.
+  SLOT_BYTES = struct.calcsize("P")
 
   def __init__(self, name, size):
     # Setup this object
@@ -331,58 +1845,168 @@ class BufferObj:
     self.lasttime = datetime.datetime.now()
     self.lock = thread.allocate_lock()
 
-    # Initialize the buffer with a set number of slots.
-    # Null characters form dividers between each slot.
-    array = []
-    for x in xrange(size - 1):
-      array.append("\0")
-    self.data = "".join(array)
+    # Initialize the buffer with a set number of empty slots.
+    self.slots = [None] * size
+    self.filled = 0
+    self.bytes = size * BufferObj.SLOT_BYTES
 
-    # lock_views must be acquired by the caller to prevent simultaneous
-    # creations of the same view.
-    assert lock_buffers.locked(), "Can't create BufferObj unless locked."
-    global buffers
+    # The buffers lock must be acquired by the caller to prevent simultaneous
+    # creations of the same buffer.
+    assert buffers.lock(name).locked(), "Can't create BufferObj unless locked."
     buffers[name] = self
+    expiry.schedule(self, self.lasttime + mobwrite_core.TIMEOUT_BUFFER)
     mobwrite_core.LOG.debug("Buffer initialized to %d slots: %s" % (size, name))
 
   def set(self, n, text):
     # Set the nth slot of this buffer with text.
+    # Return False if the buffer has grown beyond MAX_BUFFER_BYTES.
     assert self.lock.locked(), "Can't edit BufferObj unless locked."
     # n is 1-based.
     n -= 1
-    array = self.data.split("\0")
-    assert 0 <= n < len(array), "Invalid buffer insertion"
-    array[n] = text
-    self.data = "\0".join(array)
+    assert 0 <= n < len(self.slots), "Invalid buffer insertion"
+    old = self.slots[n]
+    if old is None:
+      self.filled += 1
+    else:
+      # A resent fragment.
+      self.bytes -= len(old)
+    self.slots[n] = text
+    self.bytes += len(text)
     mobwrite_core.LOG.debug("Inserted into slot %d of a %d slot buffer: %s" %
-        (n + 1, len(array), self.name))
+        (n + 1, len(self.slots), self.name))
+    return (mobwrite_core.MAX_BUFFER_BYTES == 0 or
+            self.bytes <= mobwrite_core.MAX_BUFFER_BYTES)
 
   def get(self):
     # Fetch the completed text from the buffer.
-    if ("\0" + self.data + "\0").find("\0\0") == -1:
-      text = self.data.replace("\0", "")
-      # Delete this buffer.
-      self.lasttime = datetime.datetime.min
-      self.cleanup()
+    if self.filled == len(self.slots):
+      text = "".join(self.slots)
+      self.discard()
       return text
     # Not complete yet.
     return None
 
+  def discard(self):
+    # Delete this buffer.
+    self.lasttime = datetime.datetime.min
+    self.cleanup()
+
   def cleanup(self):
     # General cleanup task.
     # Delete myself if I've been idle too long.
     # Don't delete during a retrieval.
-    lock_buffers.acquire()
+    lock = buffers.acquire(self.name)
     try:
+      if buffers.get(self.name) is not self:
+        # Already deleted.
+        return
       if self.lasttime < datetime.datetime.now() - mobwrite_core.TIMEOUT_BUFFER:
         mobwrite_core.LOG.info("Expired buffer: '%s'" % self.name)
-        global buffers
         del buffers[self.name]
+      else:
+        expiry.schedule(self, self.lasttime + mobwrite_core.TIMEOUT_BUFFER)
     finally:
-      lock_buffers.release()
+      lock.release()
+
+
+class ActionBatch:
+  # The runs of one request, which the requesting thread and the action pool
+  # work through together.  Runs on the same text form one group and are
+  # executed in order, whichever user's view they are for; different groups
+  # are independent.
+
+  # Object properties:
+  # .engine - The engine which executes each run.
+  # .runs - List of runs of actions.
+  # .groups - List of lists of indices into runs, one list per text.
+  # .responses - Response to each run, in the same order as the runs.
+  # .claimed - Count of groups claimed by a thread.
+  # .unfinished - Count of groups not yet finished.
+  # .error - Exception info from the first group which failed.
+  # .lock - Access control for claiming and finishing groups.
+  # .finished - Lock which is held until every group is finished.
+
+  def __init__(self, engine, runs, groups):
+    self.engine = engine
+    self.runs = runs
+    self.groups = groups
+    self.responses = [""] * len(runs)
+    self.claimed = 0
+    self.unfinished = len(groups)
+    self.error = None
+    self.lock = thread.allocate_lock()
+    self.finished = thread.allocate_lock()
+    self.finished.acquire()
+
+  def work(self):
+    # Claim and execute groups until none are left unclaimed.
+    while True:
+      self.lock.acquire()
+      try:
+        if self.claimed == len(self.groups):
+          return
+        group = self.groups[self.claimed]
+        self.claimed += 1
+      finally:
+        self.lock.release()
+      error = None
+      try:
+        for x in group:
+          self.responses[x] = self.engine.runActions(self.runs[x])
+      except:
+        error = sys.exc_info()
+      self.lock.acquire()
+      try:
+        if error and not self.error:
+          self.error = error
+        self.unfinished -= 1
+        if not self.unfinished:
+          self.finished.release()
+      finally:
+        self.lock.release()
+
+  def wait(self):
+    # Block until every group is finished, then raise any failure.
+    self.finished.acquire()
+    if self.error:
+      raise self.error[0], self.error[1], self.error[2]
+
+
+class ActionPool:
+  # Threads which help execute the independent groups of requests which
+  # cover several views, so that one large document doesn't hold up the
+  # others in the same request.
+
+  # Object properties:
+  # .count - Number of helper threads.
+  # .batches - Queue of batches with groups waiting for a helper.
+
+  def __init__(self, count):
+    self.count = count
+    self.batches = Queue.Queue()
+    for x in xrange(count):
+      thread.start_new_thread(self.worker, ())
+
+  def run(self, batch):
+    # Offer the batch to the helpers, and work on it in this thread too, so
+    # that it finishes even if every helper is busy.
+    for x in xrange(min(len(batch.groups) - 1, self.count)):
+      self.batches.put(batch)
+    batch.work()
+    batch.wait()
 
+  def worker(self):
+    # Help with batches, forever.
+    while True:
+      self.batches.get().work()
 
-class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
+
+# The helper threads for multi-view requests, if enabled.
+action_pool = None
+
+
+class DaemonEngine(mobwrite_core.MobWrite):
+  # The synchronization engine, independent of how requests arrive.
 
   def feedBuffer(self, name, size, index, datum):
     """Add one block of text to the buffer and return the whole text if the
@@ -402,6 +2026,14 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
     if not 0 < index <= size:
       mobwrite_core.LOG.error("Invalid buffer: '%s %d %d'" % (name, size, index))
       text = ""
+    elif ((mobwrite_core.MAX_BUFFER_SLOTS != 0 and
+           size > mobwrite_core.MAX_BUFFER_SLOTS) or
+          (mobwrite_core.MAX_BUFFER_BYTES != 0 and
+           size * BufferObj.SLOT_BYTES > mobwrite_core.MAX_BUFFER_BYTES)):
+      # Too many slots to hold, or to ever fill within the limit.
+      mobwrite_core.LOG.error("Oversized buffer: '%s %d %d'" %
+                              (name, size, index))
+      text = ""
     elif size == 1 and index == 1:
       # A buffer with one slot?  Pointless.
       text = datum
@@ -411,22 +2043,27 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
       name += "_%d" % size
       # Don't let two simultaneous creations happen, or a deletion during a
       # retrieval.
-      lock_buffers.acquire()
+      lock = buffers.acquire(name)
       try:
-        if buffers.has_key(name):
-          bufferobj = buffers[name]
+        bufferobj = buffers.get(name)
+        if bufferobj:
           bufferobj.lasttime = datetime.datetime.now()
           mobwrite_core.LOG.debug("Found buffer: '%s'" % name)
         else:
           bufferobj = BufferObj(name, size)
           mobwrite_core.LOG.debug("Creating buffer: '%s'" % name)
       finally:
-        lock_buffers.release()
+        lock.release()
       bufferobj.lock.acquire()
       try:
-        bufferobj.set(index, datum)
-        # Check if Buffer is complete.
-        text = bufferobj.get()
+        if bufferobj.set(index, datum):
+          # Check if Buffer is complete.
+          text = bufferobj.get()
+        else:
+          mobwrite_core.LOG.warning("Discarding buffer over %d bytes: '%s'" %
+                                    (mobwrite_core.MAX_BUFFER_BYTES, name))
+          bufferobj.discard()
+          text = None
       finally:
         bufferobj.lock.release()
       if text is None:
@@ -434,39 +2071,27 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
     return urllib.unquote(text)
 
 
-  def handle(self):
-    timeout_telnet = float(mobwrite_core.CFG.get("TIMEOUT_TELNET", 2.0))
-    self.connection.settimeout(timeout_telnet)
-    connection_origin = mobwrite_core.CFG.get("CONNECTION_ORIGIN", "")
-    if connection_origin and self.client_address[0] != connection_origin:
-      raise("Connection refused from %s (only %s allowed)." %
-          (self.client_address[0], connection_origin))
-    mobwrite_core.LOG.info("Connection accepted from " + self.client_address[0])
-
-    data = []
-    # Read in all the lines.
-    while 1:
-      try:
-        line = self.rfile.readline()
-      except:
-        # Timeout.
-        mobwrite_core.LOG.warning("Timeout on connection")
-        break
-      data.append(line)
-      if not line.rstrip("\r\n"):
-        # Terminate and execute on blank line.
-        self.wfile.write(self.handleRequest("".join(data)))
-        break
-
-    # Goodbye
-    mobwrite_core.LOG.debug("Disconnecting.")
-
-
   def handleRequest(self, text):
     actions = self.parseRequest(text)
     return self.doActions(actions)
 
   def doActions(self, actions):
+    start = time.time()
+    try:
+      if action_pool:
+        runs = split_runs(actions)
+        groups = group_runs(runs)
+        if len(groups) > 1:
+          # Several texts; execute them concurrently.
+          batch = ActionBatch(self, runs, groups)
+          action_pool.run(batch)
+          return join_runs(runs, batch.responses)
+      return self.runActions(actions)
+    finally:
+      mobwrite_core.METRICS.observe("request_seconds", time.time() - start)
+
+  def runActions(self, actions):
+    # Execute the actions one after another.
     output = []
     viewobj = None
     last_username = None
@@ -492,6 +2117,7 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
       if action["mode"] == "null":
         # Nullify the text.
         mobwrite_core.LOG.debug("Nullifying: '%s'" % viewobj)
+        mobwrite_core.METRICS.count("nullified_total")
         textobj.lock.acquire()
         try:
           textobj.setText(None)
@@ -506,7 +2132,13 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
         # Client did not receive the last response.  Roll back the shadow.
         mobwrite_core.LOG.warning("Rollback from shadow %d to backup shadow %d" %
             (viewobj.shadow_server_version, viewobj.backup_shadow_server_version))
-        viewobj.shadow = viewobj.backup_shadow
+        mobwrite_core.METRICS.count("rollbacks_total")
+        textobj.lock.acquire()
+        try:
+          viewobj.setShadow(viewobj.backup_shadow,
+                            viewobj.backup_shadow_version)
+        finally:
+          textobj.lock.release()
         viewobj.shadow_server_version = viewobj.backup_shadow_server_version
         viewobj.edit_stack = []
 
@@ -523,6 +2155,7 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
         # It's a raw text dump.
         data = urllib.unquote(action["data"]).decode("utf-8")
         mobwrite_core.LOG.info("Got %db raw text: '%s'" % (len(data), viewobj))
+        mobwrite_core.METRICS.count("raw_received_total")
         viewobj.delta_ok = True
         # First, update the client's shadow.
         viewobj.shadow = data
@@ -531,34 +2164,39 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
         viewobj.backup_shadow = viewobj.shadow
         viewobj.backup_shadow_server_version = viewobj.shadow_server_version
         viewobj.edit_stack = []
-        if action["force"] or textobj.text is None:
-          # Clobber the server's text.
-          textobj.lock.acquire()
-          try:
+        acquire_timed(textobj.lock)
+        try:
+          if action["force"] or textobj.text is None:
+            # Clobber the server's text.
             if textobj.text != data:
               textobj.setText(data)
               mobwrite_core.LOG.debug("Overwrote content: '%s'" % viewobj)
-          finally:
-            textobj.lock.release()
+          viewobj.adoptShadow()
+        finally:
+          textobj.lock.release()
 
       elif action["mode"] == "delta":
         # It's a delta.
         mobwrite_core.LOG.info("Got '%s' delta: '%s'" % (action["data"], viewobj))
+        mobwrite_core.METRICS.count("deltas_received_total")
         if action["server_version"] != viewobj.shadow_server_version:
           # Can't apply a delta on a mismatched shadow version.
           viewobj.delta_ok = False
           mobwrite_core.LOG.warning("Shadow version mismatch: %d != %d" %
               (action["server_version"], viewobj.shadow_server_version))
+          mobwrite_core.METRICS.count("shadow_mismatches_total")
         elif action["client_version"] > viewobj.shadow_client_version:
           # Client has a version in the future?
           viewobj.delta_ok = False
           mobwrite_core.LOG.warning("Future delta: %d > %d" %
               (action["client_version"], viewobj.shadow_client_version))
+          mobwrite_core.METRICS.count("future_deltas_total")
         elif action["client_version"] < viewobj.shadow_client_version:
           # We've already seen this diff.
           pass
           mobwrite_core.LOG.warning("Repeated delta: %d < %d" %
               (action["client_version"], viewobj.shadow_client_version))
+          mobwrite_core.METRICS.count("repeated_deltas_total")
         else:
           # Expand the delta into a diff using the client shadow.
           try:
@@ -568,12 +2206,19 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
             viewobj.delta_ok = False
             mobwrite_core.LOG.warning("Delta failure, expected %d length: '%s'" %
                 (len(viewobj.shadow), viewobj))
+            mobwrite_core.METRICS.count("delta_failures_total")
           viewobj.shadow_client_version += 1
           if diffs != None:
             # Textobj lock required for read/patch/write cycle.
-            textobj.lock.acquire()
+            acquire_timed(textobj.lock)
             try:
+              start = time.time()
               self.applyPatches(viewobj, diffs, action)
+              mobwrite_core.METRICS.observe("patch_seconds",
+                                            time.time() - start)
+              # A client with nothing to send still has the same shadow.
+              viewobj.adoptShadow(len(diffs) > 1 or (diffs and diffs[0][0] !=
+                  mobwrite_core.DMP.DIFF_EQUAL))
             finally:
               textobj.lock.release()
 
@@ -609,15 +2254,56 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
       output.append("F:%d:%s\n" % (viewobj.shadow_client_version, print_filename))
 
     textobj = viewobj.textobj
-    mastertext = textobj.text
+    # Read the text and its version together.
+    acquire_timed(textobj.lock)
+    try:
+      mastertext = textobj.text
+      version = textobj.version
+      # Views sharing a snapshot of the text share its deltas too.
+      key = (viewobj.shadow_version, version)
+      cached = None
+      if viewobj.shadow_version is not None:
+        cached = textobj.cachedDelta(key)
+    finally:
+      textobj.lock.release()
 
     if viewobj.delta_ok:
       if mastertext is None:
         mastertext = ""
-      # Create the diff between the view's text and the master text.
-      diffs = mobwrite_core.DMP.diff_main(viewobj.shadow, mastertext)
-      mobwrite_core.DMP.diff_cleanupEfficiency(diffs)
-      text = mobwrite_core.DMP.diff_toDelta(diffs)
+      stat = "diffed"
+      if viewobj.shadow_version == version:
+        # The shadow is this very text, so nothing has changed.
+        stat = "unchanged"
+        text = "=%d" % len(mastertext)
+      elif cached is not None:
+        # Another view has already diffed the same versions.
+        stat = "cached"
+        text = cached
+      else:
+        # Create the diff between the view's text and the master text.
+        start = time.time()
+        try:
+          text = mobwrite_core.compute(len(viewobj.shadow) + len(mastertext),
+                                       mobwrite_core.makeDelta, viewobj.shadow,
+                                       mastertext)
+        except mobwrite_core.PoolTimeout:
+          # Too slow to diff; send the whole text as one replacement.
+          text = mobwrite_core.replaceDelta(viewobj.shadow, mastertext)
+          key = None
+        mobwrite_core.METRICS.observe("diff_seconds", time.time() - start)
+        if viewobj.shadow_version is not None and key:
+          textobj.lock.acquire()
+          try:
+            textobj.cacheDelta(key, text)
+          finally:
+            textobj.lock.release()
+      start = time.time()
+      lock_sync_stats.acquire()
+      try:
+        sync_stats["syncs"] += 1
+        sync_stats[stat] += 1
+      finally:
+        lock_sync_stats.release()
       if force:
         # Client sending 'D' means number, no error.
         # Client sending 'R' means number, client error.
@@ -635,6 +2321,8 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
     else:
       # Error; server could not parse client's delta.
       # Send a raw dump of the text.
+      start = time.time()
+      mobwrite_core.METRICS.count("raw_sent_total")
       viewobj.shadow_client_version += 1
       if mastertext is None:
         mastertext = ""
@@ -651,76 +2339,1020 @@ class DaemonMobWrite(SocketServer.StreamRequestHandler, mobwrite_core.MobWrite):
         mobwrite_core.LOG.info("Sent %db raw text: '%s'" %
             (len(text), viewobj))
 
-    viewobj.shadow = mastertext
+    textobj.lock.acquire()
+    try:
+      viewobj.setShadow(mastertext, version)
+    finally:
+      textobj.lock.release()
     viewobj.changed = True
 
     for edit in viewobj.edit_stack:
       output.append(edit[1])
 
-    return "".join(output)
+    output = "".join(output)
+    mobwrite_core.METRICS.observe("serialize_seconds", time.time() - start)
+    return output
+
+
+class DaemonMobWrite(SocketServer.StreamRequestHandler, DaemonEngine):
+  # Services one telnet connection per thread.
+
+  def handle(self):
+    timeout_telnet = float(mobwrite_core.CFG.get("TIMEOUT_TELNET", 2.0))
+    self.connection.settimeout(timeout_telnet)
+    connection_origin = mobwrite_core.CFG.get("CONNECTION_ORIGIN", "")
+    if connection_origin and self.client_address[0] != connection_origin:
+      raise("Connection refused from %s (only %s allowed)." %
+          (self.client_address[0], connection_origin))
+    mobwrite_core.LOG.info("Connection accepted from " + self.client_address[0])
+
+    timeout_keepalive = float(mobwrite_core.CFG.get("TIMEOUT_KEEPALIVE", 60.0))
+    max_request = int(mobwrite_core.CFG.get("MAX_REQUEST_BYTES", 10000000))
+    parser = None
+    size = 0
+    keepalive = False
+    served = False
+    # Parse each line as it arrives.
+    while 1:
+      try:
+        if max_request:
+          # Don't read more of a line than the request may hold.
+          line = self.rfile.readline(max_request - size + 1)
+        else:
+          line = self.rfile.readline()
+      except:
+        # Timeout.
+        if parser or not served:
+          mobwrite_core.LOG.warning("Timeout on connection")
+        else:
+          mobwrite_core.LOG.debug("Idle keep-alive connection expired.")
+        break
+      if not line:
+        if parser:
+          mobwrite_core.LOG.warning("Truncated data: connection closed")
+        # Client closed the connection.
+        break
+      if not parser:
+        self.connection.settimeout(timeout_telnet)
+        parser = mobwrite_core.RequestParser(self)
+        size = 0
+      size += len(line)
+      if max_request and size > max_request:
+        mobwrite_core.LOG.warning("Request over %d bytes; disconnecting." %
+                                  max_request)
+        break
+      line = line.rstrip("\r\n")
+      if line == KEEPALIVE_LINE:
+        keepalive = True
+      elif parser.feed(line):
+        # Terminate and execute on blank line.
+        response = self.doActions(parser.finish())
+        if not keepalive:
+          self.wfile.write(response)
+          break
+        # Terminate the response with a blank line and wait for the next one.
+        self.wfile.write(response + "\n")
+        parser = None
+        keepalive = False
+        served = True
+        self.connection.settimeout(timeout_keepalive)
+
+    # Goodbye
+    mobwrite_core.LOG.debug("Disconnecting.")
+
+
+class EventChannel(asynchat.async_chat):
+  # One telnet connection serviced by the event loop.
+
+  # Object properties:
+  # .server - The EventServer which accepted this connection.
+  # .address - The client's IP address.
+  # .lasttime - The last time that data arrived on this connection.
+  # .line - Fragments of the line currently being received.
+  # .parser - Parser of the request currently being received, if any.
+  # .size - Bytes received of the request currently being received.
+  # .keepalive - Did the request being received ask for keep-alive.
+  # .pending - Queue of (actions, keepalive) requests received but not
+  #     executed.
+  # .busy - Is a request from this connection waiting on a worker.
+  # .busy_keepalive - Did the request waiting on a worker ask for keep-alive.
+  # .served - Has this connection answered a kept-alive request.
+  # .done - Will this connection accept no further requests.
+
+  # Read large raw dumps in big gulps.
+  ac_in_buffer_size = 65536
+
+  def __init__(self, sock, address, server):
+    asynchat.async_chat.__init__(self, sock)
+    self.server = server
+    self.address = address
+    self.lasttime = time.time()
+    self.line = []
+    self.parser = None
+    self.size = 0
+    self.keepalive = False
+    self.pending = collections.deque()
+    self.busy = False
+    self.busy_keepalive = False
+    self.served = False
+    self.done = False
+    self.set_terminator("\n")
+
+  def collect_incoming_data(self, data):
+    if self.done:
+      # Ignore anything which follows the last request.
+      return
+    self.size += len(data)
+    if self.server.max_request and self.size > self.server.max_request:
+      mobwrite_core.LOG.warning("Request over %d bytes; disconnecting." %
+                                self.server.max_request)
+      # Answer nothing further, even requests already handed to a worker.
+      self.done = True
+      self.pending.clear()
+      self.close()
+      return
+    self.line.append(data)
+    self.lasttime = time.time()
+
+  def found_terminator(self):
+    if self.done:
+      return
+    line = "".join(self.line).rstrip("\r")
+    self.line = []
+    # Count the line break too.
+    self.size += 1
+    if not self.parser:
+      self.parser = mobwrite_core.RequestParser(self.server.engine)
+    if line == KEEPALIVE_LINE:
+      self.keepalive = True
+    elif self.parser.feed(line):
+      # Terminate and execute on blank line.
+      self.pending.append((self.parser.finish(), self.keepalive))
+      if not self.keepalive:
+        self.done = True
+      self.parser = None
+      self.size = 0
+      self.keepalive = False
+      self.dispatch()
+
+  def dispatch(self):
+    # Submit the next request, one at a time so that responses stay in order.
+    if not self.busy and self.pending:
+      (actions, self.busy_keepalive) = self.pending.popleft()
+      self.busy = True
+      self.server.submit(self, actions)
+
+  def reply(self, response):
+    # Called on the event loop thread once a worker has finished.
+    if not self.connected:
+      return
+    self.busy = False
+    if self.busy_keepalive:
+      # Terminate the response with a blank line and move on to the next one.
+      self.push(response + "\n")
+      self.served = True
+      if self.pending:
+        self.dispatch()
+      elif self.done:
+        self.close_when_done()
+    else:
+      self.push(response)
+      self.close_when_done()
+
+  def readable(self):
+    return not self.done and asynchat.async_chat.readable(self)
+
+  def handle_close(self):
+    if self.busy or self.pending:
+      # Client stopped sending; still answer what has been received.
+      self.done = True
+      return
+    mobwrite_core.LOG.debug("Disconnecting.")
+    self.close()
+
+
+class EventTrigger(asyncore.file_dispatcher):
+  # Wakes up the event loop when a worker has finished a request.
+
+  def __init__(self, server):
+    (self.read_fd, self.write_fd) = os.pipe()
+    asyncore.file_dispatcher.__init__(self, self.read_fd)
+    self.server = server
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    try:
+      self.recv(4096)
+    except (OSError, socket.error):
+      pass
+    self.server.deliver()
+
+  def pull(self):
+    # Thread-safe; called by workers.
+    os.write(self.write_fd, "x")
+
+
+class EventServer(asyncore.dispatcher):
+  # A non-blocking server which multiplexes all telnet connections on a
+  # single event loop, and hands complete requests to a bounded pool of
+  # worker threads.
+
+  # Object properties:
+  # .engine_class - Class of the engine which executes requests.
+  # .engine - Engine which assembles buffers as requests are parsed.
+  # .requests - Queue of (channel, actions) requests waiting for a worker.
+  # .replies - Queue of (channel, response) replies waiting to be sent.
+  # .trigger - Pipe used to wake the event loop.
+  # .timeout - Seconds a connection may stall before being dropped.
+  # .timeout_keepalive - Seconds a kept-alive connection may sit idle.
+  # .origin - If set, the only address allowed to connect.
+  # .max_request - Size in bytes beyond which a request is refused.
+
+  def __init__(self, address, engine_class, worker_count, queue_size):
+    asyncore.dispatcher.__init__(self)
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind(address)
+    self.listen(socket.SOMAXCONN)
+    self.timeout = float(mobwrite_core.CFG.get("TIMEOUT_TELNET", 2.0))
+    self.timeout_keepalive = float(mobwrite_core.CFG.get("TIMEOUT_KEEPALIVE",
+                                                         60.0))
+    self.origin = mobwrite_core.CFG.get("CONNECTION_ORIGIN", "")
+    self.max_request = int(mobwrite_core.CFG.get("MAX_REQUEST_BYTES",
+                                                 10000000))
+    self.engine_class = engine_class
+    self.engine = engine_class()
+    self.requests = Queue.Queue(queue_size)
+    self.replies = collections.deque()
+    self.trigger = EventTrigger(self)
+    for x in xrange(worker_count):
+      thread.start_new_thread(self.worker, ())
+    mobwrite_core.LOG.info("Started %d worker threads." % worker_count)
+
+  def handle_accept(self):
+    try:
+      pair = self.accept()
+    except socket.error:
+      return
+    if pair is None:
+      return
+    (sock, address) = pair
+    if self.origin and address[0] != self.origin:
+      mobwrite_core.LOG.warning("Connection refused from %s (only %s allowed)." %
+          (address[0], self.origin))
+      sock.close()
+      return
+    mobwrite_core.LOG.info("Connection accepted from " + address[0])
+    EventChannel(sock, address, self)
+
+  def submit(self, channel, actions):
+    # Queue a parsed request for the worker threads.
+    try:
+      self.requests.put_nowait((channel, actions))
+    except Queue.Full:
+      # Overloaded.  Send back nothing.  Pretend the return packet was lost.
+      mobwrite_core.LOG.critical("Overflow: Worker queue is full.")
+      channel.reply("")
+
+  def worker(self):
+    # Execute requests in a worker thread.
+    engine = self.engine_class()
+    while True:
+      (channel, actions) = self.requests.get()
+      try:
+        response = engine.doActions(actions)
+      except:
+        mobwrite_core.LOG.exception("Request failed.")
+        response = ""
+      self.replies.append((channel, response))
+      self.trigger.pull()
+
+  def deliver(self):
+    # Send out all the replies which the workers have finished.
+    while self.replies:
+      (channel, response) = self.replies.popleft()
+      channel.reply(response)
+
+  def expire(self):
+    # Drop connections which have stalled while sending a request, or which
+    # have been kept alive without use for too long.
+    now = time.time()
+    for channel in asyncore.socket_map.values():
+      if not isinstance(channel, EventChannel) or channel.busy or channel.done:
+        continue
+      if channel.line or channel.parser or not channel.served:
+        if channel.lasttime < now - self.timeout:
+          mobwrite_core.LOG.warning("Timeout on connection")
+          channel.close()
+      elif channel.lasttime < now - self.timeout_keepalive:
+        mobwrite_core.LOG.debug("Idle keep-alive connection expired.")
+        channel.close()
+
+  def serve_forever(self):
+    # Expiry scans every connection, so run it twice a second rather than
+    # after every event.
+    last_expire = time.time()
+    while True:
+      asyncore.loop(timeout=0.5, use_poll=True, count=1)
+      if time.time() - last_expire >= 0.5:
+        self.expire()
+        last_expire = time.time()
+
+
+def shard_of(name):
+  # Which shard owns the named text.  Stable across processes and restarts.
+  return (zlib.crc32(name) & 0xffffffff) % SHARD_COUNT
+
+
+def split_runs(actions):
+  # Split a list of actions into runs of consecutive actions which share the
+  # same username and filename.
+  runs = []
+  for action in actions:
+    if (runs and runs[-1][-1]["username"] == action["username"] and
+        runs[-1][-1]["filename"] == action["filename"]):
+      runs[-1].append(action)
+    else:
+      runs.append([action])
+  return runs
+
+
+def group_runs(runs):
+  # Group the indices of runs which share the same filename, in order of
+  # first appearance.  Views of one text by different users stay in request
+  # order, since each sees the others' edits.
+  groups = []
+  index = {}
+  for x in xrange(len(runs)):
+    key = runs[x][-1]["filename"]
+    if index.has_key(key):
+      groups[index[key]].append(x)
+    else:
+      index[key] = len(groups)
+      groups.append([x])
+  return groups
+
+
+def join_runs(runs, responses):
+  # Stitch together the responses to runs which were executed separately.
+  output = []
+  last_username = None
+  last_filename = None
+  for x in xrange(len(runs)):
+    response = responses[x]
+    if not response:
+      # Nullified, or the run could not be executed.
+      continue
+    username = runs[x][-1]["username"]
+    filename = runs[x][-1]["filename"]
+    # Each run was executed in isolation, so it printed the username (if
+    # requested) and the filename.  Drop them where a single pass over the
+    # request would not have printed them.
+    if response.startswith("u:") and last_username == username:
+      response = response[response.find("\n") + 1:]
+    if last_filename == filename and last_username == username:
+      response = response[response.find("\n") + 1:]
+    output.append(response)
+    last_username = username
+    last_filename = filename
+  return "".join(output)
+
+
+class ShardConnection:
+  # A kept-alive connection from the router to one shard process.
+
+  # Object properties:
+  # .shard - The shard at the other end.
+  # .sock - The non-blocking socket.
+  # .outgoing - Request data not yet sent.
+  # .incoming - Response data received but not yet claimed.
+
+  def __init__(self, shard):
+    self.shard = shard
+    self.sock = socket.create_connection(("127.0.0.1", shard_port(shard)))
+    self.sock.setblocking(0)
+    self.outgoing = ""
+    self.incoming = ""
+
+  def flush(self):
+    # Send as much of the outgoing data as the socket will take.
+    sent = self.sock.send(self.outgoing)
+    self.outgoing = self.outgoing[sent:]
+
+  def fill(self):
+    # Receive whatever data is waiting.  Returns False if the shard hung up.
+    data = self.sock.recv(65536)
+    self.incoming += data
+    return bool(data)
+
+  def pop(self):
+    # Claim the next complete response, or None if it has not all arrived.
+    # Responses are terminated by a blank line; no response contains one.
+    if self.incoming.startswith("\n"):
+      self.incoming = self.incoming[1:]
+      return ""
+    end = self.incoming.find("\n\n")
+    if end == -1:
+      return None
+    response = self.incoming[:end + 1]
+    self.incoming = self.incoming[end + 2:]
+    return response
+
+  def close(self):
+    self.sock.close()
+
+
+class ShardPool:
+  # Idle connections to the shard processes, shared by all router threads.
+
+  def __init__(self):
+    self.lock = thread.allocate_lock()
+    self.idle = {}
+
+  def acquire(self, shard):
+    connection = None
+    self.lock.acquire()
+    try:
+      idle = self.idle.get(shard)
+      if idle:
+        connection = idle.pop()
+    finally:
+      self.lock.release()
+    if connection:
+      # An idle connection should have nothing to read.  If it does, the
+      # shard has hung up (or is confused); discard it.
+      if not select.select([connection.sock], [], [], 0)[0]:
+        return connection
+      connection.close()
+    return ShardConnection(shard)
+
+  def release(self, connection):
+    self.lock.acquire()
+    try:
+      self.idle.setdefault(connection.shard, []).append(connection)
+    finally:
+      self.lock.release()
+
+
+class ShardRouter(DaemonEngine):
+  # Splits each request by filename, forwards the slices to the shard
+  # processes which own those files, and stitches the answers back together.
+
+  def doActions(self, actions):
+    runs = split_runs(actions)
+    return join_runs(runs, self.exchange(runs))
+
+  def serializeRun(self, run):
+    """Rebuild the MobWrite commands for one run of actions.
+
+    Args:
+      run: List of actions which share a username and filename.
+
+    Returns:
+      A kept-alive request which the shard process will parse back into the
+      same actions.
+    """
+    lines = [KEEPALIVE_LINE]
+    if run[-1].get("echo_username"):
+      lines.append("U:%s" % run[-1]["username"])
+    else:
+      lines.append("u:%s" % run[-1]["username"])
+    for action in run:
+      if action["mode"] == "null":
+        lines.append("n:%s" % action["filename"])
+        continue
+      lines.append("f:%d:%s" % (action["server_version"], action["filename"]))
+      if action["mode"] == "delta":
+        name = "d"
+      else:
+        name = "r"
+      if action["force"]:
+        name = name.upper()
+      lines.append("%s:%d:%s" % (name, action["client_version"], action["data"]))
+    lines.append("\n")
+    return "\n".join(lines)
+
+  def exchange(self, runs):
+    """Send every run to its shard and collect the responses.
+
+    All the requests are written before any response is awaited, so the
+    shards work on their slices concurrently.
+
+    Args:
+      runs: List of runs of actions.
+
+    Returns:
+      List of response strings, in the same order as the runs.  A run whose
+      shard could not be reached gets an empty response.
+    """
+    responses = [""] * len(runs)
+    connections = {}
+    waiting = {}
+    failed = {}
+    try:
+      for x in xrange(len(runs)):
+        shard = shard_of(runs[x][0]["filename"])
+        if failed.has_key(shard):
+          continue
+        if not connections.has_key(shard):
+          try:
+            connections[shard] = SHARD_POOL.acquire(shard)
+          except socket.error, e:
+            mobwrite_core.LOG.error("Can't reach shard %d: %s" % (shard, e))
+            failed[shard] = True
+            continue
+          waiting[shard] = []
+        connections[shard].outgoing += self.serializeRun(runs[x])
+        waiting[shard].append(x)
+
+      timeout = float(mobwrite_core.CFG.get("TIMEOUT_SHARD", 10.0))
+      deadline = time.time() + timeout
+      while True:
+        busy = [shard for shard in waiting if waiting[shard]]
+        if not busy:
+          break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          for shard in busy:
+            mobwrite_core.LOG.error("Timeout waiting on shard %d" % shard)
+            failed[shard] = True
+            waiting[shard] = []
+          break
+        readers = [connections[shard].sock for shard in busy]
+        writers = [connections[shard].sock for shard in busy
+                   if connections[shard].outgoing]
+        (readable, writable, broken) = select.select(readers, writers, [],
+                                                     remaining)
+        for shard in busy:
+          connection = connections[shard]
+          try:
+            if connection.sock in writable:
+              connection.flush()
+            if connection.sock in readable:
+              if not connection.fill():
+                raise socket.error("Connection closed by shard")
+              while waiting[shard]:
+                response = connection.pop()
+                if response is None:
+                  break
+                responses[waiting[shard].pop(0)] = response
+          except socket.error, e:
+            mobwrite_core.LOG.error("Lost shard %d: %s" % (shard, e))
+            failed[shard] = True
+            waiting[shard] = []
+    finally:
+      for shard in connections:
+        if failed.has_key(shard):
+          connections[shard].close()
+        else:
+          SHARD_POOL.release(connections[shard])
+    return responses
+
+
+class ShardRouterMobWrite(ShardRouter, DaemonMobWrite):
+  # Services one telnet connection per thread on the router.
+  pass
+
+
+# Connections from the router to the shard processes.
+SHARD_POOL = ShardPool()
+
+
+def shard_port(shard):
+  # Shard processes listen on the ports following the public port.
+  return int(mobwrite_core.CFG.get("LOCAL_PORT", 3017)) + 1 + shard
+
+
+def start_shards(count):
+  """Fork one worker process per shard.
+
+  Args:
+    count: Number of shard processes.
+
+  Returns:
+    The shard number in a worker process, or None in the router process.
+  """
+  global SHARD_COUNT, SHARD_PIDS
+  SHARD_COUNT = count
+  for shard in xrange(count):
+    pid = os.fork()
+    if pid == 0:
+      SHARD_PIDS = []
+      return shard
+    SHARD_PIDS.append(pid)
+  mobwrite_core.LOG.info("Started %d shard processes." % count)
+  return None
+
+
+def stop_shards():
+  # Ask the shard processes to shut down cleanly, and wait for them.
+  for pid in SHARD_PIDS:
+    try:
+      os.kill(pid, signal.SIGINT)
+      os.waitpid(pid, 0)
+    except OSError:
+      pass
+
+
+def stop_router(signum, frame):
+  # Treat a request to terminate the router like a keyboard interrupt.
+  raise KeyboardInterrupt
+
+
+# Process ids of the shard workers (router process only).
+SHARD_PIDS = []
+
+
+def save_dirty():
+  # Save every text which has changed since the last cleanup pass.
+  global dirty
+  lock_dirty.acquire()
+  try:
+    changed = dirty
+    dirty = {}
+  finally:
+    lock_dirty.release()
+  for textobj in changed.values():
+    textobj.lock.acquire()
+    try:
+      if textobj.changed:
+        textobj.save()
+    finally:
+      textobj.lock.release()
+
+
+def expire_stored():
+  # Delete texts from storage which haven't been saved for TIMEOUT_TEXT.
+  timeout = datetime.datetime.now() - mobwrite_core.TIMEOUT_TEXT
+  cutoff = int(time.mktime(timeout.timetuple()))
+  if STORAGE_MODE == SQLITE:
+    # The database keeps its own index of save times.
+    for name in sqlite_db.expire(cutoff):
+      mobwrite_core.LOG.info("Deleted from DB: '%s'" % name)
+  for name in stored_index.due(cutoff):
+    if STORAGE_MODE == MEMORY:
+      filename = spill_filename(name)
+      if os.path.exists(filename):
+        os.unlink(filename)
+        mobwrite_core.LOG.info("Deleted spilled file: '%s'" % filename)
+
+    if STORAGE_MODE == FILE:
+      filename = "%s/%s.txt" % (DATA_DIR, urllib.quote(name, ""))
+      if os.path.exists(filename):
+        os.unlink(filename)
+        mobwrite_core.LOG.info("Deleted file: '%s'" % filename)
+
+    if STORAGE_MODE == BDB:
+      if texts_db.has_key(name):
+        del texts_db[name]
+      if lasttime_db.has_key(name):
+        del lasttime_db[name]
+      mobwrite_core.LOG.info("Deleted from DB: '%s'" % name)
+
+    if STORAGE_MODE == JOURNAL:
+      journal.write(name, None)
+      mobwrite_core.LOG.info("Deleted from journal: '%s'" % name)
+
+
+def scan_files():
+  # Return (name, time of last save) for every text file in the data
+  # directory which this process owns.
+  items = []
+  for filename in glob.glob("%s/*.txt" % DATA_DIR):
+    name = urllib.unquote(os.path.basename(filename)[:-4])
+    if SHARD is not None and shard_of(name) != SHARD:
+      # Leave files owned by other shards to their own processes.
+      continue
+    items.append((name, int(os.path.getmtime(filename))))
+  return items
+
+
+def import_texts(suffix):
+  # Load a new database with any texts saved in FILE or BDB mode.
+  rows = []
+  for (name, lasttime) in scan_files():
+    infile = open(text_filename(name))
+    rows.append((name, infile.read().decode("utf-8"), lasttime))
+    infile.close()
+  if os.path.exists(DATA_DIR + "/texts%s.db" % suffix):
+    try:
+      import bsddb
+    except ImportError:
+      mobwrite_core.LOG.warning("Can't import BDB texts without bsddb.")
+    else:
+      old_texts = bsddb.hashopen(DATA_DIR + "/texts%s.db" % suffix, "r")
+      old_times = bsddb.hashopen(DATA_DIR + "/lasttime%s.db" % suffix, "r")
+      for (name, text) in old_texts.iteritems():
+        rows.append((name, text.decode("utf-8"),
+                     int(old_times.get(name, time.time()))))
+      old_texts.close()
+      old_times.close()
+  if rows:
+    mobwrite_core.LOG.warning("Imported %d texts into DB." %
+                              sqlite_db.load(rows))
+
+
+def open_expiry_index(suffix):
+  # Load the record of when each stored text was last saved.
+  if STORAGE_MODE == FILE:
+    stored_index.open("%s/expiry%s.idx" % (DATA_DIR, suffix), scan_files)
+  if STORAGE_MODE == BDB:
+    stored_index.load([(k, int(v)) for k, v in lasttime_db.iteritems()])
+  if STORAGE_MODE == JOURNAL:
+    stored_index.load(journal.times())
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  # Serves the metrics to scrapers over HTTP.
+
+  def do_GET(self):
+    connection_origin = mobwrite_core.CFG.get("CONNECTION_ORIGIN", "")
+    if connection_origin and self.client_address[0] != connection_origin:
+      self.send_error(403)
+      return
+    if self.path.split("?")[0] not in ("/", "/metrics"):
+      self.send_error(404)
+      return
+    body = mobwrite_core.METRICS.render()
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    mobwrite_core.LOG.debug("Metrics: " + format % args)
+
+
+def declare_metrics():
+  # Declare the daemon's metrics.  The gauges read statistics which are kept
+  # anyway, so they cost nothing until scraped.
+  metrics = mobwrite_core.METRICS
+  for (name, help) in [
+      ("request_seconds", "Time spent executing each request."),
+      ("lock_wait_seconds", "Time spent waiting for a text's lock."),
+      ("diff_seconds", "Time spent diffing a shadow against its text."),
+      ("patch_seconds", "Time spent patching a text with a delta."),
+      ("serialize_seconds", "Time spent writing out each view's edits.")]:
+    metrics.histogram(name, help)
+  for (name, help) in [
+      ("deltas_received_total", "Deltas received from clients."),
+      ("raw_received_total", "Raw texts received from clients."),
+      ("raw_sent_total", "Raw texts sent to clients."),
+      ("nullified_total", "Texts nullified."),
+      ("rollbacks_total", "Shadows rolled back to the backup shadow."),
+      ("shadow_mismatches_total", "Deltas for a mismatched shadow version."),
+      ("future_deltas_total", "Deltas from a future client version."),
+      ("repeated_deltas_total", "Deltas which had already been applied."),
+      ("delta_failures_total", "Deltas which didn't match the shadow.")]:
+    metrics.counter(name, help)
+
+  metrics.gauge("texts", "Texts in memory.", lambda: len(texts))
+  metrics.gauge("views", "Views in memory.", lambda: len(views))
+  metrics.gauge("buffers", "Buffers being assembled.", lambda: len(buffers))
+  metrics.gauge("resident_characters", "Characters of text in memory.",
+                lambda: residency.size)
+  metrics.gauge("evictions_total", "Texts evicted to stay within budget.",
+                lambda: residency.evictions, "counter")
+  for (name, stat) in [("syncs_total", "syncs"),
+                       ("syncs_unchanged_total", "unchanged"),
+                       ("syncs_cached_total", "cached"),
+                       ("syncs_diffed_total", "diffed")]:
+    metrics.gauge(name, "Views synced (%s)." % stat,
+                  lambda stat=stat: sync_stats[stat], "counter")
+  for registry in (texts, views, buffers):
+    metrics.gauge("%s_lock_acquired_total" % registry.name,
+                  "Acquisitions of the %s stripe locks." % registry.name,
+                  lambda registry=registry: registry.stats()[0], "counter")
+    metrics.gauge("%s_lock_contended_total" % registry.name,
+                  "Acquisitions of the %s stripe locks which waited." %
+                  registry.name,
+                  lambda registry=registry: registry.stats()[1], "counter")
+  if writer:
+    metrics.gauge("write_queue_depth", "Texts waiting to be written.",
+                  writer.depth)
+    metrics.gauge("written_total", "Texts written by the write-behind.",
+                  lambda: writer.written, "counter")
+    metrics.gauge("flush_max_seconds", "Longest write-behind flush.",
+                  lambda: writer.max_latency)
+  pool = mobwrite_core.POOL
+  if pool:
+    metrics.gauge("diff_pool_busy", "Computations in the diff pool.",
+                  lambda: pool.busy)
+    metrics.gauge("diff_pool_offloaded_total",
+                  "Computations sent to the diff pool.",
+                  lambda: pool.offloaded, "counter")
+    metrics.gauge("diff_pool_inline_total",
+                  "Computations small enough to do in place.",
+                  lambda: pool.inline, "counter")
+    metrics.gauge("diff_pool_saturated_total",
+                  "Computations which found every diff process busy.",
+                  lambda: pool.saturated, "counter")
+
+
+def start_metrics(port):
+  # Serve the metrics on their own port from a background thread.
+  server = BaseHTTPServer.HTTPServer(("", port), MetricsHandler)
+  thread.start_new_thread(server.serve_forever, ())
+  mobwrite_core.LOG.info("Serving metrics on port %d..." % port)
+
 
 def cleanup_thread():
   # Every minute cleanup
   if STORAGE_MODE == BDB:
     import bsddb
 
+  view_checkpoint = float(mobwrite_core.CFG.get("VIEW_CHECKPOINT", 0))
+  last_checkpoint = time.time()
   while True:
     mobwrite_core.LOG.info("Running cleanup task.")
-    for v in views.values():
-      v.cleanup()
-    for v in texts.values():
-      v.cleanup()
-    for v in buffers.values():
-      v.cleanup()
-
-    timeout = datetime.datetime.now() - mobwrite_core.TIMEOUT_TEXT
-    if STORAGE_MODE == FILE:
-      # Delete old files.
-      files = glob.glob("%s/*.txt" % DATA_DIR)
-      for filename in files:
-        if datetime.datetime.fromtimestamp(os.path.getmtime(filename)) < timeout:
-          os.unlink(filename)
-          mobwrite_core.LOG.info("Deleted file: '%s'" % filename)
-
-    if STORAGE_MODE == BDB:
-      # Delete old DB records.
-      # Can't delete an entry in a hash while iterating or else order is lost.
-      expired = []
-      for k, v in lasttime_db.iteritems():
-        if datetime.datetime.fromtimestamp(int(v)) < timeout:
-          expired.append(k)
-      for k in expired:
-        if texts_db.has_key(k):
-          del texts_db[k]
-        if lasttime_db.has_key(k):
-          del lasttime_db[k]
-        mobwrite_core.LOG.info("Deleted from DB: '%s'" % k)
+    # Expiring a view may make its text due, so keep going until nothing is.
+    while True:
+      objs = expiry.due(datetime.datetime.now())
+      if not objs:
+        break
+      for obj in objs:
+        obj.cleanup()
+    residency.trim()
+    save_dirty()
+    expire_stored()
+    if view_store and time.time() - last_checkpoint >= view_checkpoint:
+      view_store.checkpoint()
+      last_checkpoint = time.time()
+
+    mobwrite_core.LOG.info("Residency: %s" % residency.stats())
+    mobwrite_core.LOG.info("Syncs: %(syncs)d, %(unchanged)d unchanged, "
+                           "%(cached)d cached, %(diffed)d diffed" % sync_stats)
+    for registry in (texts, views, buffers):
+      (acquired, contended) = registry.stats()
+      mobwrite_core.LOG.info("Lock contention on %s: %d of %d acquisitions" %
+                             (registry.name, contended, acquired))
+    if writer:
+      mobwrite_core.LOG.info("Write-behind: %s" % writer.stats())
+    if mobwrite_core.POOL:
+      mobwrite_core.LOG.info("Diff pool: %s" % mobwrite_core.POOL.stats())
 
     time.sleep(60)
 
 
 def main():
   mobwrite_core.CFG.initConfig(ROOT_DIR + "lib/mobwrite_config.txt")
+  global STORAGE_MODE, SHARD
+  port = int(mobwrite_core.CFG.get("LOCAL_PORT", 3017))
+  address = ("", port)
+  handler = DaemonMobWrite
+  engine = DaemonEngine
+  shard_count = int(mobwrite_core.CFG.get("SHARD_PROCESSES", 0))
+  if shard_count:
+    SHARD = start_shards(shard_count)
+    if SHARD is None:
+      # The router only assembles buffers; it stores nothing itself.
+      STORAGE_MODE = MEMORY
+      # Take the shards down with the router.
+      signal.signal(signal.SIGTERM, stop_router)
+      handler = ShardRouterMobWrite
+      engine = ShardRouter
+    else:
+      # Shards only talk to the router.
+      address = ("127.0.0.1", shard_port(SHARD))
+      mobwrite_core.CFG["CONNECTION_ORIGIN"] = "127.0.0.1"
+  start_engine(engine)
+
+  mobwrite_core.LOG.info("Listening on port %d..." % address[1])
+  server_mode = mobwrite_core.CFG.get("SERVER_MODE", "THREADING")
+  if server_mode == "THREADING":
+    s = SocketServer.ThreadingTCPServer(address, handler)
+  elif server_mode == "EVENT":
+    s = EventServer(address, engine,
+                    int(mobwrite_core.CFG.get("WORKER_THREADS", 8)),
+                    int(mobwrite_core.CFG.get("WORKER_QUEUE", 1000)))
+  else:
+    raise "Config: Unknown server mode."
+  try:
+    s.serve_forever()
+  except KeyboardInterrupt:
+    mobwrite_core.LOG.info("Shutting down.")
+    s.socket.close()
+    stop_shards()
+    stop_engine()
+
+
+def start_engine(engine):
+  """Open storage and start the background tasks, ready to execute requests.
+  The configuration must already have been read.
+
+  Args:
+    engine: Class of the engine which will execute requests.
+  """
+  global writer
+  diff_processes = int(mobwrite_core.CFG.get("DIFF_PROCESSES", 0))
+  if diff_processes and engine is DaemonEngine:
+    # Fork the diff workers before any other threads are started.
+    mobwrite_core.POOL = mobwrite_core.DiffPool(diff_processes,
+        int(mobwrite_core.CFG.get("DIFF_POOL_THRESHOLD", 20000)))
+
+  if SHARD is None:
+    suffix = ""
+  else:
+    suffix = "_%d" % SHARD
   if STORAGE_MODE == BDB:
     import bsddb
     global texts_db, lasttime_db
-    texts_db = bsddb.hashopen(DATA_DIR + "/texts.db")
-    lasttime_db = bsddb.hashopen(DATA_DIR + "/lasttime.db")
+    texts_db = bsddb.hashopen(DATA_DIR + "/texts%s.db" % suffix)
+    lasttime_db = bsddb.hashopen(DATA_DIR + "/lasttime%s.db" % suffix)
+  if STORAGE_MODE == JOURNAL:
+    global journal, JOURNAL_COMPACT
+    JOURNAL_COMPACT = int(mobwrite_core.CFG.get("JOURNAL_COMPACT",
+                                                JOURNAL_COMPACT))
+    journal = Journal(DATA_DIR + "/journal" + suffix,
+                      int(mobwrite_core.CFG.get("JOURNAL_SHARDS", 4)))
+    journal.open()
+    # Start up a thread that compacts the journal.
+    thread.start_new_thread(journal.run, ())
+  residency.budget = int(mobwrite_core.CFG.get("MAX_RESIDENT_SIZE", 0))
+  if residency.budget:
+    # Start up a thread that evicts texts once over budget.
+    thread.start_new_thread(residency.run, ())
+  global DIFF_CACHE_SIZE
+  DIFF_CACHE_SIZE = int(mobwrite_core.CFG.get("DIFF_CACHE_SIZE",
+                                              DIFF_CACHE_SIZE))
+  if STORAGE_MODE == MEMORY and residency.budget and engine is DaemonEngine:
+    # The router holds no texts, so leaves spill files to the shards.
+    clear_spills()
+  if STORAGE_MODE == SQLITE:
+    global sqlite_db
+    sqlite_db = SqliteStore(DATA_DIR + "/texts%s.sqlite" % suffix)
+    if sqlite_db.empty():
+      import_texts(suffix)
+  open_expiry_index(suffix)
+
+  if float(mobwrite_core.CFG.get("VIEW_CHECKPOINT", 0)):
+    if STORAGE_MODE == MEMORY:
+      # Restored views would be out of step with the lost texts.
+      mobwrite_core.LOG.warning("Views can't persist in memory mode.")
+    else:
+      global view_store
+      view_store = ViewStore(DATA_DIR + "/views%s.pickle" % suffix)
+      view_store.load()
 
   # Start up a thread that does timeouts and cleanup
   thread.start_new_thread(cleanup_thread, ())
 
-  port = int(mobwrite_core.CFG.get("LOCAL_PORT", 3017))
-  mobwrite_core.LOG.info("Listening on port %d..." % port)
-  s = SocketServer.ThreadingTCPServer(("", port), DaemonMobWrite)
-  try:
-    s.serve_forever()
-  except KeyboardInterrupt:
-    mobwrite_core.LOG.info("Shutting down.")
-    s.socket.close()
-    if STORAGE_MODE == BDB:
-      texts_db.close()
-      lasttime_db.close()
+  flush_interval = float(mobwrite_core.CFG.get("FLUSH_INTERVAL", 0))
+  if flush_interval and STORAGE_MODE != MEMORY:
+    # Start up a thread that writes saved texts to storage.
+    writer = WriteBehind(flush_interval)
+    thread.start_new_thread(writer.run, ())
+
+  action_threads = int(mobwrite_core.CFG.get("ACTION_THREADS", 0))
+  if action_threads and engine is DaemonEngine:
+    # Start up threads that help execute requests covering several views.
+    global action_pool
+    action_pool = ActionPool(action_threads)
+
+  metrics_port = int(mobwrite_core.CFG.get("METRICS_PORT", 0))
+  if metrics_port:
+    mobwrite_core.METRICS.enabled = True
+    declare_metrics()
+    if SHARD is not None:
+      # Shards serve their own metrics on the following ports.
+      metrics_port += 1 + SHARD
+    start_metrics(metrics_port)
+
+
+def stop_engine():
+  # Write out everything held in memory and close storage.
+  if mobwrite_core.POOL:
+    mobwrite_core.POOL.close()
+  if writer:
+    save_dirty()
+    writer.flush()
+  if view_store:
+    view_store.checkpoint()
+  stored_index.close()
+  if STORAGE_MODE == BDB:
+    texts_db.close()
+    lasttime_db.close()
+  if STORAGE_MODE == JOURNAL:
+    journal.close()
+  if STORAGE_MODE == SQLITE:
+    sqlite_db.close()
+
+
+def embed():
+  """Start the synchronization engine inside another server, such as the
+  gateway, which then executes requests itself instead of relaying them.
+
+  Returns:
+    An engine whose handleRequest method answers MobWrite commands.
+  """
+  mobwrite_core.CFG.initConfig(ROOT_DIR + "lib/mobwrite_config.txt")
+  if int(mobwrite_core.CFG.get("SHARD_PROCESSES", 0)):
+    mobwrite_core.LOG.warning("Shards can't be embedded; ignoring them.")
+  start_engine(DaemonEngine)
+  return DaemonEngine()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,426 @@
+#!/usr/bin/python2.4
+
+"""Test harness for mobwrite_daemon.py
+
+Copyright 2009 Google Inc.
+http://code.google.com/p/google-mobwrite/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+import logging
+import mobwrite_daemon
+# Force a module reload so to make debugging easier (at least in PythonWin).
+reload(mobwrite_daemon)
+mobwrite_core = mobwrite_daemon.mobwrite_core
+
+class MobWriteDaemonTest(unittest.TestCase):
+
+  def setUp(self):
+    mobwrite_core.logging.basicConfig()
+    mobwrite_core.CFG.initConfig("no_such_config.txt")
+    mobwrite_core.LOG.setLevel(logging.ERROR)
+
+  def tearDown(self):
+    mobwrite_core.logging.shutdown()
+
+  def converse(self, request):
+    # Run one telnet connection through the thread-per-connection handler.
+    (client, server) = socket.socketpair()
+    client.sendall(request)
+    client.shutdown(socket.SHUT_WR)
+    mobwrite_daemon.DaemonMobWrite(server, ("127.0.0.1", 0), None)
+    server.close()
+    response = []
+    while True:
+      data = client.recv(4096)
+      if not data:
+        break
+      response.append(data)
+    client.close()
+    return "".join(response)
+
+  def testSingleRequest(self):
+    self.assertEquals("F:0:single\nD:0:=5\n",
+        self.converse("u:fred\nf:0:single\nR:0:Hello\n\n"))
+
+  def testKeepAlive(self):
+    # Each kept-alive response is terminated by a blank line.
+    # A request without keep-alive closes the connection.
+    self.assertEquals("F:0:pipe\nD:0:=5\n\nF:1:pipe\nd:1:=6\n\n",
+        self.converse("k:1\nu:fred\nf:0:pipe\nR:0:Hello\n\n" +
+                      "k:1\nu:fred\nf:1:pipe\nd:0:=5\t+!\n\n" +
+                      "U:bob\n\n" +
+                      "u:ignored\nf:0:pipe\nr:0:\n\n"))
+
+  def testOversizedEvent(self):
+    # An oversized request drops the connection, and any reply due on it.
+    class Server:
+      max_request = 10
+    (client, server) = socket.socketpair()
+    channel = mobwrite_daemon.EventChannel(server, "127.0.0.1", Server())
+    channel.busy = True
+    channel.pending.append(([], False))
+    channel.collect_incoming_data("u:fred\nf:0:big\n")
+    self.assertTrue(channel.done)
+    self.assertFalse(channel.pending)
+    channel.reply("F:0:big\n")
+    self.assertEquals("", client.recv(4096))
+    client.close()
+
+  def testShardSlices(self):
+    # Each run of actions on one document survives a round trip to a shard.
+    router = mobwrite_daemon.ShardRouter()
+    actions = router.parseRequest("U:fred\nf:3:report\nd:2:=10\t+Hi\n" +
+                                  "f:4:report\nR:2:Hello\nn:memo\n" +
+                                  "u:bob\nF:1:report\nD:1:=5\n\n")
+    runs = mobwrite_daemon.split_runs(actions)
+    self.assertEquals([2, 1, 1], [len(run) for run in runs])
+    for run in runs:
+      self.assertEquals(run, router.parseRequest(router.serializeRun(run)))
+    # A delta after n: has no version, and is dropped by either path.
+    request = "u:fred\nn:memo\nd:0:=0\nf:0:memo\nR:0:Hi\n\n"
+    runs = mobwrite_daemon.split_runs(router.parseRequest(request))
+    self.assertEquals([["null", "raw"]],
+                      [[action["mode"] for action in run] for run in runs])
+    self.assertEquals(runs[0],
+                      router.parseRequest(router.serializeRun(runs[0])))
+    self.assertEquals("F:0:memo\nD:0:=2\n", self.converse(request))
+
+  def testActionPool(self):
+    # Views executed concurrently answer as if executed one after another.
+    request = ("U:fred\nf:0:%(a)s\nR:0:Hello\nf:0:%(b)s\nR:0:World\n" +
+               "u:bob\nf:0:%(a)s\nr:0:\nU:fred\nf:1:%(a)s\nd:1:=5\t+!\n" +
+               "n:%(c)s\n\n")
+    expected = self.converse(request % {"a": "alpha", "b": "beta",
+                                        "c": "gamma"})
+    # Runs on one text stay in order, whichever user's view they are for.
+    actions = mobwrite_daemon.DaemonEngine().parseRequest(
+        request % {"a": "alpha", "b": "beta", "c": "gamma"})
+    self.assertEquals([[0, 2, 3], [1], [4]],
+        mobwrite_daemon.group_runs(mobwrite_daemon.split_runs(actions)))
+    mobwrite_daemon.action_pool = mobwrite_daemon.ActionPool(2)
+    try:
+      self.assertEquals(expected.replace("alpha", "alpha2")
+                                .replace("beta", "beta2"),
+          self.converse(request % {"a": "alpha2", "b": "beta2",
+                                   "c": "gamma2"}))
+    finally:
+      mobwrite_daemon.action_pool = None
+
+  def testBuffer(self):
+    # Fragments may arrive out of order, be resent, or contain nulls.
+    engine = mobwrite_daemon.DaemonEngine()
+    self.assertEquals("", engine.feedBuffer("frag", 3, 3, "c"))
+    self.assertEquals("", engine.feedBuffer("frag", 3, 1, "a%00"))
+    self.assertEquals("", engine.feedBuffer("frag", 3, 1, "a\0"))
+    self.assertEquals("a\0b\0c", engine.feedBuffer("frag", 3, 2, "b\0"))
+    self.assertEquals(None, mobwrite_daemon.buffers.get("frag_3"))
+    # Buffers which grow too large are discarded; their slots count too.
+    slot = mobwrite_daemon.BufferObj.SLOT_BYTES
+    mobwrite_core.MAX_BUFFER_BYTES = 2 * slot + 4
+    mobwrite_core.MAX_BUFFER_SLOTS = 3
+    try:
+      self.assertEquals("", engine.feedBuffer("huge", 2, 1, "abc"))
+      self.assertNotEquals(None, mobwrite_daemon.buffers.get("huge_2"))
+      self.assertEquals("", engine.feedBuffer("huge", 2, 2, "def"))
+      self.assertEquals(None, mobwrite_daemon.buffers.get("huge_2"))
+      self.assertEquals("", engine.feedBuffer("wide", 3, 1, "a"))
+      self.assertEquals(None, mobwrite_daemon.buffers.get("wide_3"))
+      # Buffers with too many slots are refused before any are allocated.
+      mobwrite_core.MAX_BUFFER_BYTES = 0
+      self.assertEquals("", engine.feedBuffer("many", 4, 1, "a"))
+      self.assertEquals(None, mobwrite_daemon.buffers.get("many_4"))
+    finally:
+      mobwrite_core.MAX_BUFFER_BYTES = 2000000
+      mobwrite_core.MAX_BUFFER_SLOTS = 2000
+
+  def testJournalReplay(self):
+    # Snapshots, deltas and nullifications survive a restart and compaction.
+    directory = tempfile.mkdtemp()
+    try:
+      journal = mobwrite_daemon.Journal(directory + "/journal", 2)
+      journal.open()
+      journal.write("alpha", u"Hello world.")
+      journal.write("alpha", u"Hello brave new world.")
+      journal.write("beta", u"Caf\xe9\tbar")
+      journal.write("gamma", u"Doomed")
+      journal.write("gamma", None)
+      journal.close()
+
+      journal = mobwrite_daemon.Journal(directory + "/journal", 2)
+      journal.open()
+      self.assertEquals(u"Hello brave new world.", journal.read("alpha"))
+      self.assertEquals(u"Caf\xe9\tbar", journal.read("beta"))
+      self.assertEquals(None, journal.read("gamma"))
+      for shard in journal.shards:
+        shard.compact()
+      journal.write("alpha", u"Goodbye world.")
+      journal.close()
+
+      journal = mobwrite_daemon.Journal(directory + "/journal", 2)
+      journal.open()
+      self.assertEquals(u"Goodbye world.", journal.read("alpha"))
+      self.assertEquals(u"Caf\xe9\tbar", journal.read("beta"))
+
+      # Texts are read back from the files; long chains start afresh.
+      shard = journal.shard("alpha")
+      for x in xrange(mobwrite_daemon.JOURNAL_CHAIN * 2):
+        journal.write("alpha", u"Version %d." % x)
+        self.assertTrue(len(shard.chains["alpha"]) <=
+                        mobwrite_daemon.JOURNAL_CHAIN)
+      self.assertEquals(u"Version %d." % x, journal.read("alpha"))
+
+      # A text saved while a snapshot is being written keeps its new value.
+      rebuild = shard.rebuild
+      def rebuild_and_save(chain, readers):
+        if readers is not shard.readers:
+          shard.rebuild = rebuild
+          journal.write("alpha", u"Saved meanwhile.")
+        return rebuild(chain, readers)
+      shard.rebuild = rebuild_and_save
+      shard.compact()
+      self.assertEquals(u"Saved meanwhile.", journal.read("alpha"))
+      journal.write("alpha", u"Saved afterwards.")
+      journal.close()
+
+      journal = mobwrite_daemon.Journal(directory + "/journal", 2)
+      journal.open()
+      self.assertEquals(u"Saved afterwards.", journal.read("alpha"))
+      journal.close()
+    finally:
+      shutil.rmtree(directory)
+
+  def testExpiryIndex(self):
+    # Repeated saves of one text don't pile up in the heap.
+    index = mobwrite_daemon.ExpiryIndex()
+    index.touch("beta", 5)
+    for when in xrange(10, 5010):
+      index.touch("alpha", when)
+    self.assertTrue(len(index.heap) <= 2 * len(index.saved) + 1000)
+    self.assertEquals(["beta"], index.due(10))
+    self.assertEquals([], index.due(5009))
+    self.assertEquals(["alpha"], index.due(5010))
+
+  def testWriteBehindFiles(self):
+    # Files are staged a few at a time, and none are left open.
+    directory = tempfile.mkdtemp()
+    saved = (mobwrite_daemon.STORAGE_MODE, mobwrite_daemon.DATA_DIR,
+             mobwrite_daemon.STAGED_FILES, mobwrite_daemon.stored_index)
+    try:
+      mobwrite_daemon.STORAGE_MODE = mobwrite_daemon.FILE
+      mobwrite_daemon.DATA_DIR = directory
+      mobwrite_daemon.STAGED_FILES = 2
+      mobwrite_daemon.stored_index = mobwrite_daemon.ExpiryIndex()
+      # A directory in the way of one staged file makes it fail.
+      os.mkdir(mobwrite_daemon.text_filename("broken") + ".tmp")
+      def descriptors():
+        # Count of open file descriptors, where the system lists them.
+        if os.path.isdir("/proc/self/fd"):
+          return len(os.listdir("/proc/self/fd"))
+        return None
+      opened = descriptors()
+      batch = [("text%d" % x, u"Text %d" % x) for x in xrange(5)]
+      batch.insert(3, ("broken", u"Broken"))
+      writer = mobwrite_daemon.WriteBehind(1)
+      self.assertEquals([("broken", u"Broken")], writer.write(batch))
+      self.assertEquals(opened, descriptors())
+      for x in xrange(5):
+        infile = open(mobwrite_daemon.text_filename("text%d" % x))
+        self.assertEquals("Text %d" % x, infile.read())
+        infile.close()
+      self.assertEquals(5, len(mobwrite_daemon.stored_index.saved))
+    finally:
+      (mobwrite_daemon.STORAGE_MODE, mobwrite_daemon.DATA_DIR,
+       mobwrite_daemon.STAGED_FILES, mobwrite_daemon.stored_index) = saved
+      shutil.rmtree(directory)
+
+  def testSqliteStore(self):
+    # Batches are written together and old texts expire by save time.
+    directory = tempfile.mkdtemp()
+    try:
+      db = mobwrite_daemon.SqliteStore(directory + "/texts.sqlite")
+      self.assertTrue(db.empty())
+      self.assertEquals([], db.write([("alpha", u"Caf\xe9"), ("beta", u"Two"),
+                                      ("gamma", u"Three")]))
+      self.assertEquals([], db.write([("beta", None)]))
+      self.assertEquals(u"Caf\xe9", db.read("alpha"))
+      self.assertEquals(None, db.read("beta"))
+      self.assertEquals(1, db.load([("delta", u"Old", 1000)]))
+      self.assertEquals(["delta"], db.expire(2000))
+      self.assertEquals(None, db.read("delta"))
+      self.assertEquals(u"Three", db.read("gamma"))
+      db.close()
+      # A batch which can't even begin a transaction is handed back.
+      self.assertEquals([("alpha", u"Lost")], db.write([("alpha", u"Lost")]))
+    finally:
+      shutil.rmtree(directory)
+
+  def testResidency(self):
+    # Idle texts beyond the budget spill to disk and reload on demand.
+    directory = tempfile.mkdtemp()
+    data_dir = mobwrite_daemon.DATA_DIR
+    mobwrite_daemon.DATA_DIR = directory
+    residency = mobwrite_daemon.residency
+    # Texts left by other tests stay resident.
+    base = residency.size
+    residency.budget = base + 10
+    try:
+      old = mobwrite_daemon.fetch_textobj("resident_old", None)
+      old.setText(u"Hello world")
+      new = mobwrite_daemon.fetch_textobj("resident_new", None)
+      new.setText(u"Goodbye")
+      self.assertEquals(base + 18, residency.size)
+      # Both are in use.
+      residency.trim()
+      self.assertEquals(base + 18, residency.size)
+      evictions = residency.evictions
+      old.views = 0
+      new.views = 0
+      residency.trim()
+      self.assertEquals(base + 7, residency.size)
+      self.assertEquals(None, mobwrite_daemon.texts.get("resident_old"))
+      self.assertEquals(new, mobwrite_daemon.texts.get("resident_new"))
+
+      # Reloading one asks for the other to be pushed out.
+      old = mobwrite_daemon.fetch_textobj("resident_old", None)
+      self.assertEquals(u"Hello world", old.text)
+      self.assertTrue(residency.wanted.full())
+      residency.wanted.get()
+      residency.trim()
+      self.assertEquals(["resident_new.spill"], os.listdir(directory))
+      self.assertEquals(base + 11, residency.size)
+      self.assertEquals(evictions + 2, residency.evictions)
+      old.views = 0
+      old.lock.acquire()
+      self.assertTrue(old.unload())
+      old.lock.release()
+      self.assertEquals(base, residency.size)
+
+      # A nullified text leaves nothing to reload.
+      gone = mobwrite_daemon.fetch_textobj("resident_gone", None)
+      gone.setText(u"Doomed")
+      gone.setText(None)
+      gone.views = 0
+      self.assertTrue(gone.evict())
+      self.assertEquals(["resident_new.spill"], os.listdir(directory))
+    finally:
+      if residency.wanted.full():
+        residency.wanted.get()
+      residency.budget = 0
+      mobwrite_daemon.DATA_DIR = data_dir
+      shutil.rmtree(directory)
+
+  def testSharedShadows(self):
+    # Views in step with the text share one snapshot of it.
+    self.converse("u:fred\nf:0:shared\nR:0:Hello\n\n")
+    self.converse("u:bob\nf:0:shared\nr:0:\n\n")
+    fred = mobwrite_daemon.views.get(("fred", "shared"))
+    bob = mobwrite_daemon.views.get(("bob", "shared"))
+    textobj = fred.textobj
+    self.assertTrue(fred.shadow is bob.shadow)
+    # Bob's backup shadow is still his own empty text.
+    self.assertEquals({textobj.version: [u"Hello", 3]}, textobj.snapshots)
+
+    # Fred's edit leaves Bob on the old version until he syncs.
+    self.converse("u:fred\nf:1:shared\nd:0:=5\t+!\n\n")
+    self.assertEquals(u"Hello!", textobj.text)
+    self.assertEquals(2, len(textobj.snapshots))
+    self.converse("u:bob\nf:1:shared\nd:0:=5\n\n")
+    self.assertTrue(fred.shadow is bob.shadow)
+    # Bob's backup shadow still shares the version he had.
+    self.assertEquals(bob.backup_shadow_version, textobj.version - 1)
+    self.assertEquals([textobj.version - 1, textobj.version],
+                      sorted(textobj.snapshots.keys()))
+
+    fred.nullify()
+    bob.nullify()
+    self.assertEquals({}, textobj.snapshots)
+
+  def testPoolTimeout(self):
+    # A timed-out patch is applied in place; a timed-out diff is replaced
+    # by the whole text.
+    class SlowPool:
+      def run(self, size, function, *args):
+        raise mobwrite_core.PoolTimeout(size)
+    self.converse("u:fred\nf:0:slow\nR:0:Hello\n\n")
+    self.converse("u:bob\nf:0:slow\nr:0:\n\n")
+    pool = mobwrite_core.POOL
+    mobwrite_core.POOL = SlowPool()
+    try:
+      self.converse("u:fred\nf:1:slow\nd:0:=5\t+!\n\n")
+      textobj = mobwrite_daemon.views.get(("fred", "slow")).textobj
+      self.assertEquals(u"Hello!", textobj.text)
+      self.assertEquals("F:1:slow\nd:1:-5\t+Hello!\n",
+          self.converse("u:bob\nf:1:slow\nd:0:=5\n\n"))
+    finally:
+      mobwrite_core.POOL = pool
+
+  def testUnchangedSync(self):
+    # A poll on an unchanged text is answered without diffing.
+    self.converse("u:fred\nf:0:idle\nR:0:Hello\n\n")
+    unchanged = mobwrite_daemon.sync_stats["unchanged"]
+    self.assertEquals("F:1:idle\nd:1:=5\n",
+        self.converse("u:fred\nf:1:idle\nd:0:=5\n\n"))
+    self.assertEquals(unchanged + 1, mobwrite_daemon.sync_stats["unchanged"])
+    # Fred's own edit leaves his shadow in step with the text.
+    self.converse("u:bob\nf:0:idle\nr:0:Hello\n\n")
+    self.assertEquals("F:2:idle\nd:2:=6\n",
+        self.converse("u:fred\nf:2:idle\nd:1:=5\t+!\n\n"))
+    self.assertEquals(unchanged + 3, mobwrite_daemon.sync_stats["unchanged"])
+    # But Bob's shadow must be diffed.
+    self.assertEquals("F:1:idle\nd:1:=5\t+!\n",
+        self.converse("u:bob\nf:1:idle\nd:0:=5\n\n"))
+    self.assertEquals(unchanged + 3, mobwrite_daemon.sync_stats["unchanged"])
+
+  def testDiffCache(self):
+    # Viewers at the same version share one diff of an edit.
+    self.converse("u:fred\nf:0:cache\nR:0:Hello\n\n")
+    self.converse("u:bob\nf:0:cache\nr:0:\n\n")
+    self.converse("u:carol\nf:0:cache\nr:0:\n\n")
+    self.converse("u:fred\nf:1:cache\nd:0:=5\t+!\n\n")
+    stats = mobwrite_daemon.sync_stats.copy()
+    self.assertEquals("F:1:cache\nd:1:=5\t+!\n",
+        self.converse("u:bob\nf:1:cache\nd:0:=5\n\n"))
+    self.assertEquals("F:1:cache\nd:1:=5\t+!\n",
+        self.converse("u:carol\nf:1:cache\nd:0:=5\n\n"))
+    self.assertEquals(stats["diffed"] + 1, mobwrite_daemon.sync_stats["diffed"])
+    self.assertEquals(stats["cached"] + 1, mobwrite_daemon.sync_stats["cached"])
+
+  def testViewStore(self):
+    # A checkpointed view carries on with deltas after a restart.
+    directory = tempfile.mkdtemp()
+    try:
+      self.converse("u:fred\nf:0:stored\nR:0:Hello\n\n")
+      store = mobwrite_daemon.ViewStore(directory + "/views.pickle")
+      store.checkpoint()
+      mobwrite_daemon.views.get(("fred", "stored")).nullify()
+
+      store = mobwrite_daemon.ViewStore(directory + "/views.pickle")
+      store.load()
+      mobwrite_daemon.view_store = store
+      self.assertEquals("F:1:stored\nd:1:=6\n",
+          self.converse("u:fred\nf:1:stored\nd:0:=5\t+!\n\n"))
+      self.assertEquals(None, store.take(("fred", "stored")))
+    finally:
+      mobwrite_daemon.view_store = None
+      shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -21,6 +21,7 @@ limitations under the License.
 
 __author__ = "fraser@google.com (Neil Fraser)"
 
+import bisect
 import datetime
 
 try:
@@ -32,6 +33,8 @@ except ImportError:
 
 import logging
 import re
+import thread
+import time
 
 class Configuration(dict):
   def initConfig(self, filename):
@@ -43,7 +46,8 @@ class Configuration(dict):
     Throws:
       If the config is invalid, this function will thow an error.
     """
-    global MAX_CHARS, TIMEOUT_VIEW, TIMEOUT_TEXT, TIMEOUT_BUFFER
+    global MAX_CHARS, MAX_BUFFER_BYTES, MAX_BUFFER_SLOTS, TIMEOUT_VIEW
+    global TIMEOUT_TEXT, TIMEOUT_BUFFER
 
     def readConfigFile(filename):
       self.clear()
@@ -89,6 +93,8 @@ class Configuration(dict):
     # If a configuration is invalid, throw an error.
     DMP.Diff_Timeout = float(self.get("DIFF_TIMEOUT", 0.1))
     MAX_CHARS = int(self.get("MAX_CHARS", 100000))
+    MAX_BUFFER_BYTES = int(self.get("MAX_BUFFER_BYTES", 2000000))
+    MAX_BUFFER_SLOTS = int(self.get("MAX_BUFFER_SLOTS", 2000))
     TIMEOUT_VIEW = toTime(self.get("TIMEOUT_VIEW", "30 minutes"))
     TIMEOUT_TEXT = toTime(self.get("TIMEOUT_TEXT", "1 days"))
     TIMEOUT_BUFFER = toTime(self.get("TIMEOUT_BUFFER", "15 minutes"))
@@ -110,13 +116,14 @@ class Configuration(dict):
     LOG.info("Read %d settings from %s" % (len(self), filename))
 
 
-class TextObj:
+class TextObj(object):
   # An object which stores a text.
 
   # Object properties:
   # .name - The unique name for this text, e.g 'proposal'
   # .text - The text itself.
   # .changed - Has the text changed since the last time it was saved.
+  __slots__ = ("name", "text", "changed")
 
   def __init__(self, *args, **kwargs):
     # Setup this object
@@ -138,7 +145,7 @@ class TextObj:
       self.changed = True
 
 
-class ViewObj:
+class ViewObj(object):
   # An object which contains one user's view of one text.
 
   # Object properties:
@@ -153,6 +160,10 @@ class ViewObj:
   # .edit_stack - List of unacknowledged edits sent to the client.
   # .changed - Has the view changed since the last time it was saved.
   # .delta_ok - Did the previous delta match the text length.
+  __slots__ = ("username", "filename", "shadow", "backup_shadow",
+               "shadow_client_version", "shadow_server_version",
+               "backup_shadow_server_version", "edit_stack", "changed",
+               "delta_ok")
 
   def __init__(self, *args, **kwargs):
     # Setup this object
@@ -168,6 +179,477 @@ class ViewObj:
     self.delta_ok = True
 
 
+class Action(object):
+  # One action parsed from a request.  Servers hold many of these at once,
+  # so fields are slots rather than dictionary keys.  An action may still be
+  # read and written like the dictionary it replaces: action["mode"].
+
+  # Object properties:
+  # .username - The name for the user, e.g 'fraser'
+  # .filename - The name for the file, e.g 'proposal'
+  # .mode - "delta", "raw" or "null".
+  # .data - The delta or the raw text.
+  # .force - Should the delta be applied even if it does not match.
+  # .server_version - The server version of the file.
+  # .client_version - The client version of the delta or raw text.
+  # .echo_username - Did the client ask for the username in the response.
+  __slots__ = ("username", "filename", "mode", "data", "force",
+               "server_version", "client_version", "echo_username")
+
+  def __init__(self, **kwargs):
+    for (key, value) in kwargs.iteritems():
+      setattr(self, key, value)
+
+  def __getitem__(self, key):
+    try:
+      return getattr(self, key)
+    except AttributeError:
+      raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    setattr(self, key, value)
+
+  def get(self, key, default=None):
+    return getattr(self, key, default)
+
+  def asDict(self):
+    """Return the fields which have been set, as a dictionary.
+    """
+    result = {}
+    for key in self.__slots__:
+      if hasattr(self, key):
+        result[key] = getattr(self, key)
+    return result
+
+  def __eq__(self, other):
+    if isinstance(other, Action):
+      other = other.asDict()
+    return self.asDict() == other
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __repr__(self):
+    return "Action(%r)" % self.asDict()
+
+
+class RequestParser:
+  # Parses MobWrite commands one line at a time, so that a request can be
+  # parsed as it arrives.
+  # See: http://code.google.com/p/google-mobwrite/wiki/Protocol
+
+  # Object properties:
+  # .mobwrite - The MobWrite object which assembles buffers.
+  # .actions - List of the actions parsed so far.
+  # .username - The current username.
+  # .filename - The current filename.
+  # .server_version - The server version of the current file.
+  # .echo_username - Did the client ask for the username in the response.
+  # .buffer - Text of a completed buffer, which replaces this request.
+  # .complete - Has the terminating blank line been parsed.
+  # .elapsed - Seconds spent parsing so far.
+
+  def __init__(self, mobwrite):
+    self.mobwrite = mobwrite
+    self.actions = []
+    self.username = None
+    self.filename = None
+    self.server_version = None
+    self.echo_username = False
+    self.buffer = None
+    self.complete = False
+    self.elapsed = 0.0
+
+  def feed(self, line):
+    """Parse one line of MobWrite commands.
+
+    Args:
+      line: One line, without its line break.
+
+    Returns:
+      True if this was the blank line which terminates the request.
+    """
+    start = time.time()
+    try:
+      return self.parseLine(line)
+    finally:
+      self.elapsed += time.time() - start
+
+  def parseLine(self, line):
+    # Parse one line; see feed.
+    if not line:
+      # Terminate on blank line.
+      self.complete = True
+      return True
+    if self.buffer is not None:
+      # Buffers are not intended to be mixed with other commands.
+      return False
+    if line.find(":") != 1:
+      # Invalid line.
+      return False
+    (name, value) = (line[:1], line[2:])
+
+    # Parse out a version number for file, delta or raw.
+    version = None
+    if ("FfDdRr".find(name) != -1):
+      div = value.find(":")
+      if div > 0:
+        try:
+          version = int(value[:div])
+        except ValueError:
+          LOG.warning("Invalid version number: %s" % line)
+          return False
+        value = value[div + 1:]
+      else:
+        LOG.warning("Missing version number: %s" % line)
+        return False
+
+    if name == "b" or name == "B":
+      # Decode and store this entry into a buffer.
+      try:
+        (name, size, index, text) = value.split(" ", 3)
+        size = int(size)
+        index = int(index)
+      except ValueError:
+        LOG.warning("Invalid buffer format: %s" % value)
+        return False
+      # Store this buffer fragment.
+      text = self.mobwrite.feedBuffer(name, size, index, text)
+      # Check to see if the buffer is complete.  If so, execute it.
+      if text:
+        LOG.info("Executing buffer: %s_%d" % (name, size))
+        self.buffer = text
+
+    elif name == "u" or name == "U":
+      # Remember the username.
+      self.username = value
+      # Client may request explicit usernames in response.
+      self.echo_username = (name == "U")
+
+    elif name == "f" or name == "F":
+      # Remember the filename and version.
+      self.filename = value
+      self.server_version = version
+
+    elif name == "n" or name == "N":
+      # Nullify this file.
+      self.filename = value
+      if self.username and self.filename:
+        self.actions.append(Action(username=self.username,
+                                   filename=self.filename, mode="null"))
+
+    else:
+      # A delta or raw action.
+      if name == "d" or name == "D":
+        mode = "delta"
+      elif name == "r" or name == "R":
+        mode = "raw"
+      else:
+        mode = None
+      if mode and self.server_version is None:
+        # No f: line has given a version, e.g. a delta straight after n:.
+        LOG.warning("Missing file version: %s" % line)
+      elif self.username and self.filename and mode:
+        self.actions.append(Action(username=self.username,
+                                   filename=self.filename, mode=mode,
+                                   force=name.isupper(),
+                                   server_version=self.server_version,
+                                   client_version=version, data=value,
+                                   echo_username=self.echo_username))
+
+    return False
+
+  def finish(self):
+    """Return the list of actions parsed.  See MobWrite.parseRequest.
+    """
+    METRICS.observe("parse_seconds", self.elapsed)
+    if self.buffer is not None:
+      # A completed buffer replaces the rest of the request.
+      # Duplicate last character.  Should be a line break.
+      return self.mobwrite.parseRequest(self.buffer + self.buffer[-1])
+    return self.actions
+
+
+class Histogram:
+  # Counts of how long something took, in buckets of increasing size.
+
+  # Object properties:
+  # .bounds - List of the upper bound of each bucket, in seconds.
+  # .counts - Count of observations in each bucket, plus one for the rest.
+  # .sum - Total of all observations, in seconds.
+
+  BOUNDS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+            0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+  def __init__(self):
+    self.bounds = self.BOUNDS
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.sum = 0.0
+
+  def observe(self, seconds):
+    self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+    self.sum += seconds
+
+
+class Metrics:
+  # A registry of counters, gauges and latency histograms, rendered in the
+  # Prometheus text format when scraped.  Gauges are functions which are
+  # only called when scraped, so they cost nothing in between.  Each thread
+  # records into counts of its own, so recording takes no lock; the counts
+  # are merged when scraped.
+
+  # Object properties:
+  # .prefix - Prefix for the name of every metric.
+  # .enabled - Whether anything is recorded.  Nothing is unless it is scraped.
+  # .counters - Dictionary of declared counter names to 0.
+  # .gauges - Dictionary of names to (function returning the current value,
+  #     metric type).  Counts kept elsewhere are gauges of type 'counter'.
+  # .histograms - Dictionary of declared histogram names to None.
+  # .help - Dictionary of names to descriptions.
+  # .shards - Dictionary of thread IDs to (dictionary of names to counts,
+  #     dictionary of names to Histogram objects), written only by that thread.
+
+  def __init__(self, prefix):
+    self.prefix = prefix
+    self.enabled = False
+    self.counters = {}
+    self.gauges = {}
+    self.histograms = {}
+    self.help = {}
+    self.shards = {}
+
+  def counter(self, name, help):
+    # Declare a counter.
+    self.counters[name] = 0
+    self.help[name] = help
+
+  def gauge(self, name, help, function, kind="gauge"):
+    # Declare a gauge, whose value is returned by the function.
+    self.gauges[name] = (function, kind)
+    self.help[name] = help
+
+  def histogram(self, name, help):
+    # Declare a histogram of durations.
+    self.histograms[name] = None
+    self.help[name] = help
+
+  def shard(self):
+    # Return the calling thread's own counts.
+    ident = thread.get_ident()
+    shard = self.shards.get(ident)
+    if shard is None:
+      shard = self.shards.setdefault(ident, ({}, {}))
+    return shard
+
+  def count(self, name, n=1):
+    if not self.enabled:
+      return
+    counters = self.shard()[0]
+    counters[name] = counters.get(name, 0) + n
+
+  def observe(self, name, seconds):
+    if not self.enabled:
+      return
+    histograms = self.shard()[1]
+    histogram = histograms.get(name)
+    if histogram is None:
+      histogram = histograms[name] = Histogram()
+    histogram.observe(seconds)
+
+  def render(self):
+    """Render every metric for scraping.
+
+    Returns:
+      Multi-line string in the Prometheus text exposition format.
+    """
+    lines = []
+    def header(name, kind):
+      if self.help.has_key(name):
+        lines.append("# HELP %s%s %s" % (self.prefix, name, self.help[name]))
+      lines.append("# TYPE %s%s %s" % (self.prefix, name, kind))
+
+    # Merge the counts of every thread.
+    counters = dict(self.counters)
+    histograms = {}
+    for name in self.histograms.keys():
+      histograms[name] = ([0] * (len(Histogram.BOUNDS) + 1), 0.0)
+    for (thread_counters, thread_histograms) in self.shards.values():
+      for (name, value) in thread_counters.items():
+        counters[name] = counters.get(name, 0) + value
+      for (name, histogram) in thread_histograms.items():
+        (counts, total) = histograms.get(name,
+            ([0] * (len(Histogram.BOUNDS) + 1), 0.0))
+        counts = [a + b for (a, b) in zip(counts, list(histogram.counts))]
+        histograms[name] = (counts, total + histogram.sum)
+    histograms = [(name, counts, total)
+                  for (name, (counts, total)) in histograms.items()]
+
+    for (name, value) in sorted(counters.items()):
+      header(name, "counter")
+      lines.append("%s%s %d" % (self.prefix, name, value))
+    for (name, (function, kind)) in sorted(self.gauges.items()):
+      try:
+        value = function()
+      except:
+        LOG.exception("Gauge failed: %s" % name)
+        continue
+      header(name, kind)
+      lines.append("%s%s %s" % (self.prefix, name, value))
+    for (name, counts, total) in sorted(histograms):
+      header(name, "histogram")
+      cumulative = 0
+      for x in xrange(len(Histogram.BOUNDS)):
+        cumulative += counts[x]
+        lines.append('%s%s_bucket{le="%s"} %d' %
+                     (self.prefix, name, Histogram.BOUNDS[x], cumulative))
+      cumulative += counts[-1]
+      lines.append('%s%s_bucket{le="+Inf"} %d' %
+                   (self.prefix, name, cumulative))
+      lines.append("%s%s_sum %f" % (self.prefix, name, total))
+      lines.append("%s%s_count %d" % (self.prefix, name, cumulative))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def makeDelta(text1, text2):
+  # Return the delta which turns one text into another.
+  diffs = DMP.diff_main(text1, text2)
+  DMP.diff_cleanupEfficiency(diffs)
+  return DMP.diff_toDelta(diffs)
+
+
+def replaceDelta(text1, text2):
+  # Return a delta which turns one text into another wholesale, without the
+  # cost of diffing them.
+  diffs = []
+  if text1:
+    diffs.append((DMP.DIFF_DELETE, text1))
+  if text2:
+    diffs.append((DMP.DIFF_INSERT, text2))
+  return DMP.diff_toDelta(diffs)
+
+
+def patchText(shadow, diffs, text):
+  # Apply the changes which the diffs make to the shadow onto the text.
+  # Return the patched text and a list of which patches applied.
+  patches = DMP.patch_make(shadow, diffs)
+  return DMP.patch_apply(patches, text)
+
+
+class PoolTimeout(Exception):
+  # A computation in the diff pool took longer than POOL_TIMEOUT.
+  pass
+
+
+class DiffPool:
+  # Worker processes which diff and patch large texts, so that one long
+  # computation doesn't hold the interpreter lock against every other thread.
+
+  # Object properties:
+  # .pool - The multiprocessing pool.
+  # .processes - Number of worker processes.
+  # .threshold - Computations on at least this many characters use the pool;
+  #     smaller ones are done in the calling thread.
+  # .busy - Count of computations currently in the pool.
+  # .peak - Most computations in the pool at once.
+  # .inline - Count of computations done in the calling thread.
+  # .offloaded - Count of computations sent to the pool.
+  # .saturated - Count of computations which found every process busy.
+  # .failed - Count of computations which timed out in the pool.  The caller
+  #     decides what to do instead.
+  # .wait - Total seconds spent waiting on the pool.
+  # .lock - Access control for the counts.
+
+  def __init__(self, processes, threshold):
+    import multiprocessing
+    self.pool = multiprocessing.Pool(processes)
+    self.processes = processes
+    self.threshold = threshold
+    self.busy = 0
+    self.peak = 0
+    self.inline = 0
+    self.offloaded = 0
+    self.saturated = 0
+    self.failed = 0
+    self.wait = 0.0
+    self.lock = thread.allocate_lock()
+
+  def run(self, size, function, *args):
+    """Call a function, in a worker process if the texts are large.
+
+    Args:
+      size: Total length of the texts involved.
+      function: Module-level function to call.
+      args: Arguments for the function, which must be picklable.
+
+    Returns:
+      The function's result.
+
+    Raises:
+      PoolTimeout: The pool didn't answer within POOL_TIMEOUT seconds.
+    """
+    if size < self.threshold:
+      self.lock.acquire()
+      try:
+        self.inline += 1
+      finally:
+        self.lock.release()
+      return function(*args)
+
+    self.lock.acquire()
+    try:
+      self.offloaded += 1
+      if self.busy >= self.processes:
+        self.saturated += 1
+      self.busy += 1
+      self.peak = max(self.peak, self.busy)
+    finally:
+      self.lock.release()
+    import multiprocessing
+    start = time.time()
+    try:
+      try:
+        # A timeout keeps the wait interruptible, and survives a lost worker.
+        return self.pool.apply_async(function, args).get(POOL_TIMEOUT)
+      except multiprocessing.TimeoutError:
+        self.lock.acquire()
+        try:
+          self.failed += 1
+        finally:
+          self.lock.release()
+        LOG.error("Diff pool timed out on %d characters." % size)
+        raise PoolTimeout(size)
+    finally:
+      self.lock.acquire()
+      try:
+        self.busy -= 1
+        self.wait += time.time() - start
+      finally:
+        self.lock.release()
+
+  def stats(self):
+    self.lock.acquire()
+    try:
+      return ("%d inline, %d offloaded, %d saturated, %d failed, %d busy "
+              "(peak %d of %d), %.3fs waiting" %
+              (self.inline, self.offloaded, self.saturated, self.failed,
+               self.busy, self.peak, self.processes, self.wait))
+    finally:
+      self.lock.release()
+
+  def close(self):
+    self.pool.terminate()
+    self.pool.join()
+
+
+def compute(size, function, *args):
+  # Call a diff or patch function on texts totalling size characters, in the
+  # process pool if there is one.  May raise PoolTimeout.
+  if POOL:
+    return POOL.run(size, function, *args)
+  return function(*args)
+
+
 class MobWrite:
   def parseRequest(self, data):
     """Parse the raw MobWrite commands into a list of specific actions.
@@ -200,97 +682,11 @@ class MobWrite:
       return []
 
     # Parse the lines
-    actions = []
-    username = None
-    filename = None
-    server_version = None
-    echo_username = False
+    parser = RequestParser(self)
     for line in data.splitlines():
-      if not line:
-        # Terminate on blank line.
+      if parser.feed(line):
         break
-      if line.find(":") != 1:
-        # Invalid line.
-        continue
-      (name, value) = (line[:1], line[2:])
-
-      # Parse out a version number for file, delta or raw.
-      version = None
-      if ("FfDdRr".find(name) != -1):
-        div = value.find(":")
-        if div > 0:
-          try:
-            version = int(value[:div])
-          except ValueError:
-            LOG.warning("Invalid version number: %s" % line)
-            continue
-          value = value[div + 1:]
-        else:
-          LOG.warning("Missing version number: %s" % line)
-          continue
-
-      if name == "b" or name == "B":
-        # Decode and store this entry into a buffer.
-        try:
-          (name, size, index, text) = value.split(" ", 3)
-          size = int(size)
-          index = int(index)
-        except ValueError:
-          LOG.warning("Invalid buffer format: %s" % value)
-          continue
-        # Store this buffer fragment.
-        text = self.feedBuffer(name, size, index, text)
-        # Check to see if the buffer is complete.  If so, execute it.
-        if text:
-          LOG.info("Executing buffer: %s_%d" % (name, size))
-          # Duplicate last character.  Should be a line break.
-          # Note that buffers are not intended to be mixed with other commands.
-          return self.parseRequest(text + text[-1])
-
-      elif name == "u" or name == "U":
-        # Remember the username.
-        username = value
-        # Client may request explicit usernames in response.
-        echo_username = (name == "U")
-
-      elif name == "f" or name == "F":
-        # Remember the filename and version.
-        filename = value
-        server_version = version
-
-      elif name == "n" or name == "N":
-        # Nullify this file.
-        filename = value
-        if username and filename:
-          action = {}
-          action["username"] = username
-          action["filename"] = filename
-          action["mode"] = "null"
-          actions.append(action)
-
-      else:
-        # A delta or raw action.
-        action = {}
-        if name == "d" or name == "D":
-          action["mode"] = "delta"
-        elif name == "r" or name == "R":
-          action["mode"] = "raw"
-        else:
-          action["mode"] = None
-        if name.isupper():
-          action["force"] = True
-        else:
-          action["force"] = False
-        action["server_version"] = server_version
-        action["client_version"] = version
-        action["data"] = value
-        action["echo_username"] = echo_username
-        if username and filename and action["mode"]:
-          action["username"] = username
-          action["filename"] = filename
-          actions.append(action)
-
-    return actions
+    return parser.finish()
 
 
   def applyPatches(self, viewobj, diffs, action):
@@ -302,10 +698,8 @@ class MobWrite:
       diffs: List of diffs to apply to both the view and the server.
       action: Parameters for how forcefully to make the patch; may be modified.
     """
-    # Expand the fragile diffs into a full set of patches.
-    patches = DMP.patch_make(viewobj.shadow, diffs)
-
     # First, update the client's shadow.
+    shadow = viewobj.shadow
     viewobj.shadow = DMP.diff_text2(diffs)
     viewobj.backup_shadow = viewobj.shadow
     viewobj.backup_shadow_server_version = viewobj.shadow_server_version
@@ -321,15 +715,25 @@ class MobWrite:
     else:
       if action["force"]:
         # Clobber the server's text if a change was received.
-        if patches:
+        if DMP.patch_make(shadow, diffs):
           mastertext = viewobj.shadow
           LOG.debug("Overwrote content: '%s'" % viewobj)
         else:
           mastertext = textobj.text
       else:
-        (mastertext, results) = DMP.patch_apply(patches, textobj.text)
+        # Expand the fragile diffs into a full set of patches.
+        try:
+          (mastertext, results) = compute(len(shadow) + len(textobj.text),
+                                          patchText, shadow, diffs,
+                                          textobj.text)
+        except PoolTimeout:
+          # The shadow already has the edit, so it mustn't be dropped.  The
+          # patch is bounded by DMP's own timeouts; apply it here.
+          (mastertext, results) = patchText(shadow, diffs, textobj.text)
         LOG.debug("Patched (%s): '%s'" %
             (",".join(["%s" % (x) for x in results]), viewobj))
+        if False in results:
+          METRICS.count("patch_failures_total")
       textobj.setText(mastertext)
 
 # Global Diff/Match/Patch object.
@@ -338,4 +742,13 @@ DMP = dmp_module.diff_match_patch()
 LOG = logging.getLogger("mobwrite")
 # Configuration object.
 CFG = Configuration()
+# Metrics registry.
+METRICS = Metrics("mobwrite_")
+METRICS.histogram("parse_seconds", "Time spent parsing each request.")
+METRICS.counter("patch_failures_total",
+                "Deltas with patches which failed to apply to the text.")
+# Pool of processes for large diffs and patches, if started.
+POOL = None
+# Seconds to wait on the pool before computing in the calling thread.
+POOL_TIMEOUT = 60.0
 
@@ -0,0 +1,119 @@
+#!/usr/bin/python2.4
+
+"""Memory benchmark for the records in mobwrite_core.py
+
+Copyright 2009 Google Inc.
+http://code.google.com/p/google-mobwrite/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Reports the bytes used by each view, text and action record, comparing
+# the old dictionary-backed records with the current slotted ones.
+# Usage:  python mobwrite_core_benchmark.py [COUNT]
+
+import sys
+import mobwrite_core
+
+
+class DictViewObj:
+  # A view as it was stored before ViewObj had slots.
+
+  def __init__(self, *args, **kwargs):
+    self.username = kwargs["username"]
+    self.filename = kwargs["filename"]
+    self.shadow_client_version = kwargs.get("shadow_client_version", 0)
+    self.shadow_server_version = kwargs.get("shadow_server_version", 0)
+    self.backup_shadow_server_version = kwargs.get("backup_shadow_server_version", 0)
+    self.shadow = kwargs.get("shadow", u"")
+    self.backup_shadow = kwargs.get("backup_shadow", u"")
+    self.edit_stack = []
+    self.changed = False
+    self.delta_ok = True
+
+
+class DictTextObj:
+  # A text as it was stored before TextObj had slots.
+
+  def __init__(self, *args, **kwargs):
+    self.name = kwargs.get("name")
+    self.text = None
+    self.changed = False
+
+
+def record_size(obj):
+  """Measure the memory held by a record itself, excluding its field values
+  (which are shared or identical either way).
+
+  Args:
+    obj: A class instance or dictionary.
+
+  Returns:
+    Size in bytes of the instance and its attribute dictionary, if any.
+  """
+  size = sys.getsizeof(obj)
+  if hasattr(obj, "__dict__"):
+    size += sys.getsizeof(obj.__dict__)
+  return size
+
+
+def measure(factory, count):
+  """Build many records and return their mean size.
+
+  Args:
+    factory: Function which returns a new record given an index.
+    count: Number of records to build.
+
+  Returns:
+    Mean size in bytes of one record.
+  """
+  records = [factory(x) for x in xrange(count)]
+  total = 0
+  for record in records:
+    total += record_size(record)
+  return total / float(count)
+
+
+def main():
+  if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+  else:
+    count = 10000
+
+  def view_kwargs(x):
+    return {"username": "user%d" % x, "filename": "file%d" % (x % 100)}
+
+  def action_kwargs(x):
+    return {"username": "user%d" % x, "filename": "file%d" % (x % 100),
+            "mode": "delta", "data": "=10", "force": False,
+            "server_version": x, "client_version": x, "echo_username": False}
+
+  rows = [
+    ("view", lambda x: DictViewObj(**view_kwargs(x)),
+             lambda x: mobwrite_core.ViewObj(**view_kwargs(x))),
+    ("text", lambda x: DictTextObj(name="file%d" % x),
+             lambda x: mobwrite_core.TextObj(name="file%d" % x)),
+    ("action", lambda x: action_kwargs(x),
+               lambda x: mobwrite_core.Action(**action_kwargs(x))),
+  ]
+  print "Bytes per record, mean of %d:" % count
+  print "%-8s %8s %8s %8s" % ("record", "before", "after", "saved")
+  for (name, before, after) in rows:
+    before = measure(before, count)
+    after = measure(after, count)
+    print "%-8s %8d %8d %7d%%" % (name, before, after,
+                                  100 * (before - after) / before)
+
+
+if __name__ == "__main__":
+  main()
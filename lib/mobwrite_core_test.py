@@ -20,6 +20,8 @@ limitations under the License.
 
 import unittest
 import logging
+import thread
+import time
 import mobwrite_core
 # Force a module reload so to make debugging easier (at least in PythonWin).
 reload(mobwrite_core)
@@ -78,6 +80,87 @@ N:report
        "mode":"null",
       }], actions)
 
+    # A delta needs the version from an f: line.
+    actions = mobwrite.parseRequest("""u:fred
+n:report
+d:2:=10
+
+""")
+    self.assertEquals([{"username":"fred",
+       "filename":"report",
+       "mode":"null",
+      }], actions)
+
+  def testRequestParser(self):
+    mobwrite = mobwrite_core.MobWrite()
+    parser = mobwrite_core.RequestParser(mobwrite)
+    self.assertFalse(parser.feed("u:fred"))
+    self.assertFalse(parser.feed("f:3:report"))
+    self.assertFalse(parser.feed("d:2:=10+Hello-7=2"))
+    self.assertEquals(1, len(parser.actions))
+    self.assertTrue(parser.feed(""))
+    self.assertEquals(mobwrite.parseRequest("u:fred\nf:3:report\n" +
+                                            "d:2:=10+Hello-7=2\n\n"),
+                      parser.finish())
+
+  def testMetrics(self):
+    metrics = mobwrite_core.Metrics("test_")
+    metrics.counter("hits_total", "Hits.")
+    # Nothing is recorded until enabled.
+    metrics.count("hits_total", 5)
+    self.assertEquals({}, metrics.shards)
+    metrics.enabled = True
+    metrics.count("hits_total", 1)
+    # Counts from other threads are merged in.
+    done = thread.allocate_lock()
+    done.acquire()
+    def other():
+      metrics.count("hits_total", 1)
+      done.release()
+    thread.start_new_thread(other, ())
+    done.acquire()
+    metrics.gauge("size", "Size.", lambda: 7)
+    metrics.observe("wait_seconds", 0.003)
+    metrics.observe("wait_seconds", 20.0)
+    lines = metrics.render().splitlines()
+    self.assertEquals(["# HELP test_hits_total Hits.",
+                       "# TYPE test_hits_total counter",
+                       "test_hits_total 2",
+                       "# HELP test_size Size.",
+                       "# TYPE test_size gauge",
+                       "test_size 7",
+                       "# TYPE test_wait_seconds histogram"], lines[:7])
+    self.assertTrue('test_wait_seconds_bucket{le="0.0025"} 0' in lines)
+    self.assertTrue('test_wait_seconds_bucket{le="0.005"} 1' in lines)
+    self.assertTrue('test_wait_seconds_bucket{le="10.0"} 1' in lines)
+    self.assertTrue('test_wait_seconds_bucket{le="+Inf"} 2' in lines)
+    self.assertEquals("test_wait_seconds_count 2", lines[-1])
+
+  def testDiffPool(self):
+    # Large computations go to the pool, small ones stay in place.
+    pool = mobwrite_core.DiffPool(1, 10)
+    try:
+      self.assertEquals("=5\t+!",
+          pool.run(11, mobwrite_core.makeDelta, u"Hello", u"Hello!"))
+      self.assertEquals((u"Hi world!", [True]),
+          pool.run(9, mobwrite_core.patchText, u"Hello",
+                   [(0, u"Hello"), (1, u"!")], u"Hi world"))
+      self.assertEquals(1, pool.offloaded)
+      self.assertEquals(1, pool.inline)
+      self.assertEquals(0, pool.busy)
+      # A timeout is reported rather than computed again in place.
+      timeout = mobwrite_core.POOL_TIMEOUT
+      mobwrite_core.POOL_TIMEOUT = 0.1
+      try:
+        self.assertRaises(mobwrite_core.PoolTimeout,
+                          pool.run, 11, time.sleep, 1)
+      finally:
+        mobwrite_core.POOL_TIMEOUT = timeout
+      self.assertEquals(1, pool.failed)
+      self.assertEquals(0, pool.busy)
+    finally:
+      pool.close()
+
 
 if __name__ == "__main__":
   unittest.main()